@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Time the uflow scripts on synthetic datasets of increasing size.
+
+For each size (SAMPLESxFEATURES) a dataset is generated with synthData.py,
+then each tool is run as a separate process, recording its wall time and
+peak memory (maximum resident set size). Results are saved as JSON, with
+the git commit, to compare runs across commits.
+
+This script only uses the standard library and runs the generator as a
+subprocess: the peak memory of a child includes the memory of the parent
+at the time of the fork, which must stay small.
+"""
+import os, sys
+import argparse
+import json
+import platform
+import subprocess
+import time
+import shutil
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BIN = os.path.join(HERE, "..", "bin")
+
+# Tool name -> command (arguments formatted with the dataset directory as {data}
+# and the output directory as {out})
+TOOLS = {
+    "mergeTables": ["mergeTables.py", "-s", "--otuid", "#OTU ID", "-l", "{data}/tables.txt", "-o", "{out}/merged.tsv"],
+    "mergeTables-binary": ["mergeTables.py", "-s", "--otuid", "#OTU ID", "-l", "{data}/tables.txt", "-o", "{out}/merged.tsv", "-b"],
+    "normalizeOtutable": ["normalizeOtutable.py", "-i", "{data}/otutab.tsv", "-o", "{out}/norm.tsv"],
+    "normalizeOtutable-binary": ["normalizeOtutable.py", "-i", "{data}/otutab.npz", "-o", "{out}/norm.tsv"],
+    "addTaxonomy": ["addTaxonomy.py", "-i", "{data}/otutab.tsv", "-t", "{data}/taxonomy.tsv", "-f", "{data}/asv.fa", "-o", "{out}/tax.tsv"],
+    "exporter": ["exporter.py", "-i", "{data}/otutab.tsv", "-f", "{data}/asv.fa", "-t", "{data}/taxonomy.tsv",
+        "-m", "{data}/metadata.tsv", "-o", "{out}/export"],
+    "countClass": ["countClass.py", "-i", "{data}/kraken.txt"],
+    "countClass-block": ["countClass.py", "-b", "-i", "{data}/kraken.txt"],
+    "alphaDiversity": ["alphaDiversity.py", "-i", "{data}/otutab.npz", "-o", "{out}/alpha.txt"],
+    "betaDiversity": ["betaDiversity.py", "-i", "{data}/otutab.npz", "-o", "{out}/beta"],
+}
+
+
+def parseSize(size):
+    samples, features = size.lower().split("x")
+    return int(samples), int(features)
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "-C", HERE, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runTool(command, log):
+    """
+    Run a command, return (exit status, wall time in seconds, peak RSS in MB)
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=log, stderr=log)
+    # wait4 gives the resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return process.returncode, elapsed, usage.ru_maxrss / scale
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Benchmark the uflow scripts on synthetic data of increasing size")
+    args.add_argument("-s", "--sizes", help="Comma separated SAMPLESxFEATURES sizes [default: %(default)s]", default="50x500,200x2000,1000x10000")
+    args.add_argument("-t", "--tools", help="Comma separated tools [default: all]", default=",".join(TOOLS))
+    args.add_argument("-r", "--repeats", help="Runs per tool, keeping the fastest time and the highest memory [default: %(default)s]", type=int, default=1)
+    args.add_argument("--reads", help="Kraken reads per sample [default: %(default)s]", type=int, default=1000)
+    args.add_argument("--seed", help="Random seed [default: %(default)s]", type=int, default=42)
+    args.add_argument("-w", "--workdir", help="Directory for the datasets and outputs [default: temporary]")
+    args.add_argument("--keep", help="Keep the datasets and outputs", action="store_true")
+    args.add_argument("-o", "--output", help="Output JSON file [default: %(default)s]", default="benchmark.json")
+    opts = args.parse_args()
+
+    tools = opts.tools.split(",")
+    for tool in tools:
+        if tool not in TOOLS:
+            print("Error: unknown tool {}, available: {}".format(tool, ",".join(TOOLS)))
+            sys.exit(1)
+    try:
+        sizes = [parseSize(size) for size in opts.sizes.split(",")]
+    except ValueError:
+        print("Error: sizes must be SAMPLESxFEATURES, e.g. 100x1000")
+        sys.exit(1)
+
+    workdir = opts.workdir if opts.workdir is not None else tempfile.mkdtemp(prefix="uflow-bench.")
+    results = []
+    try:
+        for samples, features in sizes:
+            data = os.path.join(workdir, f"{samples}x{features}")
+            subprocess.check_call([sys.executable, os.path.join(HERE, "synthData.py"), "-o", data, "-s", str(samples),
+                "-f", str(features), "-r", str(samples * opts.reads), "--seed", str(opts.seed)])
+            with open(os.path.join(data, "dataset.json")) as f:
+                dataset = json.load(f)
+            for tool in tools:
+                out = os.path.join(data, "out", tool)
+                os.makedirs(out, exist_ok=True)
+                command = [sys.executable, os.path.join(BIN, TOOLS[tool][0])] + \
+                    [arg.format(data=data, out=out) for arg in TOOLS[tool][1:]]
+                runs = []
+                with open(os.path.join(out, "log.txt"), "w") as log:
+                    for _ in range(max(1, opts.repeats)):
+                        runs.append(runTool(command, log))
+                status = max(run[0] for run in runs)
+                seconds = min(run[1] for run in runs)
+                memory = max(run[2] for run in runs)
+                results.append({
+                    "tool": tool,
+                    "samples": samples,
+                    "features": features,
+                    "counts": dataset["counts"],
+                    "reads": dataset["reads"],
+                    "status": status,
+                    "seconds": round(seconds, 4),
+                    "max_rss_mb": round(memory, 1),
+                })
+                print(f"{tool}\t{samples}x{features}\t{seconds:.3f}s\t{memory:.1f} MB" + ("" if status == 0 else f"\tFAILED ({status})"), file=sys.stderr)
+    finally:
+        if not opts.keep and opts.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": gitCommit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "seed": opts.seed,
+        "results": results,
+    }
+    with open(opts.output, "w") as f:
+        json.dump(report, f, indent=2)
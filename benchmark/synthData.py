@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Generate a deterministic synthetic dataset for the uflow scripts:
+  tabs/{sample}.tab   per-sample tables (as usearch -otutab)
+  tables.txt          list of the per-sample tables
+  otutab.tsv/.npz     merged sparse OTU table (features x samples)
+  asv.fa              ASV sequences
+  taxonomy.tsv        DECIPHER-style taxonomy (as dadaist2-assigntax)
+  metadata.tsv        sample metadata
+  kraken.txt          Kraken2 per-read output
+  dataset.json        sizes and parameters
+The same seed and sizes always produce the same files.
+"""
+import os, sys
+import argparse
+import json
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from sparseTable import SparseTable
+
+RANKS = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def sampleNames(samples):
+    return [f"Sample-{i}" for i in range(samples)]
+
+
+def featureNames(features):
+    return [f"Zotu{i + 1}" for i in range(features)]
+
+
+def randomTable(rng, samples, features, density=0.05, depth=20000):
+    """
+    Sparse counts: each sample has about density * features ASVs, with
+    log-normal abundances summing to about depth reads
+    """
+    present = max(1, int(round(features * density)))
+    rows, cols, data = [], [], []
+    # Some ASVs are common to many samples
+    weights = rng.pareto(1.0, features) + 1
+    weights /= weights.sum()
+    for sample in range(samples):
+        chosen = np.unique(rng.choice(features, size=present, replace=False, p=weights))
+        abundance = rng.lognormal(0, 1.5, len(chosen))
+        counts = np.maximum(1, np.round(abundance / abundance.sum() * depth)).astype(np.int64)
+        rows.append(chosen)
+        cols.append(np.full(len(chosen), sample))
+        data.append(counts)
+    rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(features + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=features), out=indptr[1:])
+    return SparseTable(featureNames(features), sampleNames(samples), indptr,
+        cols[order].astype(np.int32), data[order].astype(np.uint32), "#OTU ID")
+
+
+def writeTabs(table, directory):
+    """
+    One two-columns table per sample, return the list of paths
+    """
+    os.makedirs(directory, exist_ok=True)
+    colptr, features, values = table.toCsc()
+    paths = []
+    for col, sample in enumerate(table.samples):
+        path = os.path.join(directory, f"{sample}.tab")
+        with open(path, "w") as f:
+            f.write(f"#OTU ID\t{sample}\n")
+            for feature, value in zip(features[colptr[col]:colptr[col + 1]].tolist(), values[colptr[col]:colptr[col + 1]].tolist()):
+                f.write(f"{table.features[feature]}\t{value}\n")
+        paths.append(path)
+    return paths
+
+
+def writeFasta(rng, path, names, length=(240, 260)):
+    with open(path, "w") as f:
+        for name in names:
+            sequence = BASES[rng.integers(0, 4, rng.integers(length[0], length[1] + 1))].tobytes().decode()
+            f.write(f">{name}\n{sequence}\n")
+
+
+def writeTaxonomy(rng, path, features, missing=0.1):
+    """
+    DECIPHER-style table: space separated, a header of ranks, rows numbered from 1
+    """
+    # A small tree of taxa: each rank has more names than the previous one
+    with open(path, "w") as f:
+        f.write(" ".join(RANKS) + "\n")
+        for i in range(features):
+            lineage = ["Bacteria"]
+            for depth, rank in enumerate(RANKS[1:]):
+                name = f"{rank[0]}{rng.integers(0, 4 ** (depth + 1))}"
+                lineage.append("NA" if rng.random() < missing * (depth + 1) / len(RANKS) else name)
+            f.write(f"{i + 1} " + " ".join(lineage) + "\n")
+
+
+def writeMetadata(path, samples):
+    with open(path, "w") as f:
+        f.write("#SampleID\tGroup\n")
+        for i, sample in enumerate(samples):
+            f.write(f"{sample}\t{'AB'[i % 2]}\n")
+
+
+def writeKraken(rng, path, reads, classified=0.7, taxa=500, batch=100000):
+    """
+    Kraken2 per-read output: C/U, read name, taxid, length, k-mer LCA mapping
+    """
+    with open(path, "w") as f:
+        for start in range(0, reads, batch):
+            n = min(batch, reads - start)
+            status = rng.random(n) < classified
+            taxids = np.where(status, rng.integers(2, taxa + 2, n), 0)
+            lengths = rng.integers(100, 151, n)
+            lines = []
+            for i, (ok, taxid, length) in enumerate(zip(status.tolist(), taxids.tolist(), lengths.tolist())):
+                kmers = length - 34
+                mapping = f"0:{kmers // 3} {taxid}:{kmers - kmers // 3}" if ok else f"0:{kmers}"
+                lines.append(f"{'CU'[not ok]}\tread{start + i + 1}\t{taxid}\t{length}\t{mapping}\n")
+            f.write("".join(lines))
+
+
+def generate(outdir, samples, features, reads=100000, density=0.05, depth=20000, seed=42):
+    """
+    Write the dataset to outdir, return the table
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(outdir, exist_ok=True)
+    table = randomTable(rng, samples, features, density, depth)
+    paths = writeTabs(table, os.path.join(outdir, "tabs"))
+    with open(os.path.join(outdir, "tables.txt"), "w") as f:
+        f.write("\n".join(paths) + "\n")
+    with open(os.path.join(outdir, "otutab.tsv"), "w") as f:
+        table.writeTsv(f)
+    table.save(os.path.join(outdir, "otutab.npz"))
+    writeFasta(rng, os.path.join(outdir, "asv.fa"), table.features)
+    writeTaxonomy(rng, os.path.join(outdir, "taxonomy.tsv"), features)
+    writeMetadata(os.path.join(outdir, "metadata.tsv"), table.samples)
+    writeKraken(rng, os.path.join(outdir, "kraken.txt"), reads)
+    with open(os.path.join(outdir, "dataset.json"), "w") as f:
+        json.dump({"samples": samples, "features": features, "counts": int(table.nnz), "reads": reads,
+            "density": density, "depth": depth, "seed": seed}, f, indent=2)
+    return table
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Generate a deterministic synthetic dataset for the uflow scripts")
+    args.add_argument("-o", "--outdir", help="Output directory", required=True)
+    args.add_argument("-s", "--samples", help="Number of samples [default: %(default)s]", type=int, default=100)
+    args.add_argument("-f", "--features", help="Number of features (ASVs) [default: %(default)s]", type=int, default=1000)
+    args.add_argument("-r", "--reads", help="Number of Kraken reads [default: %(default)s]", type=int, default=100000)
+    args.add_argument("-d", "--density", help="Fraction of the ASVs in each sample [default: %(default)s]", type=float, default=0.05)
+    args.add_argument("--depth", help="Reads per sample [default: %(default)s]", type=int, default=20000)
+    args.add_argument("--seed", help="Random seed [default: %(default)s]", type=int, default=42)
+    opts = args.parse_args()
+
+    table = generate(opts.outdir, opts.samples, opts.features, opts.reads, opts.density, opts.depth, opts.seed)
+    print(f"{opts.outdir}: {len(table.samples)} samples, {len(table.features)} features, {table.nnz} counts", file=sys.stderr)
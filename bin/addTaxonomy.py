@@ -3,9 +3,12 @@
 Read an OTU table and a taxonomy file, then add a "Taxonomy" column to the OTU table
 """
 #Zotu1   Root [rootrank, 100.0%]; Fungi [kingdom, 100.0%]; Ascomycota [phylum, 100.0%]; Saccharomycetes [class, 100.0%]; Saccharomycetales [order, 100.0%]; Debaryomycetaceae [family, 100.0%]; Debaryomyces [genus, 98.8%]; unclassified_Debaryomyces [species, 98.8%]
+import numpy as np
 import pandas as pd
 import os, sys
 import argparse
+from sparseTable import loadNpz
+from instrument import Instrument
 
 def loadTaxonomy(taxonomy, fasta):
     # Load the OTU names from the fasta file
@@ -27,15 +30,98 @@ def loadTaxonomy(taxonomy, fasta):
 
 def condenseTaxonomy(tax):
     # Condense the taxonomy to a string like k__Kingdom; p__Phylum; c__Class; o__Order; f__Family; g__Genus; s__Species
-    tax = tax.copy()
-    tax["Taxonomy"] = tax.apply(lambda row: ";".join(row.dropna().astype(str)), axis=1)
-    # Remove all columns except Taxonomy
-    tax = tax.drop(tax.columns.difference(["Taxonomy"]), axis=1)
-    return tax
+    # built one rank (column) at a time, skipping the missing ranks
+    condensed = np.full(len(tax), "", dtype=object)
+    filled = np.zeros(len(tax), dtype=bool)
+    for column in tax.columns:
+        present = tax[column].notna().to_numpy()
+        values = tax[column].astype(str).to_numpy(dtype=object)
+        separator = np.where(filled[present], ";", "").astype(object)
+        condensed[present] = condensed[present] + separator + values[present]
+        filled |= present
+    return pd.DataFrame({"Taxonomy": condensed}, index=tax.index)
+
+def outerDtypes(df, missing):
+    # Integer columns of a frame gaining missing rows in an outer join become float
+    if not missing:
+        return df
+    integers = [column for column, dtype in df.dtypes.items() if dtype.kind in "iu"]
+    return df.astype({column: np.float64 for column in integers}) if integers else df
+
+def tableChunks(table, rows):
+    """
+    Row blocks of a SparseTable as DataFrames (integer counts as int64)
+    """
+    dtype = np.int64 if table.data.dtype.kind in "ui" else np.float64
+    for ids, block in table.blocks(rows, dtype):
+        yield pd.DataFrame(block, index=ids, columns=table.samples)
+
+def textColumns(path, sep, rows):
+    """
+    First pass over a text table, a block of rows at a time: return the OTU
+    names and the type of each column over the whole table, as inferred by a
+    single read_csv (int64, float64 if any block has floats or missing
+    values, object otherwise), so that all the blocks are parsed alike
+    """
+    features = []
+    kinds = {}
+    for df in pd.read_csv(path, sep=sep, index_col=0, chunksize=rows):
+        features.extend(df.index.tolist())
+        for column, dtype in df.dtypes.items():
+            kinds.setdefault(column, set()).add(dtype.kind)
+    dtypes = {}
+    for column, kind in kinds.items():
+        if kind <= set("iu"):
+            dtypes[column] = np.int64
+        elif kind <= set("iuf"):
+            dtypes[column] = np.float64
+        else:
+            dtypes[column] = object
+    return features, dtypes
+
+def writeTaxonomyTable(chunks, features, samples, taxonomy, output, condense=False, sep="\t", index_name="#NAME"):
+    """
+    Save the OTU table with the taxonomy columns (or the condensed taxonomy)
+    and the taxonomy alone (output + ".taxonomy.txt").
+    The table is given by its OTU names and its row blocks (DataFrames),
+    each block is joined and written as it comes.
+    Only the OTUs with a (complete) taxonomy are saved, in the order of the table.
+    """
+    if condense:
+        taxonomy = condenseTaxonomy(taxonomy)
+    taxonomy.index.name = "#TAXONOMY"
+    taxonomy.to_csv(output + ".taxonomy.txt", sep=sep)
+
+    # Hash join on the first taxonomy of each OTU
+    taxonomy = taxonomy[~taxonomy.index.duplicated()]
+    position = taxonomy.index.get_indexer(pd.Index(features))
+    complete = taxonomy.notna().all(axis=1).to_numpy()
+
+    # Same column types as the outer join of the two tables
+    missing = not taxonomy.index.isin(features).all()
+    taxonomy = outerDtypes(taxonomy, bool((position < 0).any()))
+
+    with open(output, "w") as f:
+        start = 0
+        header = True
+        for df in chunks:
+            found = position[start:start + len(df)]
+            start += len(df)
+            keep = (found >= 0) & df.notna().all(axis=1).to_numpy()
+            keep[keep] = complete[found[keep]]
+            chunk = outerDtypes(df, missing).iloc[np.flatnonzero(keep)]
+            ranks = taxonomy.iloc[found[keep]]
+            ranks.index = chunk.index
+            chunk = pd.concat([chunk, ranks], axis=1)
+            chunk.index.name = index_name
+            chunk.to_csv(f, sep=sep, header=header)
+            header = False
+        if header:
+            f.write(sep.join([index_name] + list(samples) + list(taxonomy.columns)) + "\n")
 
 if __name__ == "__main__":
     args = argparse.ArgumentParser()
-    args.add_argument("-i", "--input", help="Input OTU table", required=True)
+    args.add_argument("-i", "--input", help="Input OTU table (text, or binary .npz)", required=True)
     args.add_argument("-f", "--fasta", help="Input FASTA file (OTUs)", required=True)
     args.add_argument("-t", "--taxonomy", help="Input taxonomy file (dadaist2 format)", required=True)
     args.add_argument("-o", "--output", help="Output OTU table", required=True)
@@ -58,31 +144,24 @@ if __name__ == "__main__":
     if not os.path.exists(args.fasta):
         print("Error: FASTA file not found: " + args.fasta)
         sys.exit(1)    
-    # Read OTU table
-    df = pd.read_csv(args.input, sep=args.otutab_separator, index_col=0)
-    sampleNames = df.columns.values
-
-    # Read taxonomy file
-    taxonomy = loadTaxonomy(args.taxonomy, args.fasta)
-    
-    taxonomy_condensed = condenseTaxonomy(taxonomy)
-    
-    # Add the taxonomy joining df and taxonomy
-    if args.condense:
-        df = pd.concat([df, taxonomy_condensed], axis=1)
-        taxonomy_condensed.index.name = "#TAXONOMY"
-        taxonomy_condensed.to_csv(args.output + ".taxonomy.txt", sep=OUTPUT_SEP)
-    else:
-        df = pd.concat([df, taxonomy], axis=1)
-        taxonomy.index.name = "#TAXONOMY"
-        taxonomy.to_csv(args.output + ".taxonomy.txt", sep=OUTPUT_SEP)
-    
-    # Set index name
-    df.index.name = args.index_name
+    metrics = Instrument("addTaxonomy")
+    # Read the OTU table, joined to the taxonomy a block of rows at a time
+    with metrics.phase("read") as phase:
+        if args.input.endswith(".npz"):
+            table = loadNpz(args.input)
+            features, samples = table.features, table.samples
+            chunks = tableChunks(table, max(1, 4000000 // max(len(samples), 1)))
+        else:
+            header = pd.read_csv(args.input, sep=args.otutab_separator, nrows=0)
+            samples = header.columns[1:].tolist()
+            rows = max(1, 4000000 // max(len(samples), 1))
+            features, dtypes = textColumns(args.input, args.otutab_separator, rows)
+            chunks = pd.read_csv(args.input, sep=args.otutab_separator, index_col=0, chunksize=rows, dtype=dtypes)
 
-    # Remove all rows with NaN values
-    df = df.dropna(axis=0, how='any')
+        # Read taxonomy file
+        taxonomy = loadTaxonomy(args.taxonomy, args.fasta)
+        phase.records = len(features)
     
-    df.to_csv(args.output, sep=OUTPUT_SEP)
-
-    
\ No newline at end of file
+    with metrics.phase("join") as phase:
+        writeTaxonomyTable(chunks, features, samples, taxonomy, args.output, args.condense, OUTPUT_SEP, args.index_name)
+        phase.records = len(features)
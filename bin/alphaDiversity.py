@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Alpha diversity of each sample of an OTU table, as a drop-in for
+"usearch -alpha_div" (same "Sample" + metric columns as alpha.txt).
+
+Metrics (S = richness, N = reads, p = relative abundance, f1/f2 = singletons/doubletons):
+  berger_parker  max(p)
+  buzas_gibson   exp(shannon_e) / S
+  chao1          S + f1 * (f1 - 1) / (2 * (f2 + 1))
+  dominance      1 - simpson
+  equitability   shannon_e / ln(S)
+  jost           1 / simpson (Jost effective number of species, order 2)
+  jost1          exp(shannon_e) (Jost effective number of species, order 1)
+  reads          N
+  richness       S
+  robbins        f1 / (N + 1)
+  simpson        sum(p^2)
+  shannon_2, shannon_e, shannon_10   -sum(p log p)
+"""
+import os, sys
+import argparse
+from multiprocessing import Pool
+import numpy as np
+from sparseTable import loadTable
+from instrument import Instrument
+
+METRICS = ["richness", "chao1", "berger_parker", "buzas_gibson", "dominance", "equitability",
+    "jost", "jost1", "reads", "robbins", "simpson", "shannon_2", "shannon_e", "shannon_10"]
+INTEGER_METRICS = ["richness", "reads"]
+
+
+def alphaChunk(job):
+    """
+    Compute all metrics for a chunk of samples, given their non-zero counts
+    and the (local) sample index of each count
+    """
+    counts, sample_ids, nsamples = job
+    keep = counts > 0
+    counts, sample_ids = counts[keep].astype(np.float64), sample_ids[keep]
+    reads = np.bincount(sample_ids, weights=counts, minlength=nsamples)
+    richness = np.bincount(sample_ids, minlength=nsamples).astype(np.float64)
+    f1 = np.bincount(sample_ids, weights=(counts == 1), minlength=nsamples)
+    f2 = np.bincount(sample_ids, weights=(counts == 2), minlength=nsamples)
+    maxima = np.zeros(nsamples)
+    np.maximum.at(maxima, sample_ids, counts)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = counts / reads[sample_ids]
+        simpson = np.bincount(sample_ids, weights=p * p, minlength=nsamples)
+        # 0.0 - x rather than -x: no "-0.0000" for the samples with one OTU or none
+        shannon_e = 0.0 - np.bincount(sample_ids, weights=p * np.log(p), minlength=nsamples)
+        metrics = {
+            "richness": richness,
+            "chao1": richness + f1 * (f1 - 1) / (2 * (f2 + 1)),
+            "berger_parker": np.where(reads > 0, maxima / reads, 0.0),
+            "buzas_gibson": np.where(richness > 0, np.exp(shannon_e) / richness, 0.0),
+            "dominance": np.where(reads > 0, 1 - simpson, 0.0),
+            "equitability": np.where(richness > 1, shannon_e / np.log(richness), 0.0),
+            "jost": np.where(simpson > 0, 1 / simpson, 0.0),
+            "jost1": np.where(richness > 0, np.exp(shannon_e), 0.0),
+            "reads": reads,
+            "robbins": f1 / (reads + 1),
+            "simpson": simpson,
+            "shannon_2": shannon_e / np.log(2),
+            "shannon_e": shannon_e,
+            "shannon_10": shannon_e / np.log(10),
+        }
+    return metrics
+
+
+def alphaDiversity(table, threads=1, chunk_size=500):
+    """
+    Return a dict metric -> array (one value per sample)
+    """
+    colptr, _, values = table.toCsc()
+    nsamples = len(table.samples)
+    jobs = []
+    for start in range(0, nsamples, chunk_size):
+        end = min(start + chunk_size, nsamples)
+        lo, hi = colptr[start], colptr[end]
+        sample_ids = np.repeat(np.arange(end - start), np.diff(colptr[start:end + 1]))
+        jobs.append((values[lo:hi], sample_ids, end - start))
+    if threads > 1 and len(jobs) > 1:
+        with Pool(min(threads, len(jobs))) as pool:
+            results = pool.map(alphaChunk, jobs)
+    else:
+        results = [alphaChunk(job) for job in jobs]
+    return {metric: np.concatenate([result[metric] for result in results]) if results else np.zeros(0)
+        for metric in METRICS}
+
+
+def formatValue(metric, value):
+    return str(int(value)) if metric in INTEGER_METRICS else f"{value:.4f}"
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Alpha diversity metrics of each sample of an OTU table")
+    args.add_argument("-i", "--input", help="Input OTU table (text, or binary .npz)", required=True)
+    args.add_argument("-o", "--output", help="Output file [default: stdout]")
+    args.add_argument("-s", "--separator", help="Separator of the OTU table [default: tab]", default="\t")
+    args.add_argument("-m", "--metrics", help="Comma separated metrics [default: all]", default=",".join(METRICS))
+    args.add_argument("-t", "--threads", help="Worker processes [default: %(default)s]", type=int, default=1)
+    args.add_argument("--chunk-size", help="Samples per worker task [default: %(default)s]", type=int, default=500)
+    opts = args.parse_args()
+
+    if not os.path.isfile(opts.input):
+        print("Error: OTU table file not found: " + opts.input)
+        sys.exit(1)
+
+    metrics = opts.metrics.split(",")
+    for metric in metrics:
+        if metric not in METRICS:
+            print("Error: unknown metric {}, available: {}".format(metric, ",".join(METRICS)))
+            sys.exit(1)
+
+    instrument = Instrument("alphaDiversity")
+    with instrument.phase("load") as phase:
+        table = loadTable(opts.input, opts.separator)
+        phase.records = table.nnz
+    with instrument.phase("compute") as phase:
+        alpha = alphaDiversity(table, threads=opts.threads, chunk_size=opts.chunk_size)
+        phase.records = len(table.samples)
+
+    with instrument.phase("write") as phase:
+        outfile = open(opts.output, "w") if opts.output is not None else sys.stdout
+        print("Sample\t" + "\t".join(metrics), file=outfile)
+        for i, sample in enumerate(table.samples):
+            print(sample + "\t" + "\t".join(formatValue(metric, alpha[metric][i]) for metric in metrics), file=outfile)
+        phase.records = len(table.samples)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Pairwise beta diversity matrices of the samples of an OTU table, as a
+replacement for "usearch -beta_div" (writes {metric}.txt square matrices).
+
+The matrix is computed in tiles of samples by a pool of workers, each tile
+being written to a memory mapped square matrix on disk, so that peak memory
+depends on the tile size and not on the number of samples.
+
+Metrics:
+  jaccard      1 - |A and B| / |A or B| (presence/absence)
+  bray_curtis  sum|a - b| / sum(a + b)
+"""
+import os, sys
+import argparse
+import tempfile
+from multiprocessing import Pool
+import numpy as np
+from sparseTable import loadTable
+from instrument import Instrument
+
+METRICS = ["jaccard", "bray_curtis"]
+
+# Set in each worker by initWorker
+_csc = None
+
+
+def initWorker(colptr, features, values, nfeatures, matrices):
+    global _csc
+    _csc = (colptr, features, values, nfeatures, matrices)
+
+
+def denseTile(start, end):
+    """
+    Counts of samples [start, end) as a dense (samples x features) block
+    """
+    colptr, features, values, nfeatures, _ = _csc
+    tile = np.zeros((end - start, nfeatures), dtype=np.float32)
+    lo, hi = colptr[start], colptr[end]
+    local = np.repeat(np.arange(end - start), np.diff(colptr[start:end + 1]))
+    tile[local, features[lo:hi]] = values[lo:hi]
+    return tile
+
+
+def jaccard(a, b):
+    a = (a > 0).astype(np.float32)
+    b = (b > 0).astype(np.float32)
+    shared = a @ b.T
+    union = a.sum(axis=1)[:, None] + b.sum(axis=1)[None, :] - shared
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union > 0, 1 - shared / union, 0.0)
+
+
+def brayCurtis(a, b):
+    # Only the features present in either tile contribute
+    used = np.flatnonzero((a > 0).any(axis=0) | (b > 0).any(axis=0))
+    a, b = a[:, used], b[:, used]
+    minimum = np.empty((len(a), len(b)), dtype=np.float64)
+    for i in range(len(a)):
+        minimum[i] = np.minimum(a[i], b).sum(axis=1, dtype=np.float64)
+    total = a.sum(axis=1, dtype=np.float64)[:, None] + b.sum(axis=1, dtype=np.float64)[None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total > 0, 1 - 2 * minimum / total, 0.0)
+
+
+DISTANCES = {"jaccard": jaccard, "bray_curtis": brayCurtis}
+
+
+def computeTile(task):
+    """
+    Compute tile (i, j) of every metric and store it (and its transpose) in the matrices
+    """
+    (i0, i1), (j0, j1) = task
+    a = denseTile(i0, i1)
+    b = a if i0 == j0 else denseTile(j0, j1)
+    for metric, path in _csc[4].items():
+        matrix = np.load(path, mmap_mode="r+")
+        distance = DISTANCES[metric](a, b)
+        matrix[i0:i1, j0:j1] = distance
+        matrix[j0:j1, i0:i1] = distance.T
+        matrix.flush()
+        del matrix
+    return task
+
+
+def betaDiversity(table, metrics, directory, threads=1, tile=256):
+    """
+    Compute the square matrices of the metrics as .npy files in directory,
+    return a dict metric -> path
+    """
+    nsamples = len(table.samples)
+    colptr, features, values = table.toCsc()
+    matrices = {}
+    for metric in metrics:
+        path = os.path.join(directory, f"{metric}.npy")
+        np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(nsamples, nsamples)).flush()
+        matrices[metric] = path
+    blocks = [(start, min(start + tile, nsamples)) for start in range(0, nsamples, tile)]
+    tasks = [(blocks[i], blocks[j]) for i in range(len(blocks)) for j in range(i, len(blocks))]
+    init = (colptr, features, values.astype(np.float32), len(table.features), matrices)
+    if threads > 1 and len(tasks) > 1:
+        with Pool(min(threads, len(tasks)), initializer=initWorker, initargs=init) as pool:
+            for _ in pool.imap_unordered(computeTile, tasks):
+                pass
+    else:
+        initWorker(*init)
+        for task in tasks:
+            computeTile(task)
+    return matrices
+
+
+def writeSquare(f, samples, matrix):
+    """
+    Write the square matrix as text, one row at a time
+    """
+    f.write("\t" + "\t".join(samples) + "\n")
+    for sample, row in zip(samples, matrix):
+        f.write(sample + "\t" + "\t".join(f"{value:.4f}" for value in row.tolist()) + "\n")
+
+
+def saveCondensed(path, matrix):
+    """
+    Save the upper triangle (row-major, as scipy's squareform) as .npy, one row at a time
+    """
+    n = len(matrix)
+    condensed = np.lib.format.open_memmap(path, mode="w+", dtype=matrix.dtype, shape=(n * (n - 1) // 2,))
+    offset = 0
+    for i in range(n - 1):
+        condensed[offset:offset + n - i - 1] = matrix[i, i + 1:]
+        offset += n - i - 1
+    condensed.flush()
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Beta diversity matrices of the samples of an OTU table")
+    args.add_argument("-i", "--input", help="Input OTU table (text, or binary .npz)", required=True)
+    args.add_argument("-o", "--outdir", help="Output directory [default: %(default)s]", default=".")
+    args.add_argument("-s", "--separator", help="Separator of the OTU table [default: tab]", default="\t")
+    args.add_argument("-m", "--metrics", help="Comma separated metrics [default: %(default)s]", default=",".join(METRICS))
+    args.add_argument("-t", "--threads", help="Worker processes [default: %(default)s]", type=int, default=1)
+    args.add_argument("--tile", help="Samples per tile side [default: %(default)s]", type=int, default=256)
+    args.add_argument("--condensed", help="Also save the condensed matrix ({metric}.condensed.npy)", action="store_true")
+    args.add_argument("--keep-square", help="Keep the binary square matrix ({metric}.npy)", action="store_true")
+    opts = args.parse_args()
+
+    if not os.path.isfile(opts.input):
+        print("Error: OTU table file not found: " + opts.input)
+        sys.exit(1)
+
+    metrics = opts.metrics.split(",")
+    for metric in metrics:
+        if metric not in METRICS:
+            print("Error: unknown metric {}, available: {}".format(metric, ",".join(METRICS)))
+            sys.exit(1)
+
+    os.makedirs(opts.outdir, exist_ok=True)
+    instrument = Instrument("betaDiversity")
+    with instrument.phase("load") as phase:
+        table = loadTable(opts.input, opts.separator)
+        phase.records = table.nnz
+
+    workdir = opts.outdir if opts.keep_square else tempfile.mkdtemp(dir=opts.outdir, prefix="beta.")
+    with instrument.phase("compute") as phase:
+        matrices = betaDiversity(table, metrics, workdir, threads=opts.threads, tile=opts.tile)
+        # Pairs of samples
+        phase.records = len(metrics) * len(table.samples) * (len(table.samples) - 1) // 2
+    with instrument.phase("write") as phase:
+        for metric, path in matrices.items():
+            matrix = np.load(path, mmap_mode="r")
+            with open(os.path.join(opts.outdir, f"{metric}.txt"), "w") as f:
+                writeSquare(f, table.samples, matrix)
+            if opts.condensed:
+                saveCondensed(os.path.join(opts.outdir, f"{metric}.condensed.npy"), matrix)
+            del matrix
+            if not opts.keep_square:
+                os.unlink(path)
+        phase.records = len(metrics) * len(table.samples)
+    if not opts.keep_square:
+        os.rmdir(workdir)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Combine Kraken2 reports, or Bracken abundance tables, of many samples
+(as combine_kreports.py and combine_bracken_outputs.py of KrakenTools).
+
+Each file is parsed (by a pool of workers) into arrays of taxids and counts;
+the counts of all the samples are then placed in a sparse taxid x sample
+table in one step, and summed across samples at once. Writes:
+  - the combined report: for Kraken2, the union of the taxonomy trees with
+    the total and per-sample clade/taxon reads; for Bracken, the estimated
+    reads and fraction of each species per sample
+  - optionally (-m) a taxid x sample matrix of the clade (Bracken: estimated) reads
+Sample names are the file names up to the first dot, unless given with --names.
+With --kind, the files of the other type are skipped (with a warning): Bracken
+writes both an abundance table (-o) and a Kraken2 style report (-w).
+"""
+import os, sys
+import argparse
+from multiprocessing import Pool
+import numpy as np
+from sparseTable import SparseTable
+from instrument import Instrument
+
+BRACKEN_HEADER = "name\ttaxonomy_id\ttaxonomy_lvl"
+
+
+def integers(values):
+    return np.array(list(map(int, values)), dtype=np.int64)
+
+
+def parentIndex(depths):
+    """
+    Index of the parent of each line of a report from the indentation depths
+    (the last line before it one level up), -1 for the top level
+    """
+    parents = np.full(len(depths), -1, dtype=np.int64)
+    positions = np.arange(len(depths))
+    for depth in range(1, int(depths.max()) + 1 if len(depths) else 0):
+        above = positions[depths == depth - 1]
+        here = positions[depths == depth]
+        found = np.searchsorted(above, here) - 1
+        parents[here] = np.where(found >= 0, above[np.maximum(found, 0)], -1)
+    return parents
+
+
+def parseKreport(rows):
+    """
+    Parse the rows of a Kraken2 report (standard, or with minimizer data):
+    return taxids, clade reads, taxon reads, parent taxids (-1 for none), ranks and names
+    """
+    rows = [row for row in rows if len(row) >= 6]
+    names = [row[-1] for row in rows]
+    labels = [name.lstrip(" ") for name in names]
+    depths = np.array([len(name) - len(label) for name, label in zip(names, labels)], dtype=np.int64) // 2
+    taxids = integers(row[-2] for row in rows)
+    clade = integers(row[1] for row in rows)
+    taxon = integers(row[2] for row in rows)
+    parents = parentIndex(depths)
+    parent_taxids = np.where(parents >= 0, taxids[np.maximum(parents, 0)], -1)
+    # Unclassified is not under root
+    parent_taxids[taxids == 0] = -1
+    return taxids, clade, taxon, parent_taxids, [row[-3] for row in rows], labels
+
+
+def parseBracken(rows):
+    """
+    Parse the rows of a Bracken abundance table: return taxids, estimated reads, parents, ranks and names
+    """
+    rows = [row for row in rows[1:] if len(row) >= 7]
+    taxids = integers(row[1] for row in rows)
+    reads = integers(row[5] for row in rows)
+    return taxids, reads, reads, np.full(len(rows), -1, dtype=np.int64), [row[2] for row in rows], [row[0] for row in rows]
+
+
+def parseFile(path):
+    """
+    Return the type of the file ("kraken" or "bracken") and its arrays
+    """
+    with open(path, "r") as f:
+        rows = [line.split("\t") for line in f.read().splitlines() if line and not line.startswith("#")]
+    kind = "bracken" if rows and "\t".join(rows[0]).startswith(BRACKEN_HEADER) else "kraken"
+    return (kind,) + (parseBracken(rows) if kind == "bracken" else parseKreport(rows))
+
+
+def combine(paths, samples, threads=1, kind=None):
+    """
+    Parse the files, return the type, the nodes {taxid: (parent, rank, name)}
+    and the clade and taxon reads as taxid x sample SparseTables.
+    If kind is given, only the files of this type are combined
+    """
+    if threads > 1 and len(paths) > 1:
+        with Pool(min(threads, len(paths))) as pool:
+            parsed = pool.map(parseFile, paths, chunksize=max(1, len(paths) // (threads * 4)))
+    else:
+        parsed = [parseFile(path) for path in paths]
+    if kind is not None:
+        for path, result in zip(paths, parsed):
+            if result[0] != kind:
+                print(f"Warning: skipping {path}, not a {kind} file", file=sys.stderr)
+        samples = [sample for sample, result in zip(samples, parsed) if result[0] == kind]
+        parsed = [result for result in parsed if result[0] == kind]
+    if len(set(samples)) != len(samples):
+        raise ValueError("duplicate sample names, use --names")
+    kinds = set(result[0] for result in parsed)
+    if len(kinds) > 1:
+        raise ValueError("Both Kraken2 reports and Bracken tables given")
+    # Nodes from the first report listing each taxid
+    all_taxids = np.concatenate([result[1] for result in parsed]) if parsed else np.zeros(0, dtype=np.int64)
+    taxids, first = np.unique(all_taxids, return_index=True)
+    parents = np.concatenate([result[4] for result in parsed])[first] if parsed else np.zeros(0, dtype=np.int64)
+    ranks = [rank for result in parsed for rank in result[5]]
+    names = [name for result in parsed for name in result[6]]
+    nodes = {taxid: (parent if parent >= 0 else None, ranks[i], names[i])
+        for taxid, parent, i in zip(taxids.tolist(), parents.tolist(), first.tolist())}
+    cols = np.repeat(np.arange(len(parsed)), [len(result[1]) for result in parsed])
+    rows = np.searchsorted(taxids, all_taxids)
+    features = [str(taxid) for taxid in taxids.tolist()]
+    tables = []
+    for field in (2, 3):
+        data = np.concatenate([result[field] for result in parsed]) if parsed else np.zeros(0, dtype=np.int64)
+        keep = data != 0
+        tables.append(SparseTable._fromCoo(features, samples, rows[keep], cols[keep], data[keep], "taxid"))
+    return kinds.pop() if kinds else kind or "kraken", nodes, tables[0], tables[1]
+
+
+def denseRow(table, i):
+    row = np.zeros(len(table.samples), dtype=np.int64)
+    indices, values = table.row(i)
+    row[indices] = values
+    return row
+
+
+def treeOrder(nodes, totals):
+    """
+    Return (taxid, depth) in report order: unclassified, then depth first from
+    the roots, the children by decreasing total reads
+    """
+    children = {}
+    for taxid, (parent, rank, name) in nodes.items():
+        children.setdefault(parent, []).append(taxid)
+    order = []
+    roots = sorted(children.get(None, []), key=lambda taxid: (taxid != 0, -totals[taxid], taxid))
+    stack = [(taxid, 0) for taxid in reversed(roots)]
+    while stack:
+        taxid, depth = stack.pop()
+        order.append((taxid, depth))
+        for child in sorted(children.get(taxid, []), key=lambda child: (totals[child], -child)):
+            stack.append((child, depth + 1))
+    return order
+
+
+def writeKrakenReport(f, nodes, clade, taxon):
+    """
+    Combined report as combine_kreports.py: totals and per-sample clade/level reads
+    """
+    position = {int(feature): i for i, feature in enumerate(clade.features)}
+    clade_totals = clade.featureTotals().astype(np.int64)
+    taxon_totals = taxon.featureTotals().astype(np.int64)
+    totals = {taxid: clade_totals[i] for taxid, i in position.items()}
+    reads = sum(totals.get(taxid, 0) for taxid in (0, 1))
+    f.write(f"#Number of Samples: {len(clade.samples)}\n")
+    f.write(f"#Total Number of Reads: {reads}\n")
+    f.write("#perc\ttot_all\ttot_lvl\t" + "\t".join(f"{sample}_all\t{sample}_lvl" for sample in clade.samples) + "\tlvl_type\ttaxid\tname\n")
+    for taxid, depth in treeOrder(nodes, totals):
+        i = position[taxid]
+        parent, rank, name = nodes[taxid]
+        counts = np.column_stack([denseRow(clade, i), denseRow(taxon, i)]).ravel()
+        perc = 100 * clade_totals[i] / reads if reads > 0 else 0
+        f.write(f"{perc:0.2f}\t{clade_totals[i]}\t{taxon_totals[i]}\t" + "\t".join(map(str, counts.tolist())) +
+            f"\t{rank}\t{taxid}\t{'  ' * depth}{name}\n")
+
+
+def writeBrackenReport(f, nodes, reads):
+    """
+    Combined table as combine_bracken_outputs.py: estimated reads and fraction per sample
+    """
+    totals = reads.featureTotals()
+    sample_totals = reads.sampleTotals()
+    f.write(BRACKEN_HEADER + "\t" + "\t".join(f"{sample}_num\t{sample}_frac" for sample in reads.samples) + "\n")
+    for i in np.argsort(-totals, kind="stable").tolist():
+        taxid = int(reads.features[i])
+        parent, rank, name = nodes[taxid]
+        row = denseRow(reads, i)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fractions = np.where(sample_totals > 0, row / sample_totals, 0)
+        f.write(f"{name}\t{taxid}\t{rank}\t" + "\t".join(f"{count}\t{fraction:0.5f}" for count, fraction in zip(row.tolist(), fractions.tolist())) + "\n")
+
+
+def writeMatrix(f, nodes, table):
+    """
+    Taxid x sample matrix, with the rank and name of each taxon
+    """
+    f.write("taxid\trank\tname\t" + "\t".join(table.samples) + "\n")
+    for i, feature in enumerate(table.features):
+        parent, rank, name = nodes[int(feature)]
+        f.write(f"{feature}\t{rank}\t{name}\t" + "\t".join(map(str, denseRow(table, i).tolist())) + "\n")
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Combine the Kraken2 reports (or Bracken tables) of many samples")
+    args.add_argument("-i", "--input", help="Kraken2 reports, or Bracken abundance tables", nargs="+", required=True)
+    args.add_argument("-o", "--output", help="Combined report", required=True)
+    args.add_argument("-m", "--matrix", help="Taxid x sample matrix of the reads")
+    args.add_argument("-n", "--names", help="Comma separated sample names [default: file names up to the first dot]")
+    args.add_argument("-k", "--kind", help="Combine only the files of this type, skipping the others", choices=["kraken", "bracken"])
+    args.add_argument("-t", "--threads", help="Worker processes [default: %(default)s]", type=int, default=1)
+    opts = args.parse_args()
+
+    for path in opts.input:
+        if not os.path.exists(path):
+            print("Error: file not found: " + path)
+            sys.exit(1)
+    samples = opts.names.split(",") if opts.names else [os.path.basename(path).split(".")[0] for path in opts.input]
+    if len(samples) != len(opts.input):
+        print(f"Error: {len(samples)} names for {len(opts.input)} files")
+        sys.exit(1)
+
+    metrics = Instrument("combineReports")
+    try:
+        with metrics.phase("parse") as phase:
+            kind, nodes, clade, taxon = combine(opts.input, samples, opts.threads, opts.kind)
+            phase.records = len(opts.input)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    with metrics.phase("write") as phase:
+        with open(opts.output, "w") as f:
+            if kind == "bracken":
+                writeBrackenReport(f, nodes, clade)
+            else:
+                writeKrakenReport(f, nodes, clade, taxon)
+        if opts.matrix is not None:
+            with open(opts.matrix, "w") as f:
+                writeMatrix(f, nodes, clade)
+        phase.records = len(nodes)
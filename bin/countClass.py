@@ -4,6 +4,27 @@ a script counting the lines of input starting as "C" (classified) or "U" (unclas
 as produced by Kraken. Will print the total that can be relabelled.
 """
 import sys
+import re
+from collections import Counter
+from instrument import Instrument
+
+TAXID = re.compile(rb"^[CU]\t[^\t\n]*\t(?:[^\t\n]*\(taxid )?(\d+)", re.M)
+
+def countBlocks(path, taxids=None):
+    """
+    Count classified, unclassified and total lines reading large byte blocks
+    (no per-line objects). If taxids is a Counter, also count reads per taxid.
+    """
+    from seqReader import readBlocks
+    classified = unclassified = total = 0
+    for block in readBlocks(path, b"\n"):
+        # Each block starts at the beginning of a line
+        classified += block.count(b"\nC") + (block[:1] == b"C")
+        unclassified += block.count(b"\nU") + (block[:1] == b"U")
+        total += block.count(b"\n") + (not block.endswith(b"\n"))
+        if taxids is not None:
+            taxids.update(TAXID.findall(block))
+    return classified, unclassified, total
 
 if __name__ == "__main__":
     import argparse
@@ -14,27 +35,39 @@ if __name__ == "__main__":
     parser.add_argument('-u', '--unclassified-string', help='String to use to indicate unclassified reads [default: %(default)s', default="Unclassified")
     parser.add_argument('--check', help='Check valid Kraken2 output', action='store_true')
     parser.add_argument('--total', help='Add total', action='store_true')
-    
+    parser.add_argument('-b', '--block', help='Count reading large binary blocks (faster on large inputs)', action='store_true')
+    parser.add_argument('-t', '--taxid-counts', help='Save the number of reads per taxid to this file (implies --block)')
+
     args = parser.parse_args()
 
     
-    inputfile = sys.stdin if args.input is None else open(args.input, 'r')
     outputfile = sys.stdout if args.output is None else open(args.output, 'w')
-    
 
     counter = {
         'C': 0,
         'U': 0
     }
     tot = 0
-    # Read from stdin
-    for line in inputfile:
-        if args.check: 
-            tot += 1
-        if line[0] in counter:
-            counter[line[0]] += 1
+    metrics = Instrument('countClass')
+    with metrics.phase('count') as phase:
+        if args.block or args.taxid_counts is not None:
+            taxids = Counter() if args.taxid_counts is not None else None
+            counter['C'], counter['U'], tot = countBlocks('-' if args.input is None else args.input, taxids)
+            if taxids is not None:
+                with open(args.taxid_counts, 'w') as f:
+                    for taxid in sorted(taxids, key=int):
+                        print("{}\t{}".format(taxid.decode(), taxids[taxid]), file=f)
         else:
-            counter[line[0]] = 1
+            inputfile = sys.stdin if args.input is None else open(args.input, 'r')
+            # Read from stdin
+            for line in inputfile:
+                if args.check: 
+                    tot += 1
+                if line[0] in counter:
+                    counter[line[0]] += 1
+                else:
+                    counter[line[0]] = 1
+        phase.records = counter['C'] + counter['U']
     
     print("{}:{}".format(args.classified_string,   counter['C']), file=outputfile)
     print("{}:{}".format(args.unclassified_string, counter['U']), file=outputfile)
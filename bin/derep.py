@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Dereplicate the reads of a sample (map step of the dereplication).
+
+Identical sequences (case insensitive) are counted and written once, as
+>{sha1 of the sequence};size={count}
+sorted by hash, so that derepMerge.py can merge the partial files of all
+the samples streaming them in parallel, with bounded memory.
+Input records already annotated with ;size= are counted with their size.
+"""
+import os, sys
+import argparse
+import hashlib
+import re
+import tempfile
+from collections import Counter
+from seqReader import readFasta
+from instrument import Instrument
+
+SIZE = re.compile(rb";size=(\d+)")
+
+
+def readSize(name):
+    """
+    Abundance of a record from its ;size= annotation (1 if missing)
+    """
+    match = SIZE.search(name)
+    return int(match.group(1)) if match else 1
+
+
+def sequenceHash(sequence):
+    return hashlib.sha1(sequence).hexdigest().encode()
+
+
+def countSequences(paths):
+    """
+    Count the (uppercase) sequences of FASTA files, return a Counter of bytes
+    """
+    counts = Counter()
+    for path in paths:
+        for name, comment, sequence in readFasta(path, raw=True):
+            counts[sequence.upper()] += readSize(name) if b";size=" in name else 1
+    return counts
+
+
+def writeRecords(f, records):
+    """
+    Write (hash, sequence, size) records as FASTA
+    """
+    f.write(b"".join(b">%s;size=%d\n%s\n" % (key, size, sequence) for key, sequence, size in records))
+
+
+def readRecords(path, blocksize=1024 * 1024):
+    """
+    Yield (hash, sequence, size) from a partial dereplicated file
+    """
+    for name, comment, sequence in readFasta(path, raw=True, blocksize=blocksize):
+        key, _, size = name.partition(b";size=")
+        yield key, sequence, int(size.rstrip(b";"))
+
+
+def writePartial(path, counts):
+    """
+    Write the counts sorted by hash, as a temporary file renamed at the end
+    """
+    records = sorted((sequenceHash(sequence), sequence, size) for sequence, size in counts.items())
+    tmp = tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp.", delete=False)
+    try:
+        with tmp:
+            for start in range(0, len(records), 10000):
+                writeRecords(tmp, records[start:start + 10000])
+        os.replace(tmp.name, path)
+    finally:
+        if os.path.exists(tmp.name):
+            os.unlink(tmp.name)
+    return len(records)
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Dereplicate the reads of a sample, writing the unique sequences sorted by hash")
+    args.add_argument("-i", "--input", help="Input FASTA files (plain or gzipped)", nargs="+", required=True)
+    args.add_argument("-o", "--output", help="Output FASTA file of the unique sequences", required=True)
+    args.add_argument("--verbose", help="Verbose output", action="store_true")
+    args = args.parse_args()
+
+    for path in args.input:
+        if not os.path.exists(path):
+            print("ERROR: Input file does not exist: {}".format(path))
+            sys.exit(1)
+
+    metrics = Instrument("derep")
+    with metrics.phase("count") as phase:
+        counts = countSequences(args.input)
+        phase.records = sum(counts.values())
+    with metrics.phase("write") as phase:
+        phase.records = writePartial(args.output, counts)
+    if args.verbose:
+        print(f"{sum(counts.values())} sequences, {len(counts)} unique", file=sys.stderr)
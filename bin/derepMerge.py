@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Merge the partial dereplicated files of derep.py (reduce step).
+
+The partial files are sorted by sequence hash: they are merged streaming
+all of them at once (k-way merge), summing the sizes of the same sequence.
+With more files than --max-open, groups of files are first merged into
+temporary partial files. The unique sequences are finally sorted by
+decreasing size (as expected by usearch -unoise3), spilling sorted runs to
+temporary files when more than --max-records are held in memory.
+--min-size is applied to the total sizes, so only in the final merge.
+"""
+import os, sys
+import argparse
+import heapq
+import shutil
+import tempfile
+from itertools import groupby, islice
+from derep import readRecords, writeRecords
+from instrument import Instrument
+
+
+def mergePartials(paths, blocksize):
+    """
+    Yield (hash, sequence, size) merging sorted partial files, one record per sequence
+    """
+    streams = [readRecords(path, blocksize) for path in paths]
+    for (key, sequence), records in groupby(heapq.merge(*streams), key=lambda record: record[:2]):
+        yield key, sequence, sum(record[2] for record in records)
+
+
+def reduceFiles(paths, tmpdir, max_open, blocksize):
+    """
+    Merge groups of at most max_open files into temporary partial files, until max_open are left
+    """
+    level = 0
+    while len(paths) > max_open:
+        merged = []
+        for start in range(0, len(paths), max_open):
+            path = os.path.join(tmpdir, f"level{level}.{start // max_open}.fa")
+            with open(path, "wb") as f:
+                records = mergePartials(paths[start:start + max_open], blocksize)
+                while True:
+                    batch = list(islice(records, 10000))
+                    if not batch:
+                        break
+                    writeRecords(f, batch)
+            merged.append(path)
+        paths = merged
+        level += 1
+    return paths
+
+
+def sortBySize(records, tmpdir, max_records):
+    """
+    Yield the records by decreasing size (then hash), with sorted runs spilled to disk
+    """
+    runs = []
+    buffer = []
+
+    def spill():
+        buffer.sort(key=lambda record: (-record[2], record[0]))
+        path = os.path.join(tmpdir, f"run{len(runs)}.fa")
+        with open(path, "wb") as f:
+            writeRecords(f, buffer)
+        runs.append(path)
+        buffer.clear()
+
+    for record in records:
+        buffer.append(record)
+        if len(buffer) >= max_records:
+            spill()
+    if not runs:
+        buffer.sort(key=lambda record: (-record[2], record[0]))
+        yield from buffer
+        return
+    if buffer:
+        spill()
+    yield from heapq.merge(*[readRecords(path) for path in runs], key=lambda record: (-record[2], record[0]))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Merge the partial dereplicated files of derep.py, by sequence hash")
+    args.add_argument("-i", "--input", help="Partial dereplicated files (derep.py output)", nargs="+", required=True)
+    args.add_argument("-o", "--output", help="Output FASTA file [default: %(default)s]", default="uniques.fasta")
+    args.add_argument("-m", "--min-size", help="Discard sequences with a total size below this, in the final merge only [default: %(default)s]", type=int, default=1)
+    args.add_argument("-l", "--label", help="Prefix of the sequence names [default: %(default)s]", default="Uniq")
+    args.add_argument("--partial", help="Write a partial file sorted by hash (for a further merge) rather than sorted by size", action="store_true")
+    args.add_argument("--max-open", help="Maximum number of files merged at once [default: %(default)s]", type=int, default=256)
+    args.add_argument("--max-records", help="Maximum number of records sorted in memory [default: %(default)s]", type=int, default=1000000)
+    args.add_argument("--buffer-mb", help="Total read buffer of the merged files in MB [default: %(default)s]", type=int, default=256)
+    args.add_argument("-t", "--tmpdir", help="Directory for the temporary files [default: output directory]")
+    args.add_argument("--verbose", help="Verbose output", action="store_true")
+    args = args.parse_args()
+
+    for path in args.input:
+        if not os.path.exists(path):
+            print("ERROR: Input file does not exist: {}".format(path))
+            sys.exit(1)
+    if args.partial and args.min_size > 1:
+        # The size in a partial file is the size in its shard only: a sequence
+        # below the threshold there can reach it in the final merge
+        print("ERROR: --min-size applies to the final merge, not to --partial")
+        sys.exit(1)
+    if args.max_open < 2:
+        print("ERROR: --max-open must be at least 2")
+        sys.exit(1)
+
+    metrics = Instrument("derepMerge")
+    blocksize = max(64 * 1024, args.buffer_mb * 1024 * 1024 // min(len(args.input), args.max_open))
+    tmpdir = tempfile.mkdtemp(prefix=".derep.", dir=args.tmpdir or os.path.dirname(os.path.abspath(args.output)))
+    try:
+        with metrics.phase("merge") as phase:
+            paths = reduceFiles(args.input, tmpdir, args.max_open, blocksize)
+            records = (record for record in mergePartials(paths, blocksize) if record[2] >= args.min_size)
+            if not args.partial:
+                records = sortBySize(records, tmpdir, args.max_records)
+            uniques, total = 0, 0
+            with open(args.output, "wb") as f:
+                while True:
+                    batch = list(islice(records, 10000))
+                    if not batch:
+                        break
+                    if args.partial:
+                        writeRecords(f, batch)
+                    else:
+                        f.write(b"".join(b">%s%d;size=%d\n%s\n" % (args.label.encode(), uniques + i + 1, size, sequence)
+                            for i, (key, sequence, size) in enumerate(batch)))
+                    uniques += len(batch)
+                    total += sum(record[2] for record in batch)
+            phase.records = uniques
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    if args.verbose:
+        print(f"{len(args.input)} files, {uniques} unique sequences, {total} reads", file=sys.stderr)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Sparse distance matrix of the ASVs, as a replacement for
+"usearch -calc_distmx -tabbedout" (input of usearch -otutab_octave -distmxin).
+
+Only the pairs within --maxdist are written, one per line (label1, label2,
+distance), with the distance of each ASV to itself. The distance is the
+edit distance over the length of the longest sequence.
+
+Pairs are skipped without an alignment when their lengths differ by more
+than maxdist, or when the distance estimated from MinHash sketches of their
+k-mers (Mash distance) is above --termdist (as the -termdist heuristic of
+usearch). The other pairs are aligned in blocks of rows by a pool of workers.
+
+The distance is not the usearch one (1 - identity, over the columns of the
+alignment): for the same edits an alignment has at least as many columns as
+the longest sequence, so the distance here is equal or slightly higher and a
+few pairs close to --maxdist can be missing. --termdist is a Mash distance of
+the k-mer sketches, not an alignment distance as the usearch -termdist: the
+pairs selected by the same thresholds differ from usearch -calc_distmx.
+
+At most --max-candidates pairs are aligned for each sequence (those sharing
+the most sketch values), to bound the run time on large sets of near
+identical ASVs, where most sequences share every bucket.
+
+The sketches are not compared for all the pairs: the sequences are bucketed
+by bands of rows of their sketch (locality sensitive hashing), and only the
+pairs sharing a bucket are compared. With one row per band (the default) no
+pair within --termdist is lost; with fewer, larger bands fewer pairs are
+compared, but some pairs just within --termdist may be skipped.
+"""
+import os, sys
+import argparse
+from multiprocessing import Pool
+import numpy as np
+from seqReader import readFasta
+from instrument import Instrument
+
+PRIME = (1 << 31) - 1
+# Maximum bucket members gathered at once in a block of rows
+MAX_MEMBERS = 4 * 1024 * 1024
+CODES = np.full(256, 255, dtype=np.uint8)
+for i, base in enumerate(b"ACGT"):
+    CODES[base] = i
+    CODES[ord(chr(base).lower())] = i
+
+# Set in each worker by initWorker
+_data = None
+
+
+def initWorker(labels, sequences, lengths, sketches, index, maxdist, min_matches, max_candidates):
+    global _data
+    _data = (labels, sequences, lengths, sketches, index, maxdist, min_matches, max_candidates)
+
+
+def kmerCodes(sequence, k):
+    """
+    2-bits encoded k-mers of a sequence, skipping the k-mers with other bases than ACGT
+    """
+    codes = CODES[np.frombuffer(sequence, dtype=np.uint8)].astype(np.uint64)
+    if len(codes) < k:
+        return np.zeros(0, dtype=np.uint64)
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+    valid = (windows != 255).all(axis=1)
+    weights = np.uint64(4) ** np.arange(k - 1, -1, -1, dtype=np.uint64)
+    return np.unique((windows[valid] * weights).sum(axis=1, dtype=np.uint64))
+
+
+def minHashSketches(sequences, k, size, seed=11):
+    """
+    MinHash sketch (size hash functions) of the k-mers of each sequence.
+    Sequences without k-mers get distinct values, never matching.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, PRIME, size, dtype=np.uint64)[:, None]
+    b = rng.integers(0, PRIME, size, dtype=np.uint64)[:, None]
+    sketches = np.empty((len(sequences), size), dtype=np.uint64)
+    for i, sequence in enumerate(sequences):
+        # k-mers are below 2^32 for k <= 16: a * kmer + b does not overflow
+        kmers = kmerCodes(sequence, k) % np.uint64(PRIME)
+        if len(kmers) == 0:
+            sketches[i] = PRIME + 1 + i
+            continue
+        sketches[i] = ((a * kmers[None, :] + b) % np.uint64(PRIME)).min(axis=1)
+    return sketches
+
+
+def minMatches(k, size, termdist):
+    """
+    Minimum number of matching sketch values for a Mash distance within termdist
+    """
+    containment = np.exp(-k * termdist)
+    jaccard = containment / (2 - containment)
+    return int(np.floor(jaccard * size))
+
+
+def bandIndex(sketches, bands):
+    """
+    Bucket the sequences by identical bands of rows of their sketches: for each
+    band, the bucket of each sequence, the sequences sorted by bucket and the
+    start of each bucket in this order
+    """
+    rows = sketches.shape[1] // bands
+    index = []
+    for band in range(bands):
+        values = np.ascontiguousarray(sketches[:, band * rows:(band + 1) * rows])
+        keys = values.view(np.dtype((np.void, values.dtype.itemsize * rows))).ravel()
+        unique, buckets = np.unique(keys, return_inverse=True)
+        buckets = buckets.ravel()
+        order = np.argsort(buckets, kind="stable")
+        starts = np.searchsorted(buckets[order], np.arange(len(unique) + 1))
+        index.append((buckets, order, starts))
+    return index
+
+
+def bandCandidates(index, start, end):
+    """
+    Pairs (i, j) of the rows i in [start, end) and j < i sharing at least one
+    bucket, sorted by i then j, with the number of buckets they share
+    """
+    rows = np.arange(start, end)
+    n = len(index[0][0]) if index else 0
+    codes = []
+    for buckets, order, starts in index:
+        first = starts[buckets[rows]]
+        sizes = starts[buckets[rows] + 1] - first
+        # Members of the bucket of each row, concatenated
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        members = order[np.repeat(first, sizes) + offsets]
+        owners = np.repeat(rows, sizes)
+        before = members < owners
+        codes.append(owners[before] * n + members[before])
+    codes, shared = np.unique(np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64), return_counts=True)
+    return codes // max(n, 1), codes % max(n, 1), shared
+
+
+def patternMasks(a):
+    """
+    Bit mask of the positions of each byte value in a (for editDistance)
+    """
+    peq = [0] * 256
+    for i, base in enumerate(a):
+        peq[base] |= 1 << i
+    return peq
+
+
+def editDistance(a, b, limit, peq=None):
+    """
+    Levenshtein distance of two byte strings (Myers' bit-parallel algorithm),
+    or None as soon as it must be above limit. peq: patternMasks(a), when a
+    is aligned to many sequences
+    """
+    m = len(a)
+    if m == 0:
+        return len(b) if len(b) <= limit else None
+    if peq is None:
+        peq = patternMasks(a)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    remaining = len(b)
+    for base in b:
+        eq = peq[base]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        remaining -= 1
+        # The score decreases at most by one per column
+        if score - remaining > limit:
+            return None
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+    # b empty: no column checked
+    return score if score <= limit else None
+
+
+def rowPairs(start, end):
+    """
+    Candidate pairs (i, j, longest length) of the rows [start, end) passing the
+    length and sketch filters, at most max_candidates per row
+    """
+    _, _, lengths, sketches, index, maxdist, min_matches, max_candidates = _data
+    first, second, shared = bandCandidates(index, start, end)
+    longest = np.maximum(lengths[first], lengths[second])
+    keep = np.abs(lengths[first] - lengths[second]) <= maxdist * longest
+    first, second, shared, longest = first[keep], second[keep], shared[keep], longest[keep]
+    if len(index) == sketches.shape[1]:
+        # One row per band: the shared buckets are the matching sketch values
+        matches = shared
+    else:
+        matches = (sketches[first] == sketches[second]).sum(axis=1)
+    keep = matches >= min_matches
+    first, second, matches, longest = first[keep], second[keep], matches[keep], longest[keep]
+    if max_candidates and len(first):
+        # Keep the pairs sharing the most sketch values of each row, then restore the row order
+        order = np.lexsort((second, -matches, first))
+        rank = np.arange(len(order)) - np.searchsorted(first[order], first[order])
+        keep = np.sort(order[rank < max_candidates])
+        first, second, longest = first[keep], second[keep], longest[keep]
+    return zip(first.tolist(), second.tolist(), longest.tolist())
+
+
+def computeRows(rows):
+    """
+    Distances of rows [start, end) to the previous sequences, as text lines
+    """
+    labels, sequences, _, _, index, maxdist, _, _ = _data
+    start, end = rows
+    # Bucket members gathered for each row: the rows are split so that at most
+    # MAX_MEMBERS are held at once (near identical sequences share every bucket)
+    members = sum(starts[buckets[start:end] + 1] - starts[buckets[start:end]] for buckets, _, starts in index)
+    lines = []
+    piece = start
+    while piece < end:
+        stop = piece + max(1, int(np.searchsorted(np.cumsum(members[piece - start:]), MAX_MEMBERS, side="right")))
+        pairs = rowPairs(piece, stop)
+        pair = next(pairs, None)
+        for i in range(piece, stop):
+            lines.append(f"{labels[i]}\t{labels[i]}\t0\n")
+            peq = patternMasks(sequences[i]) if pair is not None and pair[0] == i else None
+            while pair is not None and pair[0] == i:
+                _, j, length = pair
+                distance = editDistance(sequences[i], sequences[j], int(maxdist * length), peq)
+                if distance is not None:
+                    lines.append(f"{labels[i]}\t{labels[j]}\t{distance / length:.4f}\n")
+                pair = next(pairs, None)
+        piece = stop
+    return "".join(lines)
+
+
+def distanceMatrix(f, labels, sequences, maxdist=0.2, termdist=0.3, k=8, size=128, threads=1, block=64, bands=None, max_candidates=0):
+    """
+    Write the sparse distance matrix to a file handle, return the number of pairs written.
+    The sketches are bucketed in bands (size by default, one row per band), and
+    at most max_candidates pairs are aligned per sequence (0: no limit)
+    """
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    sketches = minHashSketches(sequences, k, size)
+    index = bandIndex(sketches, size if bands is None else bands)
+    init = (labels, sequences, lengths, sketches, index, maxdist, max(1, minMatches(k, size, termdist)), max_candidates)
+    tasks = [(start, min(start + block, len(sequences))) for start in range(0, len(sequences), block)]
+    pairs = 0
+    if threads > 1 and len(tasks) > 1:
+        # imap keeps the rows in order
+        with Pool(min(threads, len(tasks)), initializer=initWorker, initargs=init) as pool:
+            for lines in pool.imap(computeRows, tasks):
+                f.write(lines)
+                pairs += lines.count("\n")
+    else:
+        initWorker(*init)
+        for task in tasks:
+            lines = computeRows(task)
+            f.write(lines)
+            pairs += lines.count("\n")
+    return pairs
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Sparse distance matrix of the ASVs (as usearch -calc_distmx -tabbedout)")
+    args.add_argument("-i", "--input", help="Input FASTA file (ASVs)", required=True)
+    args.add_argument("-o", "--output", help="Output distance matrix [default: %(default)s]", default="distmx.txt")
+    args.add_argument("--maxdist", help="Maximum distance written [default: %(default)s]", type=float, default=0.2)
+    args.add_argument("--termdist", help="Skip the pairs with an estimated distance above this [default: %(default)s]", type=float, default=0.3)
+    args.add_argument("-k", "--kmer", help="K-mer size of the sketches (at most 16) [default: %(default)s]", type=int, default=8)
+    args.add_argument("--sketch-size", help="Hash functions of the sketches [default: %(default)s]", type=int, default=128)
+    args.add_argument("--bands", help="LSH bands of the sketches, dividing --sketch-size (fewer is faster, but can miss pairs) [default: --sketch-size]", type=int)
+    args.add_argument("--max-candidates", help="Maximum pairs aligned per sequence, 0 for no limit [default: %(default)s]", type=int, default=500)
+    args.add_argument("-t", "--threads", help="Worker processes [default: %(default)s]", type=int, default=1)
+    args.add_argument("--verbose", help="Verbose output", action="store_true")
+    args = args.parse_args()
+
+    if not os.path.exists(args.input):
+        print("ERROR: Input file does not exist: {}".format(args.input))
+        sys.exit(1)
+    if not 1 <= args.kmer <= 16:
+        print("ERROR: --kmer must be between 1 and 16")
+        sys.exit(1)
+    if args.bands is not None and (args.bands < 1 or args.sketch_size % args.bands != 0):
+        print("ERROR: --bands must divide --sketch-size")
+        sys.exit(1)
+
+    metrics = Instrument("distanceMatrix")
+    with metrics.phase("load") as phase:
+        labels, sequences = [], []
+        for name, comment, sequence in readFasta(args.input, raw=True):
+            labels.append(name.decode())
+            sequences.append(sequence.upper())
+        phase.records = len(sequences)
+
+    with metrics.phase("distances") as phase:
+        with open(args.output, "w") as f:
+            pairs = distanceMatrix(f, labels, sequences, args.maxdist, args.termdist, args.kmer, args.sketch_size, args.threads, bands=args.bands, max_candidates=args.max_candidates)
+        phase.records = pairs
+    if args.verbose:
+        print(f"{len(sequences)} sequences, {pairs} pairs within {args.maxdist}", file=sys.stderr)
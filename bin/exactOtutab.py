@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+OTU table of a sample, counting first the reads identical to an ASV.
+
+The ASVs (and their reverse complements) are indexed by sequence, the reads
+are streamed and the exact hits counted directly. Only the unmatched reads
+are written for usearch -otutab (the -x command, with {input} and {output}
+placeholders), and its counts are added to the exact ones. The table is
+written in the usearch -otutab format, with the sample name in the header:
+#OTU    {sample}
+
+The exact hits are counted on both strands, while usearch -otutab searches
+only the plus strand by default (-strand plus): reads that are the reverse
+complement of an ASV are counted here, and would be left unassigned by
+usearch alone unless it is run with -strand both.
+"""
+import os, sys
+import argparse
+import subprocess
+import shutil
+import tempfile
+from seqReader import openFile, readFasta, readFastq
+from instrument import Instrument
+
+COMPLEMENT = bytes.maketrans(b"ACGTUNacgtun", b"TGCAANtgcaan")
+
+
+def reverseComplement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def indexAsvs(path):
+    """
+    Return the ASV names and {sequence: index} of the ASVs and their reverse complements
+    """
+    names = []
+    index = {}
+    reverse = {}
+    for name, comment, sequence in readFasta(path, raw=True):
+        sequence = sequence.upper()
+        if sequence not in index:
+            index[sequence] = len(names)
+        reverse.setdefault(reverseComplement(sequence), len(names))
+        names.append(name.decode())
+    # The forward strand of an ASV has the precedence
+    for sequence, i in reverse.items():
+        index.setdefault(sequence, i)
+    return names, index
+
+
+def isFastq(path):
+    with openFile(path) as f:
+        return f.read(1) == b"@"
+
+
+def countExact(path, index, counts, unmatched, batch=10000):
+    """
+    Add the exact hits to counts, write the other reads to the unmatched file handle.
+    Return the number of reads and of unmatched reads.
+    """
+    reads, missed = 0, 0
+    pending = []
+    fastq = isFastq(path)
+    records = readFastq(path, raw=True) if fastq else readFasta(path, raw=True)
+    for record in records:
+        reads += 1
+        hit = index.get(record[2].upper())
+        if hit is not None:
+            counts[hit] += 1
+            continue
+        missed += 1
+        if fastq:
+            pending.append(b"@%s\n%s\n+\n%s\n" % (record[0], record[2], record[3]))
+        else:
+            pending.append(b">%s\n%s\n" % (record[0], record[2]))
+        if len(pending) >= batch:
+            unmatched.write(b"".join(pending))
+            pending.clear()
+    unmatched.write(b"".join(pending))
+    return reads, missed
+
+
+def readOtutab(path):
+    """
+    Return {OTU: count} from a single sample usearch -otutab table
+    """
+    counts = {}
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            name, count = line.rstrip("\n").split("\t")[:2]
+            counts[name] = counts.get(name, 0) + int(float(count))
+    return counts
+
+
+def writeOtutab(f, sample, names, counts):
+    f.write(f"#OTU\t{sample}\n")
+    for name, count in zip(names, counts):
+        if count > 0:
+            f.write(f"{name}\t{count}\n")
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="OTU table of a sample, counting the exact ASV hits before usearch -otutab")
+    args.add_argument("-i", "--input", help="Input reads (FASTQ or FASTA, plain or gzipped)", required=True)
+    args.add_argument("-a", "--asv", help="ASV FASTA file", required=True)
+    args.add_argument("-s", "--sample", help="Sample name", required=True)
+    args.add_argument("-o", "--output", help="Output table", required=True)
+    args.add_argument("-x", "--otutab", help="Command counting the unmatched reads, with {input} reads and {output} table placeholders")
+    args.add_argument("-u", "--unmatched", help="Keep the unmatched reads in this file")
+    args.add_argument("--verbose", help="Verbose output", action="store_true")
+    opts = args.parse_args()
+
+    for file in [opts.input, opts.asv]:
+        if not os.path.exists(file):
+            print("Error: file not found: " + file)
+            sys.exit(1)
+
+    metrics = Instrument("exactOtutab")
+    names, index = indexAsvs(opts.asv)
+    counts = [0] * len(names)
+    workdir = tempfile.mkdtemp(prefix=".otutab.", dir=".")
+    suffix = ".fastq" if isFastq(opts.input) else ".fasta"
+    unmatched = opts.unmatched if opts.unmatched is not None else os.path.join(workdir, "unmatched" + suffix)
+    try:
+        with metrics.phase("exact") as phase:
+            with open(unmatched, "wb") as f:
+                reads, missed = countExact(opts.input, index, counts, f)
+            phase.records = reads
+
+        if opts.otutab is not None and missed > 0:
+            with metrics.phase("otutab") as phase:
+                table = os.path.join(workdir, "otutab.txt")
+                status = subprocess.call(opts.otutab.format(input=unmatched, output=table), shell=True)
+                if status != 0:
+                    print(f"Error: otutab command failed with exit status {status}")
+                    sys.exit(1)
+                positions = {name: i for i, name in enumerate(names)}
+                for name, count in readOtutab(table).items():
+                    if name not in positions:
+                        print(f"Error: OTU not found in {opts.asv}: {name}")
+                        sys.exit(1)
+                    counts[positions[name]] += count
+                phase.records = missed
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(opts.output, "w") as f:
+        writeOtutab(f, opts.sample, names, counts)
+    if opts.verbose:
+        print(f"{opts.sample}: {reads} reads, {reads - missed} exact hits, {missed} unmatched", file=sys.stderr)
@@ -25,42 +25,42 @@ import shutil
 import os
 import sys
 import argparse
+import json
+import time
 from random import randint
+import numpy as np
+from sparseTable import SparseTableWriter, formatRow, loadNpz
+from seqReader import FastaIndex, isGzipped, readFasta
+from instrument import Instrument
 __VERSION__ = "0.1"
 
 
 class Features:
+    """
+    Representative sequences. Plain FASTA files are accessed through a .fai
+    index (sequences are fetched on demand), otherwise they are loaded in memory.
+    """
     def __init__(self, fasta):
         self.fasta_file = fasta
         self.features = []
         self.sequences = {}
-        self.comments = {}
         self.readFeatures()
 
     def readFeatures(self):
-        for name, comm, seq in self._read_fasta(self.fasta_file):
+        if not isGzipped(self.fasta_file):
+            try:
+                self.sequences = FastaIndex(self.fasta_file)
+                self.features = self.sequences.names
+                return
+            except ValueError:
+                # Irregular line lengths: cannot be indexed
+                pass
+        for name, comm, seq in readFasta(self.fasta_file):
             self.sequences[name] = seq
-            self.comments[name] = comm
             self.features.append(name)
 
-    def _read_fasta(self, path):
-        if path.endswith(".gz"):
-            import gzip
-        
-        seqName = None
-        seqComment = None
-        with (gzip.open if path.endswith('.gz') else open)(path, 'rt') as fasta:
-            for line in fasta:
-                if line.startswith('>'):
-                    if seqName is not None:
-                        yield seqName, seqComment, sequence
-                    seqName = line[1:].split()[0]
-                    seqComment = line[1:].split()[1:] if len(line[1:].split()) > 1 else ""
-                    sequence = ""
-                    
-                else:
-                    sequence += line.strip()
-        yield seqName, seqComment, sequence
+    def __contains__(self, name):
+        return name in self.sequences
 
 class Metadata:
     def __init__(self, metadata_file, separator, header_char, id_field, quote_char="\""):
@@ -94,31 +94,28 @@ class Metadata:
                     continue
                 fields = line.split(self.separator)
                 id = fields[self.id_field_index]
-                self.metadata[id] = fields
+                self.metadata[id] = tuple(fields)
                 self.samples.append(id)
     
-    def csv(self):
-        # 
+    def write(self, f):
+        """
+        Write the MicrobiomeAnalyst metadata CSV to a file handle
+        """
         other_fields = [f for f in self.fields if f != self.id_field]
-        # If a field contains ",", surround it by quotes
-
-                
-        csv = "#NAME," + ",".join(other_fields) + "\n"
-        for sample in self.metadata:
-            fields = self.metadata[sample]
-            fields = [sample] + fields[self.id_field_index + 1:]
-            for i in range(len(fields)):
-                if fields[i].find(",") != -1: 
-                    fields[i] = f'{self.quote}{fields[i]}{self.quote}'
-
-            csv += ",".join(fields) + "\n"
-
-        return csv
+        f.write("#NAME," + ",".join(other_fields) + "\n")
+        for sample, fields in self.metadata.items():
+            fields = [sample, *fields[self.id_field_index + 1:]]
+            # If a field contains ",", surround it by quotes
+            f.write(",".join(quoteField(field, self.quote) for field in fields) + "\n")
 
 class FeatureTable:
-    def __init__(self, feature_table_file, separator, header_char, id_field, quote_char="\""):
+    """
+    Feature table held as a SparseTable (CSR counts), loaded from text or .npz
+    or given as table
+    """
+    def __init__(self, feature_table_file, separator, header_char, id_field, quote_char="\"", table=None):
         self.feature_table_file = feature_table_file
-        self.feature_table = {}
+        self.table = table
         self.separator = separator
         self.header_char = header_char
         self.id_field = id_field
@@ -126,10 +123,19 @@ class FeatureTable:
         self.samples = []
         self.features = []
         self.quote = quote_char
-        self.load()
+        if table is not None:
+            # Table already in memory
+            self.samples = table.samples
+            self.features = table.features
+        else:
+            self.load()
     
     def load(self):
-       
+        if self.feature_table_file.endswith(".npz"):
+            self.loadBinary()
+            return
+
+        writer = None
         with open(self.feature_table_file, "r") as f:
             for line in f:
                 line = line.strip()
@@ -142,30 +148,40 @@ class FeatureTable:
                         # Determine the column of ID fields
                         self.id_field_index = fields.index(self.id_field)
                         self.samples = fields[1:]
+                        writer = SparseTableWriter(self.samples, self.header_char + self.id_field)
                     continue
                 if line == "":
                     continue
+                if writer is None:
+                    raise Exception(f"Header not found in feature table file: {self.feature_table_file}")
                 fields = line.split(self.separator)
-                id = fields[self.id_field_index]
-                
-                self.feature_table[id] = fields[1:]
-                self.features.append(id)
-    
-    def csv(self):
-        # 
-        other_fields = [f for f in self.samples if f != self.id_field]
-        # If a field contains ",", surround it by quotes
-        csv = "#NAME," + ",".join(other_fields) + "\n"
-        for sample in self.feature_table:
-            fields = self.feature_table[sample]
-            fields = [sample] + fields
-            for i in range(len(fields)):
-                if fields[i].find(",") != -1: 
-                    fields[i] = f'{self.quote}{fields[i]}{self.quote}'
+                writer.addRow(fields[self.id_field_index], fields[1:])
+        if writer is None:
+            raise Exception(f"Header not found in feature table file: {self.feature_table_file}")
+        self.table = writer.table()
+        self.features = self.table.features
+
+    def loadBinary(self):
+        table = loadNpz(self.feature_table_file)
+        id_field = table.index_name[len(self.header_char):] if table.index_name.startswith(self.header_char) else table.index_name
+        if id_field != self.id_field:
+            raise Exception(f"ID field not found in feature table file: {self.id_field} not in {[id_field] + table.samples}")
+        self.table = table
+        self.samples = table.samples
+        self.features = table.features
 
-            csv += ",".join(fields) + "\n"
+    def write(self, f):
+        """
+        Write the MicrobiomeAnalyst feature table CSV to a file handle, one feature at a time
+        """
+        other_fields = [f for f in self.samples if f != self.id_field]
+        f.write("#NAME," + ",".join(other_fields) + "\n")
+        for i, feature in enumerate(self.features):
+            cells = formatRow(*self.table.row(i), len(self.samples))
+            f.write(quoteField(feature, self.quote) + "," + ",".join(cells) + "\n")
 
-        return csv
+def quoteField(field, quote="\""):
+    return f'{quote}{field}{quote}' if field.find(",") != -1 else field
 
 def MakeMetadata(FeatureTable):
     metadata = Metadata(None, "\t", "#", "SampleID")
@@ -203,31 +219,125 @@ def loadDecipherTaxonomy(path, Sequences):
             c += 1
     return taxonomy
 
-def taxonomyToCsv(taxonomy):
-    ranks = "Domain,Phylum,Class,Order,Family,Genus,Species".split(",")
-    csv = "#NAME," + ",".join(ranks) + "\n"
-    for feature in taxonomy:
-        fields =  taxonomy[feature]
-        for i in range(len(ranks)):
-            # add "" to fields if shorter than ranks
-            if len(fields) < i+1:
-                fields.append("")
-            if fields[i].find(",") != -1: 
-                fields[i] = f'"{fields[i]}"'
-            fields[i] = "" if fields[i] == "NA" else fields[i]
-            fields[i] = ranks[i][:1].lower() + "__" + fields[i]
-
-        csv += feature + "," + ",".join(fields) + "\n"
-
-    return csv
+RANKS = "Domain,Phylum,Class,Order,Family,Genus,Species".split(",")
+
+def taxonomyLabels(fields, quote=True):
+    """
+    Prefixed rank labels (d__Bacteria, p__, ...), NA as empty, padded to all the ranks
+    """
+    fields = list(fields[:len(RANKS)]) + [""] * (len(RANKS) - len(fields))
+    labels = []
+    for rank, field in zip(RANKS, fields):
+        field = quoteField(field) if quote else field
+        labels.append(rank[:1].lower() + "__" + ("" if field == "NA" else field))
+    return labels
+
+def writeTaxonomy(f, taxonomy):
+    f.write("#NAME," + ",".join(RANKS) + "\n")
+    for feature, fields in taxonomy.items():
+        f.write(feature + "," + ",".join(taxonomyLabels(fields)) + "\n")
+
+def writeBiom(f, FeatTable, metadata, taxonomy, chunk=100000):
+    """
+    Write the feature table, with taxonomy (rows) and metadata (columns), as a
+    sparse BIOM 1.0 (JSON) document. Only the non-zero counts are written, as
+    [row, column, value] entries streamed from the sparse table.
+    """
+    table = FeatTable.table
+    dumps = json.dumps
+    element_type = "int" if np.dtype(table.data.dtype).kind in "iu" else "float"
+    header = {
+        "id": None,
+        "format": "Biological Observation Matrix 1.0.0",
+        "format_url": "http://biom-format.org",
+        "type": "OTU table",
+        "generated_by": "uflow exporter.py " + __VERSION__,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "matrix_type": "sparse",
+        "matrix_element_type": element_type,
+        "shape": [len(FeatTable.features), len(FeatTable.samples)],
+    }
+    f.write(dumps(header)[:-1])
+
+    f.write(',\n"rows": [')
+    for i, feature in enumerate(FeatTable.features):
+        ranks = taxonomy.get(feature)
+        row = {"id": feature, "metadata": {"taxonomy": taxonomyLabels(ranks, quote=False)} if ranks is not None else None}
+        f.write(("," if i else "") + "\n" + dumps(row))
+
+    # Same fields as the metadata CSV
+    fields = [field for field in metadata.fields if field != metadata.id_field]
+    f.write('],\n"columns": [')
+    for j, sample in enumerate(FeatTable.samples):
+        values = metadata.metadata.get(sample)
+        column = {"id": sample, "metadata": dict(zip(fields, values[metadata.id_field_index + 1:])) if values is not None else None}
+        f.write(("," if j else "") + "\n" + dumps(column))
+
+    f.write('],\n"data": [')
+    indptr = np.asarray(table.indptr)
+    separator = "\n"
+    # Blocks of rows with at most about chunk entries
+    step = max(1, chunk // max(1, len(FeatTable.samples)))
+    for start in range(0, len(FeatTable.features), step):
+        end = min(len(FeatTable.features), start + step)
+        lo, hi = int(indptr[start]), int(indptr[end])
+        if lo == hi:
+            continue
+        rows = np.repeat(np.arange(start, end), np.diff(indptr[start:end + 1])).tolist()
+        cols = np.asarray(table.indices[lo:hi]).tolist()
+        values = np.asarray(table.data[lo:hi])
+        values = (values.astype(np.int64) if element_type == "int" else values.astype(np.float64)).tolist()
+        f.write(separator + ",\n".join(f"[{r},{c},{v}]" for r, c, v in zip(rows, cols, values)))
+        separator = ",\n"
+    f.write("]}\n")
+
+def checkExport(FeatTable, metadata, RepSeqs, subset=False):
+    """
+    Return an error message if the tables are not consistent, None otherwise.
+    With subset the feature table can contain only part of the FASTA features.
+    """
+    if len(FeatTable.samples) != len(metadata.samples):
+        return "Number of samples in feature table and metadata do not match"
+
+    if not subset and len(FeatTable.features) != len(RepSeqs.features):
+        return "Number of features in feature table and FASTA do not match"
+
+    # Compare FeatTable.features != RepSeqs.features:
+    for f in FeatTable.features:
+        if f not in RepSeqs:
+            return "Feature {} not found in FASTA".format(f)
+    return None
+
+def writeExport(output, FeatTable, metadata, taxonomy, tree=None, biom=False):
+    """
+    Write metadata.csv, table.csv and taxonomy.csv (and copy the tree) to the output directory,
+    or with biom a single table.biom
+    """
+    if tree is not None:
+        dest = os.path.join(output, "rep-seqs.tree")
+        shutil.copy(tree, dest)
+    if biom:
+        with open(os.path.join(output, "table.biom"), "w") as f:
+            writeBiom(f, FeatTable, metadata, taxonomy)
+        return
+    with open(os.path.join(output, "metadata.csv"), "w") as f:
+        metadata.write(f)
+
+    with open(os.path.join(output, "table.csv"), "w") as f:
+        FeatTable.write(f)
+    with open(os.path.join(output, "taxonomy.csv"), "w") as f:
+        writeTaxonomy(f, taxonomy)
+        f.write("\n")
+
 if __name__ == "__main__":
     args = argparse.ArgumentParser("Export UFLOW to MicrobiomeAnalyst and Phyloseq")
-    args.add_argument("-i", "--feature-table", help="Input OTU table", required=True)
+    args.add_argument("-i", "--feature-table", help="Input OTU table (text, or binary .npz)", required=True)
     args.add_argument("-f", "--fasta", help="Input FASTA file (OTUs)", required=True)
     args.add_argument("-t", "--taxonomy", help="Input taxonomy file (dadaist2 format)", required=True)
     args.add_argument("-m", "--metadata", help="Metadata file", required=False)
     args.add_argument("--tree", help="Tree file (copied)", required=False)
     args.add_argument("-o", "--output", help="Output directory [default: %(default)s]", default="MicrobiomeAnalyst")
+    args.add_argument("-b", "--biom", help="Write a single sparse BIOM (JSON) file, table.biom, rather than the CSV files", action="store_true")
     args.add_argument("--verbose", help="Verbose output", action="store_true")
 
     # Add section for parsers
@@ -263,8 +373,12 @@ if __name__ == "__main__":
         sys.exit(1)
 
 
+    metrics = Instrument("exporter")
+
     # Load feature table
-    FeatTable = FeatureTable(args.feature_table, args.table_sep, args.table_header, args.table_id)
+    with metrics.phase("load") as phase:
+        FeatTable = FeatureTable(args.feature_table, args.table_sep, args.table_header, args.table_id)
+        phase.records = len(FeatTable.features)
 
     # Load or make metadata
     metadata = None
@@ -276,29 +390,13 @@ if __name__ == "__main__":
     RepSeqs = Features(args.fasta)
 
     # Some checks?
-    if len(FeatTable.samples) != len(metadata.samples):
-        print("ERROR: Number of samples in feature table and metadata do not match")
+    error = checkExport(FeatTable, metadata, RepSeqs)
+    if error is not None:
+        print("ERROR: {}".format(error))
         sys.exit(1)
-
-    if len(FeatTable.features) != len(RepSeqs.features):
-        print("ERROR: Number of features in feature table and FASTA do not match")
-        sys.exit(1)
-
-    # Compare FeatTable.features != RepSeqs.features:
-    for f in FeatTable.features:
-        if f not in RepSeqs.features:
-            print("ERROR: Feature {} not found in FASTA".format(f))
-            sys.exit(1)
     tax = loadDecipherTaxonomy(args.taxonomy, RepSeqs)
 
     # Make output files
-    if args.tree is not None:
-        dest = os.path.join(args.output, "rep-seqs.tree")
-        shutil.copy(args.tree, dest)
-    with open(os.path.join(args.output, "metadata.csv"), "w") as f:
-        f.write(metadata.csv())
-
-    with open(os.path.join(args.output, "table.csv"), "w") as f:
-        f.write(FeatTable.csv())
-    with open(os.path.join(args.output, "taxonomy.csv"), "w") as f:
-        print(taxonomyToCsv(tax), file=f)
+    with metrics.phase("write") as phase:
+        writeExport(args.output, FeatTable, metadata, tax, args.tree, args.biom)
+        phase.records = len(FeatTable.features)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Opt-in runtime instrumentation shared by the uflow scripts.
+
+When the UFLOW_METRICS environment variable is set to a directory, each
+script records the wall time, the number of records processed and the peak
+memory (RSS) of its phases, and saves them in a JSON sidecar in that
+directory ({tool}.{host}.{pid}.metrics.json) when it exits.
+multiqctable.py --metrics aggregates the sidecars in a MultiQC section.
+
+    metrics = Instrument("mergeTables")
+    with metrics.phase("read") as phase:
+        ...
+        phase.records = rows
+"""
+import os, sys
+import atexit
+import json
+import platform
+import resource
+import tempfile
+import time
+from contextlib import contextmanager
+
+ENV = "UFLOW_METRICS"
+SUFFIX = ".metrics.json"
+
+
+def peakRss(who=resource.RUSAGE_SELF):
+    """
+    Peak resident set size in MB (of this process, or of its largest child)
+    """
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(who).ru_maxrss / scale
+
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.records = None
+        self.start = None
+
+
+class Instrument:
+    def __init__(self, tool, directory=None):
+        self.tool = tool
+        self.directory = directory if directory is not None else os.environ.get(ENV) or None
+        self.enabled = self.directory is not None
+        self.start = time.time()
+        self.phases = []
+        self.saved = False
+        if self.enabled:
+            atexit.register(self.save)
+
+    def begin(self, name):
+        """
+        Start timing a phase, to be closed by end() (where a with block does not fit)
+        """
+        phase = Phase(name)
+        phase.start = time.perf_counter()
+        return phase
+
+    def end(self, phase, records=None):
+        """
+        Stop timing a phase and record it
+        """
+        if records is not None:
+            phase.records = records
+        if not self.enabled:
+            return
+        seconds = time.perf_counter() - phase.start
+        self.phases.append({
+            "phase": phase.name,
+            "seconds": round(seconds, 4),
+            "records": phase.records,
+            "records_per_second": round(phase.records / seconds, 1) if phase.records is not None and seconds > 0 else None,
+            "peak_rss_mb": round(peakRss(), 1),
+            "children_peak_rss_mb": round(peakRss(resource.RUSAGE_CHILDREN), 1),
+        })
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a block of code; set records on the yielded phase to report the throughput
+        """
+        phase = self.begin(name)
+        try:
+            yield phase
+        finally:
+            self.end(phase)
+
+    def save(self):
+        """
+        Write the sidecar (once, also called at exit)
+        """
+        if not self.enabled or self.saved:
+            return
+        self.saved = True
+        report = {
+            "tool": self.tool,
+            "host": platform.node(),
+            "pid": os.getpid(),
+            "workdir": os.getcwd(),
+            "start": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start)),
+            "seconds": round(time.time() - self.start, 4),
+            "peak_rss_mb": round(peakRss(), 1),
+            "children_peak_rss_mb": round(peakRss(resource.RUSAGE_CHILDREN), 1),
+            "phases": self.phases,
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{self.tool}.{platform.node()}.{os.getpid()}{SUFFIX}")
+            tmp = tempfile.NamedTemporaryFile("w", dir=self.directory, prefix=".tmp.", delete=False)
+            with tmp:
+                json.dump(report, tmp, indent=1)
+            os.replace(tmp.name, path)
+        except OSError as e:
+            # Instrumentation must never make a script fail
+            print(f"Warning: metrics not saved: {e}", file=sys.stderr)
+
+
+def loadSidecars(paths):
+    """
+    Load the sidecars from files and directories
+    """
+    reports = []
+    for path in paths:
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(SUFFIX)] \
+            if os.path.isdir(path) else [path]
+        for file in files:
+            try:
+                with open(file, "r") as f:
+                    reports.append(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"Warning: skipping {file}: {e}", file=sys.stderr)
+    return reports
@@ -1,20 +1,250 @@
 #!/usr/bin/env python3
 """
-Process a set of tables with two columns: IDs and values and 
+Process a set of tables with two columns: IDs and values and
 produce a joined table with ID and a column for each sample
 """
 import os, sys
 import argparse
+import hashlib
+import heapq
+import tempfile
+from instrument import Instrument
+
+
+def readTab(path, sample_from_header=False):
+    """
+    Read a sample table (ID and value) or a partial table produced by a previous
+    merge (ID and one column per sample).
+    Return the list of sample names and a list of (id, values)
+    """
+    samples = [os.path.basename(path).split(".")[0]]
+    rows = []
+    with open(path, "r") as f:
+        c = 0
+        for line in f:
+            c += 1
+            if c == 1:
+                header = line.strip().split("\t")
+                if len(header) > 2:
+                    # Partial table: sample names are always in the header
+                    samples = header[1:]
+                elif sample_from_header:
+                    samples = [header[1]]
+                continue
+            line = line.strip()
+            if line:
+                fields = line.split()
+                if len(fields) != len(samples) + 1:
+                    raise ValueError(f"{path}, line {c}: expected {len(samples) + 1} columns, found {len(fields)}")
+                rows.append((fields[0], fields[1:]))
+    return samples, rows
+
+
+def readFileList(path):
+    """
+    Read a file of filenames, one per line
+    """
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def mergeShard(paths, sample_from_header=False):
+    """
+    Merge a shard of tables in memory, return sample names and rows (pool worker)
+    """
+    engine = MergeEngine()
+    for path in paths:
+        engine.addTable(*readTab(path, sample_from_header))
+    order = engine.order()
+    return engine.samples, list(engine.rows(order))
+
+
+def hashIds(fasta):
+    """
+    Map the ASV names of a FASTA file to the MD5 of their sequence,
+    so that the same ASV has the same ID in every batch
+    """
+    from seqReader import readFasta
+    return {name: hashlib.md5(sequence.upper().encode()).hexdigest() for name, _, sequence in readFasta(fasta)}
+
+
+def renameRows(rows, ids):
+    for id, values in rows:
+        if id not in ids:
+            raise ValueError(f"OTU {id} not found in the FASTA file")
+        yield ids[id], values
+
+
+def updateFasta(path, fasta, ids):
+    """
+    Append to the FASTA file path the sequences of fasta it does not contain
+    yet, named by their hash; return the number of sequences added
+    """
+    from seqReader import readFasta
+    known = {name for name, _, _ in readFasta(path)} if os.path.exists(path) else set()
+    added = 0
+    with open(path, "a") as f:
+        for name, _, sequence in readFasta(fasta):
+            if ids[name] not in known:
+                known.add(ids[name])
+                f.write(f">{ids[name]}\n{sequence}\n")
+                added += 1
+    return added
+
+
+def shards(items, n):
+    """
+    Split items in n contiguous shards, keeping their order
+    """
+    size, extra = divmod(len(items), n)
+    start = 0
+    for i in range(n):
+        end = start + size + (1 if i < extra else 0)
+        if end > start:
+            yield items[start:end]
+        start = end
+
+
+class MergeEngine:
+    """
+    Join sample columns on the OTU ID.
+    OTUs are kept in a hash index (insertion ordered, so rows keep the order
+    of first appearance). Columns are held in memory, or when spill_dir is set
+    they are written in sorted runs of chunk_size samples and k-way merged back.
+    """
+    def __init__(self, spill_dir=None, chunk_size=256):
+        self.index = {}
+        self.samples = []
+        self.columns = []
+        self.spill_dir = spill_dir
+        self.chunk_size = chunk_size
+        self.runs = []
+        self._first_col = 0
+
+    def addTable(self, samples, rows):
+        """
+        Add one or more sample columns, rows being (id, values)
+        """
+        columns = [{} for _ in samples]
+        index = self.index
+        for id, values in rows:
+            row = index.get(id)
+            if row is None:
+                row = len(index)
+                index[id] = row
+            for column, val in zip(columns, values):
+                if val != "0":
+                    column[row] = val
+        self.samples.extend(samples)
+        self.columns.extend(columns)
+        if self.spill_dir is not None and len(self.columns) >= self.chunk_size:
+            self._spill()
+
+    def _spill(self):
+        """
+        Write the buffered columns as a run sorted by (row, column)
+        """
+        if not self.columns:
+            return
+        triples = []
+        for offset, column in enumerate(self.columns):
+            col = self._first_col + offset
+            for row, val in column.items():
+                triples.append((row, col, val))
+        triples.sort()
+        run = tempfile.NamedTemporaryFile("w", dir=self.spill_dir, prefix="merge.", suffix=".run", delete=False)
+        with run:
+            for row, col, val in triples:
+                run.write(f"{row}\t{col}\t{val}\n")
+        self.runs.append(run.name)
+        self._first_col += len(self.columns)
+        self.columns = []
+
+    @staticmethod
+    def _readRun(path):
+        with open(path, "r") as f:
+            for line in f:
+                row, col, val = line.rstrip("\n").split("\t")
+                yield int(row), int(col), val
+
+    def order(self, sort=False):
+        """
+        Return the column positions in output order
+        """
+        order = list(range(len(self.samples)))
+        if sort:
+            order.sort(key=lambda col: self.samples[col])
+        return order
+
+    def rows(self, order):
+        """
+        Yield (id, values) for each OTU, with values in the given column order
+        """
+        ids = list(self.index)
+        if self.spill_dir is None:
+            columns = [self.columns[col] for col in order]
+            for row, id in enumerate(ids):
+                yield id, [column.get(row, "0") for column in columns]
+            return
+
+        self._spill()
+        # Output position of each input column
+        position = [0] * len(order)
+        for pos, col in enumerate(order):
+            position[col] = pos
+        streams = [self._readRun(run) for run in self.runs]
+        zeros = ["0"] * len(order)
+        values = None
+        current = -1
+        try:
+            for row, col, val in heapq.merge(*streams):
+                if row != current:
+                    if values is not None:
+                        yield ids[current], values
+                    # OTUs with no counts in any run
+                    for empty in range(current + 1, row):
+                        yield ids[empty], list(zeros)
+                    current = row
+                    values = list(zeros)
+                values[position[col]] = val
+            if values is not None:
+                yield ids[current], values
+            for empty in range(current + 1, len(ids)):
+                yield ids[empty], list(zeros)
+        finally:
+            for run in self.runs:
+                os.unlink(run)
+            self.runs = []
+
+
+def writeTable(f, otuid, samples, rows, binary=None):
+    """
+    Write the joined table, optionally feeding each row to a SparseTableWriter
+    """
+    f.write(otuid + "\t" + "\t".join(samples) + "\n")
+    for id, values in rows:
+        f.write(id + "\t" + "\t".join(values) + "\n")
+        if binary is not None:
+            binary.addRow(id, values)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Process a set of tables with two columns: IDs and values and produce a joined table with ID and a column for each sample"
     )
-    parser.add_argument("TABS", help="Input table files", nargs="+")
+    parser.add_argument("TABS", help="Input table files (per sample, or partial tables from a previous merge)", nargs="*")
+    parser.add_argument("-l", "--file-list", help="File with the list of input tables, one per line")
     parser.add_argument("-o", "--output", help="Output table file", required=True)
     parser.add_argument("-s", "--sample-from-header", help="Sample names from table headers", action="store_true")
     parser.add_argument("--sort", help="Sort sample names", action="store_true")
     parser.add_argument("--otuid", help="OTU ID column name", default="#OTUID")
+    parser.add_argument("-b", "--binary", help="Also save the table in binary format (.npz) next to the output", action="store_true")
+    parser.add_argument("-j", "--threads", help="Merge shards of the input in parallel, then merge the results [default: %(default)s]", type=int, default=1)
+    parser.add_argument("--spill-dir", help="Spill sorted runs to this directory to bound memory usage")
+    parser.add_argument("--chunk-size", help="Samples per spilled run [default: %(default)s]", type=int, default=256)
+    parser.add_argument("-a", "--append", help="Existing merged table (binary .npz, or text) to add the new samples to")
+    parser.add_argument("--hash-ids", help="FASTA file of the OTUs: rename them as the MD5 of their sequence")
+    parser.add_argument("--hash-fasta", help="FASTA file of all the OTUs named by hash, updated with the new ones (requires --hash-ids)")
     parser.add_argument(
         "-v", "--verbose", help="Verbose output", action="store_true"
     )
@@ -22,59 +252,92 @@ if __name__ == "__main__":
 
     if args.verbose:
         print(args)
-    
+
+    tabs = list(args.TABS)
+    if args.file_list is not None:
+        tabs.extend(readFileList(args.file_list))
+    if len(tabs) == 0:
+        print("ERROR: No input tables", file=sys.stderr)
+        sys.exit(1)
+
+    for file in [args.append, args.hash_ids]:
+        if file is not None and not os.path.isfile(file):
+            print(f"ERROR: File not found: {file}", file=sys.stderr)
+            sys.exit(1)
+    if args.hash_fasta is not None and args.hash_ids is None:
+        print("ERROR: --hash-fasta requires --hash-ids", file=sys.stderr)
+        sys.exit(1)
+
+    if args.spill_dir is not None and not os.path.isdir(args.spill_dir):
+        os.makedirs(args.spill_dir)
+
+    metrics = Instrument("mergeTables")
+
     # Read input files
-    otus = []
-    samples = []
-    tables = {}
-    for singleTabFile in args.TABS:
-        table = {}
-        
-        samplename = os.path.basename(singleTabFile).split(".")[0]
-        
+    phase = metrics.begin("read")
+    engine = MergeEngine(spill_dir=args.spill_dir, chunk_size=args.chunk_size)
+    if args.threads > 1 and len(tabs) > 1:
+        from multiprocessing import Pool
+        from functools import partial
         if args.verbose:
-            print(f"Reading {singleTabFile}")
-        with open(singleTabFile, "r") as f:
-            c=0
-            for line in f:
-                c+=1
-                if c==1:
-                    if args.sample_from_header:
-                        samplename = line.strip().split("\t")[1]
-                    continue
-                line = line.strip()
-                if line:
-                    id, val = line.split()
-                    if not id in otus:
-                        otus.append(id)
-                    table[id] = val
-        tables[samplename] = table 
-        samples.append(samplename)
-
-    if args.sort:
-        samples.sort()
-    # Join tables
-    with open(args.output, "w") as f:
-        # Header
-        f.write(f"{args.otuid}\t")
-        for samplename in samples:
-            sep = "\t" if samplename != samples[-1] else ""
-            f.write(f"{samplename}{sep}")
-        f.write("\n")
-
-        print(f"Last sample: {samples[-1]}", file=sys.stderr)
-        for id in otus:
-            f.write(f"{id}\t")
-            for samplename in samples:
-                sep = "\t"
-                if samplename == samples[-1]:
-                    sep = "\n"
-                if id in tables[samplename]:
-                    # Check if id is the last one
-
-                    
-                    f.write(f"{tables[samplename][id]}{sep}")
-                else:
-                    f.write(f"0{sep}")
-                
-            #f.write("\n")
+            print(f"Merging {len(tabs)} tables in {args.threads} shards")
+        with Pool(args.threads) as pool:
+            worker = partial(mergeShard, sample_from_header=args.sample_from_header)
+            for samples, rows in pool.imap(worker, shards(tabs, args.threads)):
+                engine.addTable(samples, rows)
+    else:
+        for singleTabFile in tabs:
+            if args.verbose:
+                print(f"Reading {singleTabFile}")
+            engine.addTable(*readTab(singleTabFile, args.sample_from_header))
+    metrics.end(phase, records=len(tabs))
+
+    order = engine.order(sort=args.sort)
+    samples = [engine.samples[col] for col in order]
+
+    rows = engine.rows(order)
+    if args.hash_ids is not None:
+        ids = hashIds(args.hash_ids)
+        rows = renameRows(rows, ids)
+        if args.hash_fasta is not None:
+            added = updateFasta(args.hash_fasta, args.hash_ids, ids)
+            if args.verbose:
+                print(f"Added {added} new OTUs to {args.hash_fasta}")
+
+    phase = metrics.begin("write")
+    try:
+        if args.append is not None:
+            # Add the new columns (and OTUs) to the existing table: the old
+            # samples are not read again, only the merged table
+            from sparseTable import SparseTableWriter, binaryPath, loadNpz, readTsv
+            new = SparseTableWriter(samples, args.otuid)
+            for id, values in rows:
+                new.addRow(id, values)
+            existing = loadNpz(args.append, mmap=False) if args.append.endswith(".npz") else readTsv(args.append)
+            table = existing.hstack(new.table())
+            if args.sort:
+                table = table.sortSamples()
+            table.index_name = args.otuid
+            if args.verbose:
+                print(f"Appended {len(samples)} samples to {len(existing.samples)}: {table.shape[0]} OTUs")
+            with open(args.output, "w") as f:
+                print(f"Last sample: {table.samples[-1]}", file=sys.stderr)
+                table.writeTsv(f)
+            if args.binary:
+                table.save(binaryPath(args.output))
+        else:
+            binary = None
+            if args.binary:
+                from sparseTable import SparseTableWriter, binaryPath
+                binary = SparseTableWriter(samples, args.otuid)
+
+            # Join tables
+            with open(args.output, "w") as f:
+                print(f"Last sample: {samples[-1]}", file=sys.stderr)
+                writeTable(f, args.otuid, samples, rows, binary)
+            if args.binary:
+                binary.save(binaryPath(args.output))
+        metrics.end(phase, records=len(engine.index))
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
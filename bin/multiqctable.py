@@ -3,8 +3,10 @@
 Generate a MultiQC ready table.
 Receives a list of *.fastp.json files and from those rescue the basename.*.txt
 """
-import sys, os, json
+import sys, os, json, re
 import argparse
+import mmap
+from multiprocessing import Pool
 
 report_header = """
 # plot_type: 'table'
@@ -38,6 +40,39 @@ report_header = """
 Sample\tcol1\tcol2\tcol3\tcol4\tcol5\tcol6
 """
 
+metrics_header = """
+# plot_type: 'table'
+# section_name: 'Scripts performance'
+# description: 'Wall time, throughput and peak memory of the phases of the uflow scripts (UFLOW_METRICS)'
+# pconfig:
+#     namespace: 'uflow metrics'
+#     id: 'uflow_metrics'
+# headers:
+#     runs:
+#         title: 'Runs'
+#         description: 'Number of runs of the script'
+#         format: '{:,.0f}'
+#     seconds:
+#         title: 'Total time (s)'
+#         description: 'Wall time of the phase, summed over the runs'
+#         format: '{:,.2f}'
+#     max_seconds:
+#         title: 'Max time (s)'
+#         description: 'Wall time of the slowest run'
+#         format: '{:,.2f}'
+#     records_per_second:
+#         title: 'Records/s'
+#         description: 'Records (reads, rows, samples) processed per second'
+#         format: '{:,.0f}'
+#     peak_rss_mb:
+#         title: 'Peak RSS (MB)'
+#         description: 'Maximum resident memory of the script (or its largest worker) at the end of the phase'
+#         format: '{:,.1f}'
+Phase\truns\tseconds\tmax_seconds\trecords_per_second\tpeak_rss_mb
+"""
+
+FILTERED_READS = re.compile(rb'"read1_after_filtering"\s*:\s*\{\s*"total_reads"\s*:\s*(\d+)')
+
 def loadHost(filename):
     data = {
         "Human": 0,
@@ -65,45 +100,168 @@ def checkContaminants(file):
     except Exception as e:
         return "N/A"
 
+def fastpReads(file):
+    """
+    Return read1_after_filtering.total_reads from a fastp JSON file,
+    searching the field in the raw file rather than parsing the whole JSON
+    """
+    with open(file, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                match = FILTERED_READS.search(data)
+                if match is not None:
+                    return int(match.group(1))
+        except ValueError:
+            # Empty file
+            pass
+    with open(file, 'r') as f:
+        return int(json.load(f)["read1_after_filtering"]["total_reads"])
+
+def sampleRow(job):
+    """
+    Return the table row of a sample (pool worker)
+    """
+    file, opts = job
+    basename = os.path.basename(file).replace(opts["json_suffix"], "")
+    filtered = fastpReads(file)
+    host_data  = loadHost(file.replace(opts["json_suffix"], opts["host_suffix"]))
+    row = [basename]
+    # Total reads
+    total = int(host_data["Human"]) + int(host_data["Non-human"])
+    # % host
+    hostRatio =   int(host_data["Human"]) / total
+    # % filtered
+    filtRatio = filtered / total
+
+    # Output columns
+    # 1. Total
+    row.append(str(total))
+    # 2. HostRatio
+    row.append(hostRatio.__format__('.2%'))
+    # 3. Non-host
+    row.append(str( host_data["Non-human"] ))
+    # 4. FiltRatio
+    row.append(filtRatio.__format__('.2%'))
+    # 5. Cleaned
+    row.append(str(filtered))
+    # 6. Contaminants
+    contamfile = file.replace(opts["json_suffix"], opts["contam_suffix"])
+    row.append(str( checkContaminants(contamfile)))
+    return row
+
+def fileSignature(file, opts):
+    """
+    Path, size and modification time of the files of a sample (the cache key)
+    """
+    signature = []
+    for suffix in (opts["json_suffix"], opts["host_suffix"], opts["contam_suffix"]):
+        path = file.replace(opts["json_suffix"], suffix)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature.append([os.path.realpath(path), stat.st_size, stat.st_mtime_ns])
+        else:
+            signature.append(None)
+    return signature
+
+def loadCache(path):
+    if path is None or not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        print(f"Warning: ignoring invalid cache file {path}", file=sys.stderr)
+        return {}
+
+def saveCache(path, cache):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+def aggregateMetrics(reports):
+    """
+    Summarize the instrumentation sidecars by script and phase, return rows
+    (script: phase, runs, seconds, max seconds, records per second, peak RSS)
+    """
+    summary = {}
+    for report in reports:
+        phases = report.get("phases", []) + [{
+            "phase": "total",
+            "seconds": report.get("seconds", 0),
+            "records": None,
+            "peak_rss_mb": report.get("peak_rss_mb", 0),
+            "children_peak_rss_mb": report.get("children_peak_rss_mb", 0),
+        }]
+        for phase in phases:
+            key = f"{report.get('tool', 'unknown')}: {phase['phase']}"
+            entry = summary.setdefault(key, {"runs": 0, "seconds": 0.0, "max_seconds": 0.0,
+                "records": 0, "timed": 0.0, "peak_rss_mb": 0.0})
+            entry["runs"] += 1
+            entry["seconds"] += phase["seconds"]
+            entry["max_seconds"] = max(entry["max_seconds"], phase["seconds"])
+            if phase.get("records") is not None:
+                entry["records"] += phase["records"]
+                entry["timed"] += phase["seconds"]
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"], phase.get("peak_rss_mb", 0), phase.get("children_peak_rss_mb", 0))
+    rows = []
+    for key in sorted(summary):
+        entry = summary[key]
+        rate = f"{entry['records'] / entry['timed']:.1f}" if entry["timed"] > 0 else ""
+        rows.append([key, str(entry["runs"]), f"{entry['seconds']:.3f}", f"{entry['max_seconds']:.3f}",
+            rate, f"{entry['peak_rss_mb']:.1f}"])
+    return rows
+
 if __name__ == "__main__":
     args = argparse.ArgumentParser(description='Generate a MultiQC ready table')
-    args.add_argument('-j', '--fastp-json', help='FASTP json files', nargs='+')
+    args.add_argument('-j', '--fastp-json', help='FASTP json files', nargs='+', default=[])
     args.add_argument('-s', '--json-suffix', help='Suffix of the json files [default: %(default)s]', default='.fastp.json')
     args.add_argument('-z', '--host-suffix', help='Suffix of the host files [default: %(default)s]', default='.host.txt')
     args.add_argument('--contam-suffix', help='Suffix of the host files [default: %(default)s]', default='.contaminants.txt')
     args.add_argument('-o', '--output', help='Output file [default: %(default)s]', default='summary_mqc.txt')
+    args.add_argument('-t', '--threads', help='Worker processes [default: %(default)s]', type=int, default=1)
+    args.add_argument('-c', '--cache', help='Cache file of the sample rows, reused when the sample files did not change')
+    args.add_argument('-m', '--metrics', help='Instrumentation sidecars of the scripts (files or directories) to summarize', nargs='+')
+    args.add_argument('--metrics-output', help='Output file of the scripts performance section [default: %(default)s]', default='uflow_metrics_mqc.txt')
     opts = args.parse_args()
 
-    outfile = open(opts.output, 'w') if opts.output is not None else sys.stdout
-    print (report_header.strip(), file=outfile)
-    # Existing files
+    settings = {
+        "json_suffix": opts.json_suffix,
+        "host_suffix": opts.host_suffix,
+        "contam_suffix": opts.contam_suffix,
+    }
+    # Reuse the rows of the samples whose files did not change
+    cache = loadCache(opts.cache)
+    rows = {}
+    todo = []
     for file in opts.fastp_json:
-        basename = os.path.basename(file).replace(opts.json_suffix, "")
-        fastp_json = json.load(open(file))
-        host_data  = loadHost(file.replace(opts.json_suffix, opts.host_suffix))
-        row = [basename]
-        # Total reads
-        total = int(host_data["Human"]) + int(host_data["Non-human"])
-        # % host
-        hostRatio =   int(host_data["Human"]) / total
-        # % filtered
-        filtRatio = int(fastp_json["read1_after_filtering"]["total_reads"]) / total
-
-        # Output columns
-        # 1. Total
-        row.append(str(total))
-        # 2. HostRatio
-        row.append(hostRatio.__format__('.2%'))
-        # 3. Non-host
-        row.append(str( host_data["Non-human"] ))
-        # 4. FiltRatio
-        row.append(filtRatio.__format__('.2%'))
-        # 5. Cleaned
-        row.append(str(fastp_json["read1_after_filtering"]["total_reads"]))
-        # 6. Contaminants
-        contamfile = file.replace(opts.json_suffix, opts.contam_suffix)
-        row.append(str( checkContaminants(contamfile)))
-        print("\t".join(row), file=outfile)
+        signature = fileSignature(file, settings)
+        entry = cache.get(os.path.basename(file))
+        if entry is not None and entry["signature"] == signature:
+            rows[file] = entry["row"]
+        else:
+            todo.append((file, signature))
 
+    jobs = [(file, settings) for file, _ in todo]
+    if opts.threads > 1 and len(jobs) > 1:
+        with Pool(min(opts.threads, len(jobs))) as pool:
+            results = pool.map(sampleRow, jobs, chunksize=max(1, len(jobs) // (opts.threads * 4)))
+    else:
+        results = [sampleRow(job) for job in jobs]
+    for (file, signature), row in zip(todo, results):
+        rows[file] = row
+        cache[os.path.basename(file)] = {"signature": signature, "row": row}
+    if opts.cache is not None and todo:
+        saveCache(opts.cache, cache)
 
+    outfile = open(opts.output, 'w') if opts.output is not None else sys.stdout
+    print (report_header.strip(), file=outfile)
+    for file in opts.fastp_json:
+        print("\t".join(rows[file]), file=outfile)
 
+    if opts.metrics is not None:
+        from instrument import loadSidecars
+        with open(opts.metrics_output, 'w') as f:
+            print(metrics_header.strip(), file=f)
+            for row in aggregateMetrics(loadSidecars(opts.metrics)):
+                print("\t".join(row), file=f)
@@ -1,26 +1,198 @@
 #!/usr/bin/env python3
+"""
+Normalize an OTU table (features as rows, samples as columns).
+
+Methods:
+  tss       total sum scaling (fraction of the sample total)
+  relative  relative abundance (percentage of the sample total)
+  css       cumulative sum scaling (metagenomeSeq)
+  clr       centered log-ratio, with pseudocount
+  log       log(x + pseudocount)
+
+Sample statistics are collected in a first pass and the table is normalized
+in a second pass, both over blocks of rows: with --chunked a text table is
+streamed twice from disk so it never needs to fit in memory.
+"""
 import os, sys
 import argparse
-import pandas as pd
+import numpy as np
+from sparseTable import loadNpz, readTsv
+from instrument import Instrument
+
+METHODS = ["tss", "relative", "css", "clr", "log"]
+
+
+def reduceHistogram(cols, values, counts):
+    """
+    Merge duplicated (sample, value) pairs summing their counts
+    """
+    if len(cols) == 0:
+        return cols, values, counts
+    order = np.lexsort((values, cols))
+    cols, values, counts = cols[order], values[order], counts[order]
+    new = np.ones(len(cols), dtype=bool)
+    new[1:] = (cols[1:] != cols[:-1]) | (values[1:] != values[:-1])
+    starts = np.flatnonzero(new)
+    return cols[starts], values[starts], np.add.reduceat(counts, starts)
+
+
+def cssFactor(values, counts, quantile):
+    """
+    Sum of the counts up to the quantile of the non-zero counts of a sample,
+    from its sorted distinct values and their multiplicity
+    """
+    if len(values) == 0:
+        return 0.0
+    cumulative = np.cumsum(counts)
+    # Quantile as in R quantile(type=7) over the expanded values
+    h = (cumulative[-1] - 1) * quantile
+    lo = values[np.searchsorted(cumulative, np.floor(h), side="right")]
+    hi = values[np.searchsorted(cumulative, np.ceil(h), side="right")]
+    threshold = lo + (h - np.floor(h)) * (hi - lo)
+    keep = values <= threshold
+    return float(np.sum(values[keep] * counts[keep]))
+
+
+class Normalizer:
+    def __init__(self, method, samples, pseudocount=1.0, quantile=0.5, scale=1000.0, log_base=10.0, dtype=np.float64):
+        if method not in METHODS:
+            raise ValueError(f"Unknown normalization method: {method}")
+        self.method = method
+        self.nsamples = samples
+        self.pseudocount = pseudocount
+        self.quantile = quantile
+        self.scale = scale
+        self.log_base = log_base
+        self.dtype = dtype
+        self.features = 0
+        self.totals = np.zeros(samples, dtype=np.float64)
+        self.hist = [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.int64)]
+        self.factors = None
+
+    def update(self, block):
+        """
+        First pass: collect the per-sample statistics from a block of rows
+        """
+        self.features += block.shape[0]
+        if self.method in ("tss", "relative"):
+            self.totals += block.sum(axis=0, dtype=np.float64)
+        elif self.method == "clr":
+            self.totals += np.log(block + self.pseudocount).sum(axis=0, dtype=np.float64)
+        elif self.method == "css":
+            rows, cols = np.nonzero(block)
+            hist = zip(self.hist, (cols.astype(np.int64), block[rows, cols].astype(np.float64), np.ones(len(cols), dtype=np.int64)))
+            self.hist = list(reduceHistogram(*[np.concatenate(pair) for pair in hist]))
+
+    def finalize(self):
+        if self.method == "tss":
+            self.factors = self.totals
+        elif self.method == "relative":
+            self.factors = self.totals / 100.0
+        elif self.method == "clr":
+            # Mean of the log values of each sample
+            self.factors = self.totals / max(self.features, 1)
+        elif self.method == "css":
+            cols, values, counts = self.hist
+            bounds = np.searchsorted(cols, np.arange(self.nsamples + 1))
+            self.factors = np.array([cssFactor(values[start:end], counts[start:end], self.quantile)
+                for start, end in zip(bounds[:-1], bounds[1:])]) / self.scale
+        self.factors = None if self.factors is None else self.factors.astype(self.dtype)
+
+    def transform(self, block):
+        """
+        Second pass: normalize a block of rows
+        """
+        block = block.astype(self.dtype, copy=False)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.method in ("tss", "relative", "css"):
+                return block / self.factors
+            if self.method == "clr":
+                return np.log(block + self.pseudocount) - self.factors
+            return np.log(block + self.pseudocount) / np.log(self.dtype(self.log_base))
+
+
+def textHeader(path, sep):
+    with open(path, "r") as f:
+        return f.readline().rstrip("\r\n").split(sep)
+
+
+def textBlocks(path, sep, rows, dtype):
+    """
+    Yield (ids, dense block) parsing a text table, rows at a time
+    """
+    with open(path, "r") as f:
+        f.readline()
+        ids, lines = [], []
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line == "":
+                continue
+            id, values = line.split(sep, 1)
+            ids.append(id)
+            lines.append(values)
+            if len(lines) == rows:
+                yield ids, np.loadtxt(lines, delimiter=sep, dtype=dtype, ndmin=2, comments=None)
+                ids, lines = [], []
+        if lines:
+            yield ids, np.loadtxt(lines, delimiter=sep, dtype=dtype, ndmin=2, comments=None)
+
+
+def writeBlock(f, ids, block, sep="\t"):
+    for id, row in zip(ids, block):
+        values = row.astype(str)
+        if np.isnan(row).any():
+            values[np.isnan(row)] = ""
+        f.write(id + sep + sep.join(values) + "\n")
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Normalize OTU table')
-    parser.add_argument('-i', '--input', help='Input OTU table', required=True)
+    parser.add_argument('-i', '--input', help='Input OTU table (text, or binary .npz)', required=True)
     parser.add_argument('-o', '--output', help='Output OTU table', required=True)
-    parser.add_argument('-s', '--separator', help='Separator', default='\t')
-     
+    parser.add_argument('-s', '--separator', help='Separator of the input table (the output is always tab separated)', default='\t')
+    parser.add_argument('-m', '--method', help='Normalization method [default: %(default)s]', choices=METHODS, default='tss')
+    parser.add_argument('-p', '--pseudocount', help='Pseudocount for clr and log [default: %(default)s]', type=float, default=1.0)
+    parser.add_argument('--quantile', help='Quantile of the non-zero counts for css [default: %(default)s]', type=float, default=0.5)
+    parser.add_argument('--scale', help='Scaling constant for css [default: %(default)s]', type=float, default=1000.0)
+    parser.add_argument('--log-base', help='Logarithm base for log [default: %(default)s]', type=float, default=10.0)
+    parser.add_argument('--float32', help='Compute in single precision (half the memory)', action='store_true')
+    parser.add_argument('--chunked', help='Stream a text table twice from disk instead of loading it', action='store_true')
+    parser.add_argument('--chunk-rows', help='Rows per block [default: about 4M values per block]', type=int)
+
     args = parser.parse_args()
 
     if not os.path.isfile(args.input):
         print('Error: OTU table file not found: ' + args.input)
         sys.exit(1)
-    
+
     output_file = args.output
-    
-    df = pd.read_csv(args.input, sep=args.separator, index_col=0)
-    
-    # Normalize by total of each column
-    df_norm = df.div(df.sum(axis=0), axis=1)
-
-    
-    df_norm.to_csv(output_file, sep='\t')
\ No newline at end of file
+    metrics = Instrument('normalizeOtutable')
+    dtype = np.float32 if args.float32 else np.float64
+
+    with metrics.phase('load'):
+        if args.input.endswith('.npz') or not args.chunked:
+            # Memory mapped (binary) or sparse (text) table
+            table = loadNpz(args.input) if args.input.endswith('.npz') else readTsv(args.input, args.separator)
+            index_name, samples = table.index_name, table.samples
+            blocks = lambda rows: table.blocks(rows, dtype)
+        else:
+            header = textHeader(args.input, args.separator)
+            index_name, samples = header[0], header[1:]
+            blocks = lambda rows: textBlocks(args.input, args.separator, rows, dtype)
+
+    rows = args.chunk_rows if args.chunk_rows is not None else max(1, 4000000 // max(len(samples), 1))
+    normalizer = Normalizer(args.method, len(samples), pseudocount=args.pseudocount, quantile=args.quantile,
+        scale=args.scale, log_base=args.log_base, dtype=dtype)
+    with metrics.phase('statistics') as phase:
+        if args.method != 'log':
+            for ids, block in blocks(rows):
+                normalizer.update(block)
+        normalizer.finalize()
+        phase.records = normalizer.features
+
+    with metrics.phase('normalize') as phase, open(output_file, 'w') as f:
+        f.write(index_name + '\t' + '\t'.join(samples) + '\n')
+        phase.records = 0
+        for ids, block in blocks(rows):
+            writeBlock(f, ids, normalizer.transform(block))
+            phase.records += len(ids)
@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 """
-Check the database file and make a symbolic link adding the appropriate suffix
+Check the database file and make a symbolic link adding the appropriate suffix.
+
+With --cache the database is linked once in a shared cache directory, keyed
+by its checksum, with the appropriate suffix: a hard link (symbolic link
+across file systems), in its original compression, as dadaist2-assigntax
+reads it. The link is made with a temporary name and renamed, so concurrent
+tasks can share it safely. The prepared path is printed.
 """
 
 import os, sys
 import argparse
+import hashlib
+import shutil
+import tempfile
 
 def dbType(file):
     """
@@ -17,17 +26,98 @@ def dbType(file):
         return '.fa.gz'
     else:
         return '.RData'
+
+def fileChecksum(path, blocksize=16 * 1024 * 1024):
+    """
+    SHA1 of the content of a file
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def atomicWrite(path, content):
+    """
+    Write a file in its directory as a temporary file, then rename it
+    """
+    tmp = tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), prefix=".tmp.", delete=False)
+    with tmp:
+        tmp.write(content)
+    os.replace(tmp.name, path)
+
+def cachedChecksum(path, cache):
+    """
+    Checksum of a file, memoized in the cache directory by path, size and
+    modification time: recomputed only if the file changed
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    signature = f"{stat.st_size}\t{stat.st_mtime_ns}"
+    memo = os.path.join(cache, "checksums", hashlib.sha1(path.encode()).hexdigest())
+    if os.path.exists(memo):
+        with open(memo, "r") as f:
+            stored, checksum = f.read().rstrip("\n").rsplit("\t", 1)
+        if stored == signature:
+            return checksum
+    checksum = fileChecksum(path)
+    os.makedirs(os.path.dirname(memo), exist_ok=True)
+    atomicWrite(memo, f"{signature}\t{checksum}\n")
+    return checksum
+
+def prepareDb(file, cache):
+    """
+    Return the path of the prepared database in the cache, preparing it if needed
+    """
+    checksum = cachedChecksum(file, cache)
+    directory = os.path.join(cache, checksum)
+    prepared = os.path.join(directory, "db" + dbType(file))
+    if os.path.exists(prepared):
+        return prepared
+    os.makedirs(directory, exist_ok=True)
+    return linkDb(file, prepared)
+
+def linkDb(file, prepared):
+    """
+    Link the database in the cache (hard link, or symbolic link on another file system)
+    """
+    source = os.path.realpath(file)
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(prepared), prefix=".tmp.")
+    tmp = os.path.join(tmpdir, os.path.basename(prepared))
+    try:
+        try:
+            os.link(source, tmp)
+        except OSError:
+            os.symlink(source, tmp)
+        # Another task may have linked it in the meantime: same content
+        os.replace(tmp, prepared)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return prepared
+
 if __name__ == "__main__":
     args = argparse.ArgumentParser(description="Check the database file and make a symbolic link adding the appropriate suffix")
     args.add_argument("-i", "--input", help="Input database file", required=True)
     args.add_argument("-m", "--move", help="Move the file, otherwise symlink", action="store_true")
+    args.add_argument("-c", "--cache", help="Shared cache directory of the prepared databases")
     args = args.parse_args()
 
+    if not os.path.exists(args.input):
+        print(f"Error: database not found: {args.input}", file=sys.stderr)
+        sys.exit(1)
+
     # Output basename
     base = os.path.basename(args.input)
-    ext = dbType(args.input)
-    print(f"{args.input} -> {base + ext}", file=sys.stderr)
-    if args.move:
-        os.rename(args.input, base + ext)
+    if args.cache is not None:
+        prepared = prepareDb(args.input, args.cache)
+        ext = dbType(args.input)
+        print(f"{args.input} -> {prepared} -> {base + ext}", file=sys.stderr)
+        os.symlink(os.path.abspath(prepared), base + ext)
+        print(os.path.abspath(prepared))
     else:
-        os.symlink(args.input, base + ext)
\ No newline at end of file
+        ext = dbType(args.input)
+        print(f"{args.input} -> {base + ext}", file=sys.stderr)
+        if args.move:
+            os.rename(args.input, base + ext)
+        else:
+            os.symlink(args.input, base + ext)
\ No newline at end of file
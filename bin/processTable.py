@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Post-process an OTU table in a single process: load it once, then
+  1. trim it (as usearch -otutab_trim)
+  2. normalize it (as normalizeOtutable.py)
+  3. add the taxonomy (as addTaxonomy.py)
+  4. optionally export it for MicrobiomeAnalyst/Phyloseq (as exporter.py)
+The table stays sparse: the normalized table and the table with taxonomy
+are written from the same dense blocks of rows, one block at a time.
+"""
+import os, sys
+import argparse
+import numpy as np
+import pandas as pd
+from sparseTable import loadTable
+from normalizeOtutable import METHODS, Normalizer, writeBlock
+from addTaxonomy import loadTaxonomy, writeTaxonomyTable
+from instrument import Instrument
+
+
+def trimTable(table, min_sample_size=0, min_freq=0.0, min_otu_size=0, min_count=0):
+    """
+    Trim the table, in this order:
+      - counts below min_count, or below min_freq of the (untrimmed) sample size, are set to zero
+      - samples with less than min_sample_size reads (after the counts) are removed
+      - OTUs with less than min_otu_size reads (in the samples kept) are removed
+    Values equal to a threshold are kept.
+    """
+    data = np.asarray(table.data, dtype=np.float64)
+    rows = table.rowIds()
+    cols = np.asarray(table.indices)
+    sample_size = np.bincount(cols, weights=data, minlength=len(table.samples))
+    entries = (data >= min_count) & (data >= min_freq * sample_size[cols]) & (data > 0)
+
+    sample_size = np.bincount(cols[entries], weights=data[entries], minlength=len(table.samples))
+    samples = sample_size >= max(min_sample_size, 1)
+    entries &= samples[cols]
+
+    otu_size = np.bincount(rows[entries], weights=data[entries], minlength=len(table.features))
+    features = otu_size >= max(min_otu_size, 1)
+    return table.subset(features, samples, entries)
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Trim, normalize, annotate and export an OTU table in one pass")
+    args.add_argument("-i", "--input", help="Input OTU table (text, or binary .npz)", required=True)
+    args.add_argument("-s", "--separator", help="Separator of the OTU table [default: tab]", default="\t")
+    args.add_argument("-f", "--fasta", help="Input FASTA file (OTUs)", required=True)
+    args.add_argument("-t", "--taxonomy", help="Input taxonomy file (dadaist2 format)", required=True)
+
+    trimargs = args.add_argument_group("Trimming options (as usearch -otutab_trim)")
+    trimargs.add_argument("--min-sample-size", help="Minimum reads per sample [default: %(default)s]", type=int, default=1000)
+    trimargs.add_argument("--min-freq", help="Minimum frequency of a count in its sample [default: %(default)s]", type=float, default=0.0005)
+    trimargs.add_argument("--min-otu-size", help="Minimum reads per OTU [default: %(default)s]", type=int, default=10)
+    trimargs.add_argument("--min-count", help="Minimum count [default: %(default)s]", type=int, default=0)
+
+    normargs = args.add_argument_group("Normalization options")
+    normargs.add_argument("-m", "--method", help="Normalization method [default: %(default)s]", choices=METHODS, default="tss")
+    normargs.add_argument("-p", "--pseudocount", help="Pseudocount for clr and log [default: %(default)s]", type=float, default=1.0)
+
+    outargs = args.add_argument_group("Output options")
+    outargs.add_argument("--trimmed", help="Trimmed OTU table [default: %(default)s]", default="otutable.tsv")
+    outargs.add_argument("--binary", help="Also save the trimmed table in binary format (.npz)", action="store_true")
+    outargs.add_argument("--normalized", help="Normalized OTU table [default: %(default)s]", default="freq_table.tsv")
+    outargs.add_argument("-o", "--output", help="Normalized OTU table with taxonomy [default: %(default)s]", default="table_relative_tax.tsv")
+    outargs.add_argument("-k", "--index-name", help="Index name of the table with taxonomy [default: %(default)s]", default="#NAME")
+    outargs.add_argument("--condense", help="Condense the taxonomy to a string", action="store_true")
+    outargs.add_argument("--csv", help="Print the table with taxonomy as CSV rather than TSV", action="store_true")
+    outargs.add_argument("--export", help="Export directory for MicrobiomeAnalyst (trimmed counts)")
+    outargs.add_argument("--metadata", help="Metadata file for the export")
+    outargs.add_argument("--tree", help="Tree file for the export (copied)")
+    outargs.add_argument("--biom", help="Export a single sparse BIOM (JSON) file rather than the CSV files", action="store_true")
+    opts = args.parse_args()
+
+    for file in [opts.input, opts.fasta, opts.taxonomy] + [file for file in (opts.metadata, opts.tree) if file]:
+        if not os.path.exists(file):
+            print("Error: file not found: " + file)
+            sys.exit(1)
+
+    instrument = Instrument("processTable")
+
+    # Load and trim
+    with instrument.phase("load") as phase:
+        table = loadTable(opts.input, opts.separator)
+        phase.records = table.nnz
+    with instrument.phase("trim") as phase:
+        trimmed = trimTable(table, opts.min_sample_size, opts.min_freq, opts.min_otu_size, opts.min_count)
+        print("Trimmed table: {} OTUs x {} samples (from {} x {})".format(
+            len(trimmed.features), len(trimmed.samples), len(table.features), len(table.samples)), file=sys.stderr)
+        with open(opts.trimmed, "w") as f:
+            trimmed.writeTsv(f)
+        if opts.binary:
+            trimmed.save(os.path.splitext(opts.trimmed)[0] + ".npz")
+        phase.records = len(trimmed.features)
+
+    # Normalization statistics
+    with instrument.phase("normalize") as phase:
+        rows = max(1, 4000000 // max(len(trimmed.samples), 1))
+        normalizer = Normalizer(opts.method, len(trimmed.samples), pseudocount=opts.pseudocount)
+        if opts.method != "log":
+            for ids, block in trimmed.blocks(rows):
+                normalizer.update(block)
+        normalizer.finalize()
+        phase.records = len(trimmed.features)
+
+    # Normalized table and taxonomy, written from the same blocks of rows
+    with instrument.phase("taxonomy") as phase:
+        taxonomy = loadTaxonomy(opts.taxonomy, opts.fasta)
+        with open(opts.normalized, "w") as f:
+            f.write(trimmed.index_name + "\t" + "\t".join(trimmed.samples) + "\n")
+
+            def normalizedChunks():
+                for ids, block in trimmed.blocks(rows):
+                    block = normalizer.transform(block)
+                    writeBlock(f, ids, block)
+                    yield pd.DataFrame(block, index=ids, columns=trimmed.samples)
+
+            writeTaxonomyTable(normalizedChunks(), trimmed.features, trimmed.samples, taxonomy,
+                opts.output, opts.condense, "," if opts.csv else "\t", opts.index_name)
+        phase.records = len(trimmed.features)
+
+    # Export
+    if opts.export is not None:
+        with instrument.phase("export") as phase:
+            from exporter import (FeatureTable, Features, Metadata, MakeMetadata,
+                checkExport, loadDecipherTaxonomy, writeExport)
+            os.makedirs(opts.export, exist_ok=True)
+            id_field = trimmed.index_name[1:] if trimmed.index_name.startswith("#") else trimmed.index_name
+            FeatTable = FeatureTable(None, "\t", "#", id_field, table=trimmed)
+            metadata = Metadata(opts.metadata, "\t", "#", "SampleID") if opts.metadata else MakeMetadata(FeatTable)
+            RepSeqs = Features(opts.fasta)
+            error = checkExport(FeatTable, metadata, RepSeqs, subset=True)
+            if error is not None:
+                print("ERROR: {}".format(error))
+                sys.exit(1)
+            kept = set(trimmed.features)
+            tax = {feature: ranks for feature, ranks in loadDecipherTaxonomy(opts.taxonomy, RepSeqs).items() if feature in kept}
+            writeExport(opts.export, FeatTable, metadata, tax, opts.tree, opts.biom)
+            phase.records = len(trimmed.features)
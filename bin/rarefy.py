@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Rarefy an OTU table (e.g. the TRIM output) and compute rarefaction curves.
+
+The counts of each sample are subsampled without replacement to the target
+depth with multivariate hypergeometric draws, all the iterations of a sample
+being drawn at once. Samples with fewer reads than the depth are dropped.
+The rarefied table is the first iteration (integer counts), or the mean of
+the iterations with --average.
+
+With --curves, the observed features and the Shannon index (natural log)
+are computed at increasing depths (mean and standard deviation over the
+iterations), for each sample up to its number of reads.
+
+Samples are processed in chunks by a pool of workers. Each sample has its
+own random generator, seeded from --seed and its position, so the results
+do not depend on the number of workers.
+"""
+import os, sys
+import argparse
+from multiprocessing import Pool
+import numpy as np
+from sparseTable import SparseTable, binaryPath, loadTable
+from instrument import Instrument
+
+CURVE_FIELDS = ["sample", "depth", "observed", "observed_sd", "shannon", "shannon_sd"]
+
+
+def shannon(draws, depth):
+    """
+    Shannon index (natural log) of each row of draws (iterations x features)
+    """
+    p = draws / depth
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return -np.where(p > 0, p * np.log(p), 0.0).sum(axis=1)
+
+
+def rarefyChunk(job):
+    """
+    Rarefy the samples of a chunk (given by sample) and compute their curves.
+    Return, for each sample, the rarefied (features, values) or None, and the curve rows.
+    """
+    start, colptr, features, values, depth, curve_depths, iterations, seed, average = job
+    results = []
+    for j in range(len(colptr) - 1):
+        counts = values[colptr[j]:colptr[j + 1]].astype(np.int64)
+        ids = features[colptr[j]:colptr[j + 1]]
+        total = int(counts.sum())
+        rng = np.random.default_rng([seed, start + j])
+        rarefied = None
+        if depth > 0 and total >= depth:
+            # All the iterations in one call (iterations x features)
+            draws = rng.multivariate_hypergeometric(counts, depth, size=iterations)
+            sample = draws.mean(axis=0) if average else draws[0]
+            keep = sample > 0
+            rarefied = (ids[keep], sample[keep])
+        curve = []
+        for step in curve_depths:
+            if step > total:
+                break
+            draws = rng.multivariate_hypergeometric(counts, step, size=iterations)
+            observed = (draws > 0).sum(axis=1)
+            index = shannon(draws, step)
+            curve.append((step, observed.mean(), observed.std(), index.mean(), index.std()))
+        results.append((rarefied, curve))
+    return start, results
+
+
+def rarefy(table, depth, curve_depths=(), iterations=1, seed=0, average=False, threads=1, chunk_size=200):
+    """
+    Return the rarefied table and {sample: curve rows}
+    """
+    colptr, features, values = table.toCsc()
+    nsamples = len(table.samples)
+    jobs = []
+    for start in range(0, nsamples, chunk_size):
+        end = min(start + chunk_size, nsamples)
+        lo, hi = colptr[start], colptr[end]
+        jobs.append((start, colptr[start:end + 1] - lo, features[lo:hi], values[lo:hi], depth,
+            sorted(curve_depths), iterations, seed, average))
+    if threads > 1 and len(jobs) > 1:
+        with Pool(min(threads, len(jobs))) as pool:
+            chunks = pool.map(rarefyChunk, jobs)
+    else:
+        chunks = [rarefyChunk(job) for job in jobs]
+
+    rows, cols, data, samples, curves = [], [], [], [], {}
+    for start, results in chunks:
+        for j, (rarefied, curve) in enumerate(results):
+            sample = table.samples[start + j]
+            curves[sample] = curve
+            if rarefied is None:
+                continue
+            ids, counts = rarefied
+            rows.append(ids)
+            cols.append(np.full(len(ids), len(samples)))
+            data.append(counts)
+            samples.append(sample)
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+    data = np.concatenate(data) if data else np.zeros(0, dtype=np.int64)
+    # Keep the features still present
+    used = np.zeros(len(table.features), dtype=bool)
+    used[rows] = True
+    position = np.cumsum(used) - 1
+    rarefied = SparseTable._fromCoo([feature for feature, keep in zip(table.features, used) if keep], samples,
+        position[rows], cols, data, table.index_name)
+    return rarefied, curves
+
+
+def curveDepths(depths, steps, maximum):
+    """
+    Explicit comma separated depths, or steps depths evenly spaced up to maximum
+    """
+    if depths:
+        return sorted(set(int(depth) for depth in depths.split(",")))
+    if steps <= 0 or maximum <= 0:
+        return []
+    return sorted(set(int(round(maximum * (i + 1) / steps)) for i in range(steps)) - {0})
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Rarefy an OTU table (multivariate hypergeometric) and compute rarefaction curves")
+    args.add_argument("-i", "--input", help="Input OTU table (text, or binary .npz)", required=True)
+    args.add_argument("-o", "--output", help="Rarefied OTU table [default: %(default)s]", default="otutable_rarefied.tsv")
+    args.add_argument("-s", "--separator", help="Separator of the OTU table [default: tab]", default="\t")
+    args.add_argument("-d", "--depth", help="Rarefaction depth [default: reads of the smallest sample]", type=int)
+    args.add_argument("-n", "--iterations", help="Iterations per sample [default: %(default)s]", type=int, default=10)
+    args.add_argument("--average", help="Write the mean of the iterations rather than the first one", action="store_true")
+    args.add_argument("--seed", help="Random seed [default: %(default)s]", type=int, default=42)
+    args.add_argument("-b", "--binary", help="Also save the rarefied table in binary format (.npz) next to the output", action="store_true")
+
+    curveargs = args.add_argument_group("Rarefaction curves")
+    curveargs.add_argument("-c", "--curves", help="Output file of the rarefaction curves")
+    curveargs.add_argument("--steps", help="Number of depths of the curves [default: %(default)s]", type=int, default=10)
+    curveargs.add_argument("--max-depth", help="Largest depth of the curves [default: reads of the largest sample]", type=int)
+    curveargs.add_argument("--curve-depths", help="Comma separated depths of the curves (instead of --steps)")
+
+    args.add_argument("-t", "--threads", help="Worker processes [default: %(default)s]", type=int, default=1)
+    args.add_argument("--chunk-size", help="Samples per worker task [default: %(default)s]", type=int, default=200)
+    opts = args.parse_args()
+
+    if not os.path.isfile(opts.input):
+        print("Error: OTU table file not found: " + opts.input)
+        sys.exit(1)
+    if opts.iterations < 1:
+        print("Error: --iterations must be at least 1")
+        sys.exit(1)
+
+    instrument = Instrument("rarefy")
+    with instrument.phase("load") as phase:
+        table = loadTable(opts.input, opts.separator)
+        phase.records = table.nnz
+    totals = table.sampleTotals().astype(np.int64)
+    if np.any(np.asarray(table.data) % 1 != 0):
+        print("Error: the OTU table must contain integer counts")
+        sys.exit(1)
+    depth = opts.depth if opts.depth is not None else int(totals[totals > 0].min()) if np.any(totals > 0) else 0
+    depths = []
+    if opts.curves is not None:
+        maximum = opts.max_depth if opts.max_depth is not None else int(totals.max()) if len(totals) else 0
+        try:
+            depths = curveDepths(opts.curve_depths, opts.steps, maximum)
+        except ValueError:
+            print("Error: --curve-depths must be comma separated integers")
+            sys.exit(1)
+
+    with instrument.phase("rarefy") as phase:
+        rarefied, curves = rarefy(table, depth, depths, opts.iterations, opts.seed, opts.average, opts.threads, opts.chunk_size)
+        phase.records = len(table.samples) * opts.iterations
+
+    with instrument.phase("write") as phase:
+        with open(opts.output, "w") as f:
+            rarefied.writeTsv(f)
+        if opts.binary:
+            rarefied.save(binaryPath(opts.output))
+        if opts.curves is not None:
+            with open(opts.curves, "w") as f:
+                f.write("\t".join(CURVE_FIELDS) + "\n")
+                for sample in table.samples:
+                    for step, observed, observed_sd, index, index_sd in curves[sample]:
+                        f.write(f"{sample}\t{step}\t{observed:.2f}\t{observed_sd:.2f}\t{index:.4f}\t{index_sd:.4f}\n")
+        phase.records = len(rarefied.samples)
+    dropped = len(table.samples) - len(rarefied.samples)
+    print(f"Rarefied to {depth} reads: {len(rarefied.samples)} samples, {len(rarefied.features)} features"
+        + (f" ({dropped} samples below the depth dropped)" if dropped else ""), file=sys.stderr)
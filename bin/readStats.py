@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Count the reads of FASTQ files and estimate their length, in one streaming pass.
+
+With --min-reads the count stops as soon as the threshold is reached (and
+the length sample is complete), without decompressing the rest of the file.
+Lengths are taken from a sample of the reads (one every --every, at least
+--min-len long). Files are processed concurrently with --threads.
+A summary (TSV, or JSON with --json) is printed, one line per file:
+  file  reads  complete  pass  sampled  min_len  max_len  mean_len  median_len
+where reads is a lower bound when complete is false.
+"""
+import os, sys
+import argparse
+import json
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+from seqReader import readBlocks
+
+FIELDS = ["file", "reads", "complete", "pass", "sampled", "min_len", "max_len", "mean_len", "median_len"]
+
+
+def scanFastq(path, min_reads=0, sample_size=4000, every=1, min_len=0, blocksize=1024 * 1024):
+    """
+    Return the summary of a FASTQ file (4 lines per record) as a dict
+    """
+    lines = 0
+    lengths = []
+    complete = True
+    done = False
+    for block in readBlocks(path, b"\n", blocksize):
+        # Stop before counting a block past the threshold
+        if done:
+            complete = False
+            break
+        if len(lengths) < sample_size:
+            split = block.split(b"\n")
+            if split[-1] == b"":
+                split.pop()
+            # Sequence lines are the second of each record
+            offset = (1 - lines) % 4
+            first = (lines + offset) // 4
+            for read, sequence in enumerate(split[offset::4], first):
+                if read % every == 0:
+                    length = len(sequence.rstrip(b"\r"))
+                    if length >= min_len:
+                        lengths.append(length)
+                        if len(lengths) >= sample_size:
+                            break
+        lines += block.count(b"\n") + (0 if block.endswith(b"\n") else 1)
+        done = min_reads > 0 and lines // 4 >= min_reads and len(lengths) >= sample_size
+    reads = lines // 4
+    lengths = np.array(lengths, dtype=np.int64)
+    return {
+        "file": path,
+        "reads": reads,
+        "complete": complete,
+        "pass": reads >= min_reads,
+        "sampled": len(lengths),
+        "min_len": int(lengths.min()) if len(lengths) else 0,
+        "max_len": int(lengths.max()) if len(lengths) else 0,
+        "mean_len": round(float(lengths.mean()), 1) if len(lengths) else 0,
+        "median_len": float(np.median(lengths)) if len(lengths) else 0,
+    }
+
+
+def formatValue(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Count the reads of FASTQ files (stopping at a threshold) and sample their length")
+    args.add_argument("input", help="Input FASTQ files (plain or gzipped)", nargs="+")
+    args.add_argument("-n", "--min-reads", help="Stop counting once this many reads are found [default: count all]", type=int, default=0)
+    args.add_argument("-s", "--sample-size", help="Reads sampled for the length statistics [default: %(default)s]", type=int, default=4000)
+    args.add_argument("-e", "--every", help="Sample one read every N [default: %(default)s]", type=int, default=1)
+    args.add_argument("-l", "--min-len", help="Minimum length of the sampled reads [default: %(default)s]", type=int, default=0)
+    args.add_argument("-t", "--threads", help="Files processed concurrently [default: %(default)s]", type=int, default=1)
+    args.add_argument("-o", "--output", help="Output file [default: stdout]")
+    args.add_argument("-j", "--json", help="Print the summary as JSON", action="store_true")
+    opts = args.parse_args()
+
+    for path in opts.input:
+        if not os.path.exists(path):
+            print("Error: file not found: " + path, file=sys.stderr)
+            sys.exit(1)
+    if opts.every < 1:
+        print("Error: --every must be at least 1", file=sys.stderr)
+        sys.exit(1)
+
+    scan = partial(scanFastq, min_reads=opts.min_reads, sample_size=opts.sample_size, every=opts.every, min_len=opts.min_len)
+    if opts.threads > 1 and len(opts.input) > 1:
+        with Pool(min(opts.threads, len(opts.input))) as pool:
+            summaries = pool.map(scan, opts.input, chunksize=1)
+    else:
+        summaries = [scan(path) for path in opts.input]
+
+    out = open(opts.output, "w") if opts.output else sys.stdout
+    if opts.json:
+        json.dump(summaries, out, indent=2)
+        out.write("\n")
+    else:
+        out.write("\t".join(FIELDS) + "\n")
+        for summary in summaries:
+            out.write("\t".join(formatValue(summary[field]) for field in FIELDS) + "\n")
+    if out is not sys.stdout:
+        out.close()
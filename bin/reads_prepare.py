@@ -2,14 +2,176 @@
 """
 Prepare the FASTQ reads for USEARCH
 August 2022, Andrea Telatin
+
+Relabel the reads as {sample}.{counter} (both mates get the same name)
+and discard pairs with a mate outside the length range, in a single pass.
+Samples are processed in parallel, output is compressed with pigz when available.
 """
 
 import os, sys
 import argparse
+import shutil
+import subprocess
+from itertools import zip_longest
+from multiprocessing import Pool
+from seqReader import readFastq
+
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+WRITE_BATCH = 10000
+
+
+class PigzWriter:
+    """
+    Compress to a file through a pigz subprocess
+    """
+    def __init__(self, path, threads, level):
+        self.output = open(path, "wb")
+        self.process = subprocess.Popen(["pigz", "-c", "-p", str(threads), f"-{level}"],
+            stdin=subprocess.PIPE, stdout=self.output)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        status = self.process.wait()
+        self.output.close()
+        if status != 0:
+            raise RuntimeError(f"pigz failed with exit status {status}")
+
+
+def openOutput(path, threads=1, level=6):
+    if shutil.which("pigz") is not None:
+        return PigzWriter(path, threads, level)
+    return gzip.open(path, "wb", compresslevel=level)
+
+
+def pairFiles(files, for_tag, rev_tag):
+    """
+    Group the files in (sample, R1, R2) tuples, R2 is None for single end samples
+    """
+    samples = {}
+    for file in files:
+        base = os.path.basename(file)
+        if rev_tag in base:
+            sample, mate = base.split(rev_tag)[0], 1
+        else:
+            sample, mate = base.split(for_tag)[0] if for_tag in base else base.split(".")[0], 0
+        mates = samples.setdefault(sample, [None, None])
+        if mates[mate] is not None:
+            raise ValueError(f"Two {'reverse' if mate else 'forward'} files for sample {sample}: {mates[mate]} and {file}")
+        mates[mate] = file
+    pairs = []
+    for sample, (r1, r2) in samples.items():
+        if r1 is None:
+            raise ValueError(f"Reverse file without forward file for sample {sample}: {r2}")
+        pairs.append((sample, r1, r2))
+    return pairs
+
+
+def prepareSample(job):
+    """
+    Relabel and filter one sample, return (sample, total, kept)
+    """
+    sample, r1, r2, opts = job
+    prefix = (sample + opts["separator"]).encode()
+    min_len, max_len = opts["min_len"], opts["max_len"]
+    outputs = [openOutput(os.path.join(opts["outdir"], f"{sample}{tag}.fastq.gz"), opts["compress_threads"], opts["level"])
+        for tag in (opts["for_tag"], opts["rev_tag"])[:2 if r2 is not None else 1]]
+    readers = [readFastq(r1, raw=True)]
+    if r2 is not None:
+        readers.append(readFastq(r2, raw=True))
+
+    total = kept = 0
+    buffers = [[] for _ in outputs]
+    try:
+        for records in zip_longest(*readers, fillvalue=None):
+            # Both mates must have the same number of records
+            if None in records:
+                raise ValueError(f"{sample}: R1 and R2 have a different number of reads")
+            total += 1
+            lengths = [len(record[2]) for record in records]
+            if min(lengths) < min_len or (max_len > 0 and max(lengths) > max_len):
+                continue
+            kept += 1
+            name = prefix + str(kept).encode()
+            for buffer, (_, comment, sequence, quality) in zip(buffers, records):
+                header = name + b" " + comment if comment and not opts["strip_comments"] else name
+                buffer.append(b"@" + header + b"\n" + sequence + b"\n+\n" + quality + b"\n")
+            if kept % WRITE_BATCH == 0:
+                for output, buffer in zip(outputs, buffers):
+                    output.write(b"".join(buffer))
+                    buffer.clear()
+        for output, buffer in zip(outputs, buffers):
+            output.write(b"".join(buffer))
+    finally:
+        for output in outputs:
+            output.close()
+    return sample, total, kept
+
 
 def main():
     args = argparse.ArgumentParser("Prepare the FASTQ reads for USEARCH")
     args.add_argument("FASTQ", help="FASTQ files", nargs="+")
     args.add_argument("-o", "--output", help="Output directory [default: %(default)s]", default="usearch-reads")
+    args.add_argument("-s", "--sample-name", help="Sample name (only with a single sample) [default: from the filename]")
+    args.add_argument("--separator", help="Separator between sample name and read counter [default: %(default)s]", default=".")
+    args.add_argument("-1", "--for-tag", help="Forward reads tag [default: %(default)s]", default="_R1")
+    args.add_argument("-2", "--rev-tag", help="Reverse reads tag [default: %(default)s]", default="_R2")
+    args.add_argument("-m", "--min-len", help="Discard pairs with a mate shorter than this [default: %(default)s]", type=int, default=1)
+    args.add_argument("-x", "--max-len", help="Discard pairs with a mate longer than this, 0 to disable [default: %(default)s]", type=int, default=0)
+    args.add_argument("--strip-comments", help="Remove the read comments", action="store_true")
+    args.add_argument("-t", "--threads", help="Samples processed in parallel [default: %(default)s]", type=int, default=1)
+    args.add_argument("-z", "--compress-threads", help="Compression threads per output file (pigz) [default: %(default)s]", type=int, default=2)
+    args.add_argument("-l", "--level", help="Compression level [default: %(default)s]", type=int, default=6)
+    opts = args.parse_args()
+
+    for file in opts.FASTQ:
+        if not os.path.isfile(file):
+            print("ERROR: FASTQ file not found: {}".format(file))
+            sys.exit(1)
+
+    try:
+        pairs = pairFiles(opts.FASTQ, opts.for_tag, opts.rev_tag)
+    except ValueError as e:
+        print("ERROR: {}".format(e))
+        sys.exit(1)
+
+    if opts.sample_name is not None:
+        if len(pairs) != 1:
+            print("ERROR: --sample-name requires a single sample, found {}".format(len(pairs)))
+            sys.exit(1)
+        pairs = [(opts.sample_name, pairs[0][1], pairs[0][2])]
+
+    os.makedirs(opts.output, exist_ok=True)
+    settings = {
+        "outdir": opts.output,
+        "separator": opts.separator,
+        "for_tag": opts.for_tag,
+        "rev_tag": opts.rev_tag,
+        "min_len": opts.min_len,
+        "max_len": opts.max_len,
+        "strip_comments": opts.strip_comments,
+        "compress_threads": opts.compress_threads,
+        "level": opts.level,
+    }
+    jobs = [(sample, r1, r2, settings) for sample, r1, r2 in pairs]
+    try:
+        if opts.threads > 1 and len(jobs) > 1:
+            with Pool(min(opts.threads, len(jobs))) as pool:
+                results = pool.map(prepareSample, jobs)
+        else:
+            results = [prepareSample(job) for job in jobs]
+    except ValueError as e:
+        print("ERROR: {}".format(e))
+        sys.exit(1)
+
+    for sample, total, kept in results:
+        print(f"{sample}\t{total}\t{kept}", file=sys.stderr)
+
 if __name__=="__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+FASTA/FASTQ readers shared by the uflow scripts.
+
+Files (plain or gzipped) are read in large binary blocks, records are split
+on the block and sequence lines are joined once per record.
+FastaIndex builds (or reuses) a samtools-style .fai index to check names and
+fetch single sequences without loading the whole file.
+"""
+import os, sys
+
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def isGzipped(path):
+    with open(path, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def openFile(path):
+    """
+    Open a plain or gzipped file for binary reading ("-" for stdin)
+    """
+    if path == "-":
+        return sys.stdin.buffer
+    if isGzipped(path):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def readBlocks(path, separator, blocksize=BLOCK_SIZE):
+    """
+    Yield blocks of complete records, splitting the stream at the last separator of each block
+    """
+    f = openFile(path)
+    overlap = len(separator) - 1
+    try:
+        # Pieces of the current record are joined once, when a separator is
+        # found: a record longer than the block size is not copied at each read
+        pieces = []
+        tail = b""
+        while True:
+            chunk = f.read(blocksize)
+            if not chunk:
+                break
+            pieces.append(chunk)
+            # Search the new data only, with the end of the previous data for a
+            # separator spanning two reads
+            found = (tail + chunk).rfind(separator)
+            if found == -1:
+                tail = (tail + chunk)[-overlap:] if overlap else b""
+                continue
+            block = b"".join(pieces)
+            cut = len(block) - len(chunk) - len(tail) + found
+            tail = block[-overlap:] if overlap else b""
+            pieces = [block[cut + 1:]]
+            yield block[:cut + 1]
+        leftover = b"".join(pieces)
+        if leftover:
+            yield leftover
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+
+def splitHeader(header):
+    parts = header.split(None, 1)
+    if len(parts) == 0:
+        return b"", b""
+    return parts[0], parts[1].strip() if len(parts) > 1 else b""
+
+
+def readFasta(path, raw=False, blocksize=BLOCK_SIZE):
+    """
+    Yield (name, comment, sequence) for each record; bytes if raw, str otherwise
+    """
+    for block in readBlocks(path, b"\n>", blocksize):
+        if block.startswith(b">"):
+            block = block[1:]
+        for record in block.split(b"\n>"):
+            header, _, sequence = record.partition(b"\n")
+            if not header and not sequence:
+                continue
+            name, comment = splitHeader(header)
+            sequence = sequence.replace(b"\n", b"").replace(b"\r", b"")
+            if raw:
+                yield name, comment, sequence
+            else:
+                yield name.decode(), comment.decode(), sequence.decode()
+
+
+def readFastq(path, raw=False, blocksize=BLOCK_SIZE):
+    """
+    Yield (name, comment, sequence, quality) for each record (4-lines FASTQ)
+    """
+    leftover = []
+    for block in readBlocks(path, b"\n", blocksize):
+        lines = block.split(b"\n")
+        if lines[-1] == b"":
+            lines.pop()
+        if leftover:
+            lines = leftover + lines
+        complete = len(lines) - len(lines) % 4
+        leftover = lines[complete:]
+        for i in range(0, complete, 4):
+            header = lines[i].rstrip(b"\r")
+            if not header.startswith(b"@"):
+                raise ValueError(f"{path}: invalid FASTQ header: {header[:50]}")
+            name, comment = splitHeader(header[1:])
+            sequence = lines[i + 1].rstrip(b"\r")
+            quality = lines[i + 3].rstrip(b"\r")
+            if raw:
+                yield name, comment, sequence, quality
+            else:
+                yield name.decode(), comment.decode(), sequence.decode(), quality.decode()
+    if [line for line in leftover if line.strip()]:
+        raise ValueError(f"{path}: truncated FASTQ record")
+
+
+class FastaIndex:
+    """
+    samtools faidx compatible index (name, length, offset, linebases, linewidth),
+    behaving as a read-only mapping from name to sequence
+    """
+    def __init__(self, fasta, save=True):
+        self.fasta_file = fasta
+        self.index_file = fasta + ".fai"
+        self.entries = {}
+        if isGzipped(fasta):
+            raise ValueError(f"Cannot index a gzipped FASTA file: {fasta}")
+        if os.path.exists(self.index_file) and os.path.getmtime(self.index_file) >= os.path.getmtime(fasta):
+            self.load()
+        else:
+            self.build()
+            if save:
+                try:
+                    self.save()
+                except OSError:
+                    pass
+        self._handle = None
+
+    def load(self):
+        with open(self.index_file, "r") as f:
+            for line in f:
+                name, length, offset, linebases, linewidth = line.rstrip("\n").split("\t")[:5]
+                self.entries[name] = (int(length), int(offset), int(linebases), int(linewidth))
+
+    def build(self):
+        entries = {}
+        name = None
+        offset = 0
+        with open(self.fasta_file, "rb") as f:
+            for line in f:
+                if line.startswith(b">"):
+                    if name is not None:
+                        entries[name] = (length, start, linebases, linewidth)
+                    name = splitHeader(line[1:])[0].decode()
+                    start = offset + len(line)
+                    length = linebases = linewidth = 0
+                    last = False
+                elif name is not None:
+                    bases = len(line.rstrip(b"\r\n"))
+                    if bases == 0 and linebases:
+                        last = True
+                    elif bases:
+                        if last:
+                            raise ValueError(f"{self.fasta_file}: different line length in sequence {name}")
+                        if linebases == 0:
+                            linebases, linewidth = bases, len(line)
+                        elif bases != linebases or len(line) != linewidth:
+                            # Only the last line of a sequence can be shorter
+                            last = True
+                            if bases > linebases:
+                                raise ValueError(f"{self.fasta_file}: different line length in sequence {name}")
+                        length += bases
+                offset += len(line)
+        if name is not None:
+            entries[name] = (length, start, linebases, linewidth)
+        self.entries = entries
+
+    def save(self):
+        with open(self.index_file, "w") as f:
+            for name, entry in self.entries.items():
+                f.write(name + "\t" + "\t".join(str(x) for x in entry) + "\n")
+
+    @property
+    def names(self):
+        return list(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, name):
+        length, offset, linebases, linewidth = self.entries[name]
+        if length == 0:
+            return ""
+        if self._handle is None:
+            self._handle = open(self.fasta_file, "rb")
+        size = (length // linebases) * linewidth + length % linebases
+        self._handle.seek(offset)
+        data = self._handle.read(size)
+        return data.replace(b"\n", b"").replace(b"\r", b"").decode()
+
+    def get(self, name, default=None):
+        return self[name] if name in self.entries else default
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
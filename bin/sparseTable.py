@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Binary OTU table shared by the post-processing scripts.
+
+The table is stored in CSR layout (rows are features, columns are samples,
+as in the TSV tables) in an uncompressed .npz container:
+  indptr, indices, data   CSR arrays
+  features, samples       names
+  index_name              name of the first column (e.g. "#OTU ID")
+
+As the members are not compressed they can be memory mapped directly from
+the container, so loading a table does not copy or parse the counts.
+"""
+import os, sys
+import zipfile
+from array import array
+import numpy as np
+
+FORMAT = "uflow-csr-1"
+
+
+def binaryPath(path):
+    """
+    Return the path of the binary table stored next to a TSV table
+    """
+    return os.path.splitext(path)[0] + ".npz"
+
+
+def countsDtype(data):
+    """
+    Smallest unsigned type for integer counts, float64 otherwise
+    """
+    if len(data) == 0:
+        return np.uint32
+    if np.all(data >= 0) and np.all(np.mod(data, 1) == 0):
+        return np.uint32 if data.max() < 2**32 else np.uint64
+    return np.float64
+
+
+def formatRow(indices, values, size):
+    """
+    Cells of a row as text: integer counts as %d, floats as their repr
+    (as pandas writes them). Zeros not stored are "0", as in the input
+    tables (stored zeros, e.g. "0.0", keep their float format).
+    """
+    cells = ["0"] * size
+    text = map(str, values.tolist()) if values.dtype.kind in "ui" else map(repr, values.tolist())
+    for col, cell in zip(indices.tolist(), text):
+        cells[col] = cell
+    return cells
+
+
+class SparseTable:
+    def __init__(self, features, samples, indptr, indices, data, index_name="#OTU ID"):
+        self.features = list(features)
+        self.samples = list(samples)
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.index_name = index_name
+
+    @property
+    def shape(self):
+        return len(self.features), len(self.samples)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    @classmethod
+    def fromDense(cls, features, samples, matrix, index_name="#OTU ID"):
+        matrix = np.asarray(matrix)
+        rows, cols = np.nonzero(matrix)
+        indptr = np.zeros(matrix.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=matrix.shape[0]), out=indptr[1:])
+        data = matrix[rows, cols]
+        return cls(features, samples, indptr, cols.astype(np.int32), data.astype(countsDtype(data)), index_name)
+
+    def rowIds(self):
+        """
+        Row (feature) index of each stored value
+        """
+        return np.repeat(np.arange(len(self.features)), np.diff(self.indptr))
+
+    def row(self, i):
+        """
+        Return (sample indices, values) of a feature
+        """
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def subset(self, feature_mask, sample_mask, entry_mask=None):
+        """
+        Return a new table with the selected features and samples
+        (and, if entry_mask is given, only the selected stored values)
+        """
+        feature_mask = np.asarray(feature_mask, dtype=bool)
+        sample_mask = np.asarray(sample_mask, dtype=bool)
+        rows = self.rowIds()
+        keep = feature_mask[rows] & sample_mask[self.indices]
+        if entry_mask is not None:
+            keep &= entry_mask
+        new_rows = (np.cumsum(feature_mask) - 1)[rows[keep]]
+        new_cols = (np.cumsum(sample_mask) - 1)[self.indices[keep]]
+        nfeatures = int(feature_mask.sum())
+        indptr = np.zeros(nfeatures + 1, dtype=np.int64)
+        np.cumsum(np.bincount(new_rows, minlength=nfeatures), out=indptr[1:])
+        return SparseTable([f for f, k in zip(self.features, feature_mask) if k],
+            [s for s, k in zip(self.samples, sample_mask) if k],
+            indptr, new_cols.astype(np.int32), np.asarray(self.data)[keep], self.index_name)
+
+    def hstack(self, other):
+        """
+        Return a new table with the samples of other added after those of this table.
+        Features are joined by name: the new ones are added after the existing ones.
+        """
+        overlap = set(self.samples) & set(other.samples)
+        if overlap:
+            raise ValueError("Samples already in the table: " + ", ".join(sorted(overlap)[:5]))
+        index = {feature: i for i, feature in enumerate(self.features)}
+        features = list(self.features)
+        mapping = np.empty(len(other.features), dtype=np.int64)
+        for i, feature in enumerate(other.features):
+            row = index.get(feature)
+            if row is None:
+                row = index[feature] = len(features)
+                features.append(feature)
+            mapping[i] = row
+        rows = np.concatenate([self.rowIds(), mapping[other.rowIds()]])
+        cols = np.concatenate([np.asarray(self.indices, dtype=np.int64), np.asarray(other.indices, dtype=np.int64) + len(self.samples)])
+        data = np.concatenate([np.asarray(self.data), np.asarray(other.data)])
+        return SparseTable._fromCoo(features, self.samples + other.samples, rows, cols, data, self.index_name)
+
+    def sortSamples(self):
+        """
+        Return a new table with the samples sorted by name
+        """
+        order = sorted(range(len(self.samples)), key=lambda col: self.samples[col])
+        position = np.empty(len(order), dtype=np.int64)
+        position[order] = np.arange(len(order))
+        return SparseTable._fromCoo(self.features, [self.samples[col] for col in order],
+            self.rowIds(), position[np.asarray(self.indices, dtype=np.int64)], np.asarray(self.data), self.index_name)
+
+    @classmethod
+    def _fromCoo(cls, features, samples, rows, cols, data, index_name):
+        order = np.lexsort((cols, rows))
+        indptr = np.zeros(len(features) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(features)), out=indptr[1:])
+        data = data[order]
+        return cls(features, samples, indptr, cols[order].astype(np.int32), data.astype(countsDtype(data)), index_name)
+
+    def toCsc(self):
+        """
+        Return the table by sample: (colptr, feature indices, values)
+        """
+        order = np.argsort(self.indices, kind="stable")
+        colptr = np.zeros(len(self.samples) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices, minlength=len(self.samples)), out=colptr[1:])
+        return colptr, self.rowIds()[order], np.asarray(self.data)[order]
+
+    def blocks(self, rows, dtype=np.float64):
+        """
+        Yield (features, dense block) rows at a time
+        """
+        for start in range(0, len(self.features), rows):
+            end = min(start + rows, len(self.features))
+            block = np.zeros((end - start, len(self.samples)), dtype=dtype)
+            lo, hi = self.indptr[start], self.indptr[end]
+            local = np.repeat(np.arange(end - start), np.diff(self.indptr[start:end + 1]))
+            block[local, self.indices[lo:hi]] = self.data[lo:hi]
+            yield self.features[start:end], block
+
+    def toDense(self, dtype=None):
+        dense = np.zeros(self.shape, dtype=dtype if dtype is not None else self.data.dtype)
+        dense[self.rowIds(), self.indices] = self.data
+        return dense
+
+    def sampleTotals(self):
+        return np.bincount(self.indices, weights=self.data, minlength=len(self.samples))
+
+    def featureTotals(self):
+        return np.bincount(self.rowIds(), weights=self.data, minlength=len(self.features))
+
+    def save(self, path):
+        np.savez(path,
+            format=np.array(FORMAT),
+            index_name=np.array(self.index_name),
+            features=np.array(self.features, dtype=str),
+            samples=np.array(self.samples, dtype=str),
+            indptr=np.asarray(self.indptr, dtype=np.int64),
+            indices=np.asarray(self.indices, dtype=np.int32),
+            data=np.asarray(self.data))
+
+    def writeTsv(self, f, sep="\t"):
+        """
+        Stream the table as text, one feature at a time
+        """
+        f.write(self.index_name + sep + sep.join(self.samples) + "\n")
+        for i, feature in enumerate(self.features):
+            f.write(feature + sep + sep.join(formatRow(*self.row(i), len(self.samples))) + "\n")
+
+
+class SparseTableWriter:
+    """
+    Build a SparseTable one feature at a time (e.g. while streaming a merge)
+    """
+    def __init__(self, samples, index_name="#OTU ID"):
+        self.samples = list(samples)
+        self.index_name = index_name
+        self.features = []
+        self.indptr = array("q", [0])
+        self.indices = array("i")
+        self.data = array("d")
+        # Values written as floats in the text (e.g. "5.0"): keep the table float
+        self.floats = False
+
+    def addRow(self, feature, values):
+        """
+        Add a feature from its values (one per sample, as strings or numbers)
+        """
+        cols = [col for col, val in enumerate(values) if val != "0" and val != 0]
+        if not self.floats:
+            self.floats = not all(str(values[col]).isdigit() for col in cols)
+        self.indices.extend(cols)
+        self.data.extend([float(values[col]) for col in cols])
+        self.features.append(feature)
+        self.indptr.append(len(self.indices))
+
+    def table(self):
+        data = np.frombuffer(self.data, dtype=np.float64)
+        return SparseTable(self.features, self.samples,
+            np.frombuffer(self.indptr, dtype=np.int64),
+            np.frombuffer(self.indices, dtype=np.int32),
+            data if self.floats else data.astype(countsDtype(data)), self.index_name)
+
+    def save(self, path):
+        self.table().save(path)
+
+
+def _mmapMember(path, archive, name):
+    """
+    Memory map an array stored (uncompressed) in a .npz file
+    """
+    info = archive.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        with archive.open(name) as f:
+            return np.lib.format.read_array(f)
+    with open(path, "rb") as f:
+        # Skip the local file header to reach the .npy payload
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_len = int.from_bytes(header[26:28], "little")
+        extra_len = int.from_bytes(header[28:30], "little")
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if dtype.hasobject:
+        raise ValueError(f"{path}: {name} is not a plain array")
+    if int(np.prod(shape)) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape,
+        order="F" if fortran else "C")
+
+
+def loadNpz(path, mmap=True):
+    """
+    Load a binary table; the CSR arrays are memory mapped unless mmap is False
+    """
+    with zipfile.ZipFile(path) as archive:
+        if mmap:
+            arrays = {name[:-4]: _mmapMember(path, archive, name) for name in archive.namelist()}
+        else:
+            arrays = {name[:-4]: np.lib.format.read_array(archive.open(name)) for name in archive.namelist()}
+    if "format" not in arrays or str(arrays["format"][()]) != FORMAT:
+        raise ValueError(f"{path} is not a binary OTU table")
+    return SparseTable(arrays["features"].tolist(), arrays["samples"].tolist(),
+        arrays["indptr"], arrays["indices"], arrays["data"], str(arrays["index_name"][()]))
+
+
+def readTsv(path, sep="\t"):
+    """
+    Parse a text OTU table (first line is the header, first column the feature IDs)
+    """
+    writer = None
+    with open(path, "r") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if writer is None:
+                header = line.split(sep)
+                writer = SparseTableWriter(header[1:], header[0])
+                continue
+            if line == "":
+                continue
+            fields = line.split(sep)
+            writer.addRow(fields[0], fields[1:])
+    if writer is None:
+        raise ValueError(f"{path} is empty")
+    return writer.table()
+
+
+def loadTable(path, sep="\t"):
+    """
+    Load an OTU table, binary (.npz) or text
+    """
+    if path.endswith(".npz"):
+        return loadNpz(path)
+    return readTsv(path, sep)
+
+
+if __name__ == "__main__":
+    import argparse
+    args = argparse.ArgumentParser(description="Convert an OTU table between TSV and the binary (.npz) format")
+    args.add_argument("-i", "--input", help="Input OTU table (.npz or text)", required=True)
+    args.add_argument("-o", "--output", help="Output OTU table (.npz for binary, text otherwise)", required=True)
+    args.add_argument("-s", "--separator", help="Separator of text tables [default: tab]", default="\t")
+    args = args.parse_args()
+
+    if not os.path.isfile(args.input):
+        print("Error: OTU table file not found: " + args.input)
+        sys.exit(1)
+
+    table = loadTable(args.input, args.separator)
+    if args.output.endswith(".npz"):
+        table.save(args.output)
+    else:
+        with open(args.output, "w") as f:
+            table.writeTsv(f, args.separator)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Taxonomy assignment with a persistent cache.
+
+Each sequence is looked up by the hash of its sequence and the checksum of the
+reference database, only the sequences not found in the cache are classified
+(running the classifier command on them), and their taxonomy is added to the
+cache. The taxonomy of all the sequences is then written in the input order,
+in the same format produced by the classifier (taxonomy.tsv).
+
+The cache is an SQLite database in the cache directory, shared between runs;
+when it grows over --max-size the least recently used entries are removed.
+"""
+import os, sys
+import argparse
+import hashlib
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+from seqReader import readFasta
+from parseDb import cachedChecksum
+
+BATCH = 500
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS taxonomy (db TEXT, seq TEXT, ranks TEXT, used INTEGER, PRIMARY KEY (db, seq))",
+    "CREATE TABLE IF NOT EXISTS headers (db TEXT PRIMARY KEY, header TEXT)",
+]
+
+
+def sequenceHash(sequence):
+    return hashlib.sha1(sequence.upper().encode()).hexdigest()
+
+
+def readTaxonomy(path):
+    """
+    Read a classifier taxonomy table: return the header line and, for each
+    row, the line without its first field (the row number)
+    """
+    with open(path, "r") as f:
+        header = f.readline().rstrip("\r\n")
+        rows = []
+        for line in f:
+            line = line.strip("\r\n").lstrip()
+            if line == "":
+                continue
+            rows.append(line[len(line.split(None, 1)[0]):])
+    return header, rows
+
+
+class TaxonomyCache:
+    def __init__(self, directory, timeout=600):
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "taxonomy.sqlite"), timeout=timeout)
+        with self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+
+    def header(self, db):
+        row = self.db.execute("SELECT header FROM headers WHERE db = ?", (db,)).fetchone()
+        return None if row is None else row[0]
+
+    def lookup(self, db, keys):
+        """
+        Return a dict key -> ranks of the keys found in the cache (marking them as used)
+        """
+        keys = list(keys)
+        found = {}
+        for start in range(0, len(keys), BATCH):
+            batch = keys[start:start + BATCH]
+            query = "SELECT seq, ranks FROM taxonomy WHERE db = ? AND seq IN ({})".format(",".join("?" * len(batch)))
+            found.update(self.db.execute(query, [db] + batch).fetchall())
+        now = int(time.time())
+        with self.db:
+            self.db.executemany("UPDATE taxonomy SET used = ? WHERE db = ? AND seq = ?", [(now, db, key) for key in found])
+        return found
+
+    def store(self, db, header, entries):
+        now = int(time.time())
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO headers VALUES (?, ?)", (db, header))
+            self.db.executemany("INSERT OR REPLACE INTO taxonomy VALUES (?, ?, ?, ?)",
+                [(db, key, ranks, now) for key, ranks in entries.items()])
+
+    def evict(self, max_bytes):
+        """
+        Remove the least recently used entries beyond max_bytes of stored data, return their number
+        """
+        with self.db:
+            removed = self.db.execute("""
+                DELETE FROM taxonomy WHERE rowid IN (
+                    SELECT rowid FROM (
+                        SELECT rowid, SUM(LENGTH(db) + LENGTH(seq) + LENGTH(ranks) + 8)
+                            OVER (ORDER BY used DESC, rowid DESC) AS total FROM taxonomy)
+                    WHERE total > ?)""", (max_bytes,)).rowcount
+            self.db.execute("DELETE FROM headers WHERE db NOT IN (SELECT DISTINCT db FROM taxonomy)")
+        return removed
+
+    def close(self):
+        self.db.close()
+
+
+def classify(command, sequences, table, workdir):
+    """
+    Run the classifier command on {key: sequence}, return the header and {key: ranks}
+    """
+    fasta = os.path.join(workdir, "seqs.fa")
+    outdir = os.path.join(workdir, "taxonomy")
+    with open(fasta, "w") as f:
+        for i, sequence in enumerate(sequences.values()):
+            f.write(f">seq{i + 1}\n{sequence}\n")
+    status = subprocess.call(command.format(input=fasta, outdir=outdir), shell=True)
+    if status != 0:
+        raise RuntimeError(f"Classifier failed with exit status {status}")
+    header, rows = readTaxonomy(os.path.join(outdir, table))
+    if len(rows) != len(sequences):
+        raise RuntimeError(f"Classifier returned {len(rows)} rows for {len(sequences)} sequences")
+    return header, dict(zip(sequences, rows))
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Assign the taxonomy with a persistent cache of the classified sequences")
+    args.add_argument("-i", "--input", help="Input FASTA file (ASVs)", required=True)
+    args.add_argument("-d", "--database", help="Reference database file", required=True)
+    args.add_argument("-c", "--cache", help="Cache directory", required=True)
+    args.add_argument("-o", "--outdir", help="Output directory [default: %(default)s]", default="taxonomy")
+    args.add_argument("-x", "--classifier", help="Classifier command, with {input} FASTA and {outdir} placeholders")
+    args.add_argument("--table", help="Taxonomy table written by the classifier [default: %(default)s]", default="taxonomy.tsv")
+    args.add_argument("--max-size", help="Maximum size of the cache in MB [default: %(default)s]", type=float, default=1024)
+    opts = args.parse_args()
+
+    for file in [opts.input, opts.database]:
+        if not os.path.exists(file):
+            print("Error: file not found: " + file)
+            sys.exit(1)
+
+    cache = TaxonomyCache(opts.cache)
+    # Checksum of the database, memoized in the cache directory (as parseDb.py --cache)
+    db = cachedChecksum(opts.database, opts.cache)
+    records = [sequence for _, _, sequence in readFasta(opts.input)]
+    keys = [sequenceHash(sequence) for sequence in records]
+    sequences = dict(zip(keys, records))
+    taxonomy = cache.lookup(db, sequences)
+    header = cache.header(db)
+
+    misses = {key: sequence for key, sequence in sequences.items() if key not in taxonomy}
+    print(f"Cache hits: {len(sequences) - len(misses)}/{len(sequences)}", file=sys.stderr)
+    if misses or (header is None and sequences):
+        if opts.classifier is None:
+            print("Error: {} sequences not in the cache and no classifier given".format(len(misses)))
+            sys.exit(1)
+        workdir = tempfile.mkdtemp(prefix="taxcache.", dir=".")
+        try:
+            # Without a stored header, classify at least one sequence to get it
+            header, new = classify(opts.classifier, misses or dict([next(iter(sequences.items()))]), opts.table, workdir)
+        except RuntimeError as e:
+            print("Error: {}".format(e))
+            sys.exit(1)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        cache.store(db, header, new)
+        taxonomy.update(new)
+
+    os.makedirs(opts.outdir, exist_ok=True)
+    with open(os.path.join(opts.outdir, opts.table), "w") as f:
+        if header is not None:
+            f.write(header + "\n")
+        for i, key in enumerate(keys):
+            f.write(f"{i + 1}{taxonomy[key]}\n")
+
+    removed = cache.evict(int(opts.max_size * 1024 * 1024))
+    if removed:
+        print(f"Removed {removed} entries from the cache", file=sys.stderr)
+    cache.close()
@@ -12,6 +12,20 @@ params.forward    = "CTTGGTCATTTAGAGGAAGTAA"
 params.reverse    = "GCTGCGTTCTTCATCGATGC"  
 
 params.skip_uncross = false
+params.merge_shard_size = 500
+params.usearch_alpha = false
+params.usearch_beta = true
+params.usearch_distmx = true
+params.fused      = false
+params.biom       = false
+params.exact_otutab = true
+params.rarefy     = false
+params.rarefy_depth = false
+params.rarefy_iterations = 10
+params.tax_cache  = false
+params.tax_cache_size = 1024
+params.qc_cache   = false
+params.db_cache   = false
       
 // prints to the screen and to the log
 log.info """
@@ -31,8 +45,8 @@ log.info """
 
 def dbPath = file(db, checkIfExists: true)
  /*    Modules  */
-include { CUTADAPT; ITSX; MERGE; RELABEL; FASTP; FILT; DEREP; UNOISE;  } from './modules/amplicon'
-include {  OTUTABLE; JOINTAB; NORM; ADDTAX; UNCROSS; TABSTATS; OCTAVE; ALPHA; BETA; TRIM } from './modules/otutab'
+include { CUTADAPT; ITSX; MERGE; RELABEL; FASTP; FILT; DEREP; DEREPMERGE; UNOISE;  } from './modules/amplicon'
+include {  OTUTABLE; MERGESHARD; JOINTAB; NORM; ADDTAX; POSTPROCESS; UNCROSS; TABSTATS; OCTAVE; ALPHA; BETA; TRIM; RAREFY } from './modules/otutab'
 include { TAX } from './modules/dadaist'
 reads = Channel
         .fromFilePairs(reads, checkIfExists: true)
@@ -65,23 +79,42 @@ workflow {
       READS = MERGE(CLEAN.out)
   }
   FILT(READS)
-  DEREP(FILT.out.map{it -> it[1]}.collect())
-  UNOISE(DEREP.out)
+  // Map reduce: dereplicate each sample, then merge the unique sequences
+  DEREP(FILT.out)
+  DEREPMERGE(DEREP.out.collect())
+  UNOISE(DEREPMERGE.out)
   TAX(UNOISE.out, dbPath)
   OTUTABLE(READS, UNOISE.out)
 
-  JOINTAB(OTUTABLE.out.map{it -> it[1]}.collect())
-  UNCROSS(JOINTAB.out, params.skip_uncross)
+  // Tree reduce: merge shards of per-sample tables, then join the partial tables.
+  // Tables and partials are sorted by name, so the rows and columns are in the
+  // same order as a single merge whatever the order the tasks complete in
+  SHARDS = OTUTABLE.out.map{it -> it[1]}
+    .toSortedList{ a, b -> a.name <=> b.name }
+    .flatMap{ tabs -> tabs.collate(params.merge_shard_size).withIndex().collect{ shard, i -> [i, shard] } }
+  MERGESHARD(SHARDS)
+  JOINTAB(MERGESHARD.out.toSortedList{ a, b -> a.name <=> b.name })
+  UNCROSS(JOINTAB.out.table, params.skip_uncross)
   
-  TRIM(UNCROSS.out.table)
+  if (params.fused) {
+    // Trim, normalize and annotate loading the table once
+    POSTPROCESS(UNCROSS.out.table, TAX.out, UNOISE.out)
+    TRIMMED = POSTPROCESS.out.trimmed
+  } else {
+    TRIM(UNCROSS.out.table)
+    TRIMMED = TRIM.out
+    NORM(TRIM.out)
+    ADDTAX(NORM.out, TAX.out, UNOISE.out)
+  }
 
-  TABSTATS(TRIM.out)
-  ALPHA(TRIM.out)
-  BETA(TRIM.out)
+  TABSTATS(TRIMMED)
+  if (params.rarefy) {
+    RAREFY(TRIMMED)
+  }
+  ALPHA(TRIMMED)
+  BETA(TRIMMED)
   
-  OCTAVE(TRIM.out, UNOISE.out)
-  NORM(TRIM.out)
-  ADDTAX(NORM.out, TAX.out, UNOISE.out)
+  OCTAVE(TRIMMED, UNOISE.out)
   
   //TRACKFILES(FASTP.out.json.mix( KRAKEN2_HOST.out.txt, CONTAMLOG ).collect() )
   //MULTIQC( FASTP.out.json.mix( KRAKEN2_REPORT.out, TRACKFILES.out ).collect() )
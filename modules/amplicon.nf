@@ -73,8 +73,7 @@ process RELABEL {
     script:
     """
     mkdir -p out
-    seqfu cat -p ${sample_id}. -z ${reads[0]}  | gzip -c > out/${sample_id}_R1.fastq.gz
-    seqfu cat -p ${sample_id}. -z ${reads[1]}  | gzip -c > out/${sample_id}_R2.fastq.gz
+    reads_prepare.py -s ${sample_id} -z ${Math.max(1, task.cpus.intdiv(2))} -o out ${reads[0]} ${reads[1]}
     """
 }
 
@@ -124,7 +123,23 @@ process FILT {
 
 
 process DEREP {
-    tag "filter $sample_id"
+    tag "derep $sample_id"
+    label 'process_low'
+
+    input:
+    tuple val(sample_id), path(reads)
+
+    
+    output:
+    path("${sample_id}.derep.fa")
+    
+    script:
+    """
+    derep.py -i ${reads} -o ${sample_id}.derep.fa
+    """    
+}
+
+process DEREPMERGE {
     label 'process_medium'
 
     input:
@@ -136,7 +151,8 @@ process DEREP {
     
     script:
     """
-    seqfu cat *.fa | seqfu derep > uniques.fasta
+    # unoise3 discards the uniques below its -minsize (8)
+    derepMerge.py -i *.derep.fa -o uniques.fasta --min-size 8
     """    
 }
 process UNOISE {
@@ -1,5 +1,5 @@
 process GETLEN {
-    /* get estimate read length of the reads */
+    /* get estimate read length of the reads, from the readStats.py summaries of MINREADS */
     input:
     path("*")
 
@@ -8,7 +8,9 @@ process GETLEN {
 
     script:
     """
-    seqfu cat --min-len 30 | seqfu head --skip 2 -n 4000 * | seqfu stats | cut -f 10 | tail -n 1 > len.txt
+    # Longest of the sampled reads (column max_len) across the samples
+    awk -F '\\t' 'FNR > 1 && \$7 > max { max = \$7 } END { if (max > 0) print max }' * > len.txt
+    [[ -s len.txt ]] || rm len.txt
     """
 }
 process MINREADS {
@@ -21,14 +23,16 @@ process MINREADS {
     
     output:
     tuple val(sample_id), path("pass/${sample_id}_R*.fastq.gz"), emit: reads optional true 
+    path("${sample_id}.readstats.tsv"), emit: stats
     
     script:
-    // # TOT=\$(seqfu count ${reads[0]} ${reads[1]} | cut -f 2 )
+    // Stops reading at the threshold, also samples the read lengths (for GETLEN)
     """
-    TOT=\$(seqfu head -n ${min} ${reads[0]} | seqfu count | cut -f 2 )
+    readStats.py -n ${min} --min-len 30 -o ${sample_id}.readstats.tsv ${reads[0]}
 
     mkdir -p pass
-    if [[ \$TOT -eq ${min} ]]; then
+    # Column pass of the summary
+    if [[ \$(cut -f 4 ${sample_id}.readstats.tsv | tail -n 1) == "true" ]]; then
         mv ${reads[0]} pass/${sample_id}_R1.fastq.gz
         mv ${reads[1]} pass/${sample_id}_R2.fastq.gz
     fi
@@ -138,9 +142,12 @@ process TRACKFILES {
 
     output:
     path 'summary_mqc.txt'
+    path 'uflow_metrics_mqc.txt', optional: true
 
     script:
+    def cache = params.qc_cache ? "-c ${params.qc_cache}" : ""
+    def metrics = params.metrics ? "-m ${params.metrics}" : ""
     """
-    multiqctable.py -j *json
+    multiqctable.py -j *json -t ${task.cpus} ${cache} ${metrics}
     """
 } 
\ No newline at end of file
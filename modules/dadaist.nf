@@ -13,8 +13,16 @@ process TAX {
     path("taxonomy"), optional: true
     
     script:
+    def prepare = params.db_cache ? "-c ${params.db_cache}" : ""
+    if (params.tax_cache)
     """
-    parseDb.py -i DB
+    parseDb.py -i DB ${prepare}
+    taxCache.py -i seqs.fa -d DB -c ${params.tax_cache} --max-size ${params.tax_cache_size} -o taxonomy \\
+      -x "dadaist2-assigntax -i {input} --outdir {outdir} -t ${task.cpus} --reference DB.*"
+    """
+    else
+    """
+    parseDb.py -i DB ${prepare}
     dadaist2-assigntax -i seqs.fa --outdir taxonomy -t ${task.cpus} --reference DB.*
     """    
 }
\ No newline at end of file
@@ -30,7 +30,7 @@ process KRAKEN2_HOST {
       --classified-out ${sample_id}-human#.fq \\
       --report ${sample_id}.host.report \\
       --memory-mapping --paired ${reads[0]} ${reads[1]} 2> ${sample_id}.host.log | \\
-      countClass.py -c "Human" -u "Non-human" -o ${sample_id}.host.txt
+      countClass.py -b -c "Human" -u "Non-human" -o ${sample_id}.host.txt
     
     pigz -p ${task.cpus} *.fq
     """  
@@ -70,11 +70,12 @@ process COMBINE_KRAKEN {
 
     
     output:
-    path("kraken-report.tsv")
+    path("kraken-report.tsv"), emit: report
+    path("kraken-matrix.tsv"), emit: matrix
      
     script:
     """
-    combine_kreports.py --reports *.kraken2.tsv -o kraken-report.tsv
+    combineReports.py -i *.kraken2.tsv -o kraken-report.tsv -m kraken-matrix.tsv -t ${task.cpus}
     """  
 }
 process COMBINE_BRACKEN {
@@ -88,11 +89,12 @@ process COMBINE_BRACKEN {
 
     
     output:
-    path("kraken-report.tsv")
+    path("bracken-report.tsv"), emit: report
+    path("bracken-matrix.tsv"), emit: matrix
      
     script:
     """
-    combine_bracken_outputs.py --files *.bracken.* -o bracken-report.tsv
+    combineReports.py -i *.bracken.* -k bracken -o bracken-report.tsv -m bracken-matrix.tsv -t ${task.cpus}
     """  
 }
 
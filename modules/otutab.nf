@@ -1,16 +1,35 @@
+process MERGESHARD {
+    label 'process_low'
+
+    input:
+    tuple val(shard), path(tabs)
+    
+    output:
+    path("partial_*.tsv")
+
+    script:
+    // Zero padded, so that the partial tables sort in shard order
+    def partial = String.format("partial_%06d.tsv", shard)
+    """
+    printf '%s\\n' ${tabs} > tables.txt
+    mergeTables.py --sample-from-header --otuid "#OTU ID" -j ${task.cpus} -l tables.txt -o ${partial}
+    """        
+}
+
 process JOINTAB {
     label 'process_low'
     publishDir "$params.outdir/", 
         mode: 'copy'
     input:
-    path("*.tab")
+    path(partials)
     
     output:
-    path("rawtable.tsv")
+    path("rawtable.tsv"), emit: table
 
     script:
     """
-    mergeTables.py -v --sort --sample-from-header --otuid "#OTU ID" -o rawtable.tsv *.tab
+    printf '%s\\n' ${partials} > tables.txt
+    mergeTables.py -v --sort --sample-from-header --otuid "#OTU ID" -j ${task.cpus} -l tables.txt -o rawtable.tsv
     """        
 }
 
@@ -43,6 +62,13 @@ process OTUTABLE {
     tuple val(sample_id), path("${sample_id}.tab")
     
     script:
+    if (params.exact_otutab)
+    """
+    # Count the reads identical to an ASV, only the others go through usearch
+    exactOtutab.py -i ${reads[0]} -a asv.fasta -s ${sample_id} -o ${sample_id}.tab \\
+      -x "usearch -otutab {input} -otutabout {output} -otus asv.fasta -threads ${task.cpus}"
+    """
+    else
     """
     usearch -otutab ${reads[0]} -otutabout table.tmp -otus asv.fasta -threads ${task.cpus}
     # Fix sample name: remplace the second column of the fist line by the sample name
@@ -83,6 +109,26 @@ process TRIM {
     """
 }
 
+process RAREFY {
+    label 'process_medium'
+    publishDir "$params.outdir/diversity/",
+        mode: 'copy'
+
+    input:
+    path("otutab.txt")
+
+    output:
+    path("otutable_rarefied.tsv"), emit: table
+    path("rarefaction_curves.tsv"), emit: curves
+
+    script:
+    def depth = params.rarefy_depth ? "-d ${params.rarefy_depth}" : ""
+    """
+    rarefy.py -i otutab.txt -o otutable_rarefied.tsv ${depth} -n ${params.rarefy_iterations} \\
+      -c rarefaction_curves.tsv -t ${task.cpus}
+    """
+}
+
 process OCTAVE {
     label 'process_high'
     publishDir "$params.outdir/info/",
@@ -96,9 +142,13 @@ process OCTAVE {
     output:
     path("octave.*"),  optional: true
 
+    script:
+    def distmx = params.usearch_distmx ?
+        "usearch -calc_distmx seqs.fa -tabbedout distmx.txt -maxdist 0.2 -termdist 0.3 -threads ${task.cpus}" :
+        "distanceMatrix.py -i seqs.fa -o distmx.txt --maxdist 0.2 --termdist 0.3 -t ${task.cpus}"
     """
     set +e
-    usearch -calc_distmx seqs.fa -tabbedout distmx.txt -maxdist 0.2 -termdist 0.3 -threads ${task.cpus} || touch fail.txt
+    ${distmx} || touch fail.txt
     if [[ ! -e fail.txt ]]; then
         usearch -otutab_octave otutab.txt -distmxin distmx.txt \
             -htmlout octave.html -svgout octave.svg || true
@@ -117,9 +167,15 @@ process ALPHA {
     output:
     path("alpha.txt"),  optional: true
 
-    """
-    usearch -alpha_div otutab.txt -output alpha.txt
-    """
+    script:
+    if (params.usearch_alpha)
+        """
+        usearch -alpha_div otutab.txt -output alpha.txt
+        """
+    else
+        """
+        alphaDiversity.py -i otutab.txt -o alpha.txt -t ${task.cpus}
+        """
 } 
 
 process BETA {
@@ -134,9 +190,15 @@ process BETA {
     output:
     path("*.{txt,tree}"),  optional: true
 
-    """
-    usearch -beta_div otutab.tab -metrics jaccard,bray_curtis
-    """
+    script:
+    if (params.usearch_beta)
+        """
+        usearch -beta_div otutab.tab -metrics jaccard,bray_curtis
+        """
+    else
+        """
+        betaDiversity.py -i otutab.tab -m jaccard,bray_curtis -t ${task.cpus}
+        """
 } 
 
 process UNCROSS {
@@ -188,4 +250,28 @@ process ADDTAX {
     """    
 }
 
+process POSTPROCESS {
+    label 'process_medium'
+    publishDir "$params.outdir/", 
+        mode: 'copy', pattern: "{table_relative_tax.tsv,export}"
+
+    input:
+    path("otutab.txt")
+    path("taxonomy")
+    path("asv.fa")
 
+    output:
+    path("otutable.tsv"), emit: trimmed
+    path("freq_table.tsv"), emit: normalized
+    path("table_relative_tax.tsv"), emit: taxonomy
+    path("export"), emit: export
+
+    script:
+    def biom = params.biom ? "--biom" : ""
+    """
+    processTable.py -i otutab.txt -f asv.fa -t taxonomy/taxonomy.tsv \
+      --min-sample-size 1000 --min-freq 0.0005 --min-otu-size 10 \
+      --trimmed otutable.tsv --normalized freq_table.tsv -o table_relative_tax.tsv \
+      --export export ${biom}
+    """
+}
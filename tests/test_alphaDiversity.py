@@ -0,0 +1,67 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+from alphaDiversity import METRICS, alphaDiversity, formatValue
+from sparseTable import SparseTable
+
+
+def formatted(table):
+    alpha = alphaDiversity(table)
+    return {sample: {metric: formatValue(metric, alpha[metric][i]) for metric in METRICS}
+        for i, sample in enumerate(table.samples)}
+
+
+def test_metrics_by_hand():
+    # S1: 5, 3, 1, 1 (two singletons); S2: 4, 2, 2 (no singleton); S3 empty; S4 one OTU
+    table = SparseTable.fromDense(["A", "B", "C", "D"], ["S1", "S2", "S3", "S4"], [
+        [5, 0, 0, 7],
+        [3, 4, 0, 0],
+        [1, 2, 0, 0],
+        [1, 2, 0, 0],
+    ])
+    alpha = formatted(table)
+    assert alpha["S1"] == {
+        "richness": "4", "chao1": "5.0000", "berger_parker": "0.5000", "buzas_gibson": "0.8041",
+        "dominance": "0.6400", "equitability": "0.8427", "jost": "2.7778", "jost1": "3.2165",
+        "reads": "10", "robbins": "0.1818", "simpson": "0.3600", "shannon_2": "1.6855",
+        "shannon_e": "1.1683", "shannon_10": "0.5074",
+    }
+    assert alpha["S2"] == {
+        "richness": "3", "chao1": "3.0000", "berger_parker": "0.5000", "buzas_gibson": "0.9428",
+        "dominance": "0.6250", "equitability": "0.9464", "jost": "2.6667", "jost1": "2.8284",
+        "reads": "8", "robbins": "0.0000", "simpson": "0.3750", "shannon_2": "1.5000",
+        "shannon_e": "1.0397", "shannon_10": "0.4515",
+    }
+    assert alpha["S3"]["richness"] == "0" and alpha["S3"]["reads"] == "0"
+    assert all(alpha["S3"][metric] == "0.0000" for metric in METRICS if metric not in ("richness", "reads"))
+    assert [alpha["S4"][metric] for metric in ("shannon_2", "shannon_e", "shannon_10", "jost", "jost1")] == \
+        ["0.0000", "0.0000", "0.0000", "1.0000", "1.0000"]
+
+
+@pytest.mark.skipif(shutil.which("usearch") is None, reason="usearch not installed")
+def test_metrics_match_usearch(tmp_path):
+    rng = np.random.default_rng(3)
+    abundance = rng.pareto(1.2, 200) + 0.01
+    counts = np.column_stack([rng.multinomial(depth, abundance / abundance.sum())
+        for depth in rng.integers(50, 3000, 12)])
+    table = SparseTable.fromDense([f"Zotu{i + 1}" for i in range(200)], [f"S{j + 1}" for j in range(12)], counts)
+    with open(tmp_path / "otutab.txt", "w") as f:
+        table.writeTsv(f)
+    subprocess.run(["usearch", "-alpha_div", str(tmp_path / "otutab.txt"), "-output", str(tmp_path / "alpha.txt"),
+        "-metrics", ",".join(METRICS)], check=True, capture_output=True)
+    with open(tmp_path / "alpha.txt") as f:
+        header = f.readline().rstrip("\n").split("\t")
+        expected = {}
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            expected[fields[0]] = dict(zip(header[1:], fields[1:]))
+    alpha = formatted(table)
+    for sample in table.samples:
+        for metric in METRICS:
+            assert alpha[sample][metric] == expected[sample][metric], (sample, metric)
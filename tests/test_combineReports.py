@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+
+BIN = os.path.join(os.path.dirname(__file__), "..", "bin")
+
+REPORTS = {
+    "A.kraken2.tsv": [
+        (10, 10, "U", 0, "unclassified"),
+        (90, 0, "R", 1, "root"),
+        (90, 10, "D", 2, "  Bacteria"),
+        (80, 80, "S", 562, "    Escherichia coli"),
+    ],
+    "B.kraken2.tsv": [
+        (5, 5, "U", 0, "unclassified"),
+        (95, 0, "R", 1, "root"),
+        (95, 5, "D", 2, "  Bacteria"),
+        (60, 60, "S", 1423, "    Bacillus subtilis"),
+        (30, 30, "S", 562, "    Escherichia coli"),
+    ],
+}
+BRACKEN_HEADER = "name\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\tadded_reads\tnew_est_reads\tfraction_total_reads\n"
+
+
+def run(tmp_path, *args):
+    return subprocess.run([sys.executable, os.path.join(BIN, "combineReports.py")] + list(args),
+        cwd=tmp_path, capture_output=True, text=True)
+
+
+def writeReports(tmp_path):
+    for name, rows in REPORTS.items():
+        with open(tmp_path / name, "w") as f:
+            for clade, taxon, rank, taxid, label in rows:
+                f.write(f"{clade:6.2f}\t{clade}\t{taxon}\t{rank}\t{taxid}\t{label}\n")
+
+
+def test_kraken_reports(tmp_path):
+    writeReports(tmp_path)
+    assert run(tmp_path, "-i", "A.kraken2.tsv", "B.kraken2.tsv", "-o", "report.tsv", "-m", "matrix.tsv").returncode == 0
+    # Union of the trees, children by decreasing total reads
+    with open(tmp_path / "report.tsv") as f:
+        assert f.read() == ("#Number of Samples: 2\n#Total Number of Reads: 200\n"
+            "#perc\ttot_all\ttot_lvl\tA_all\tA_lvl\tB_all\tB_lvl\tlvl_type\ttaxid\tname\n"
+            "7.50\t15\t15\t10\t10\t5\t5\tU\t0\tunclassified\n"
+            "92.50\t185\t0\t90\t0\t95\t0\tR\t1\troot\n"
+            "92.50\t185\t15\t90\t10\t95\t5\tD\t2\t  Bacteria\n"
+            "55.00\t110\t110\t80\t80\t30\t30\tS\t562\t    Escherichia coli\n"
+            "30.00\t60\t60\t0\t0\t60\t60\tS\t1423\t    Bacillus subtilis\n")
+    with open(tmp_path / "matrix.tsv") as f:
+        assert f.read() == ("taxid\trank\tname\tA\tB\n0\tU\tunclassified\t10\t5\n1\tR\troot\t90\t95\n"
+            "2\tD\tBacteria\t90\t95\n562\tS\tEscherichia coli\t80\t30\n1423\tS\tBacillus subtilis\t0\t60\n")
+
+
+def test_bracken_kind(tmp_path):
+    # Bracken writes an abundance table (.bracken.txt) and a Kraken2 style report (.bracken.tsv)
+    writeReports(tmp_path)
+    os.rename(tmp_path / "A.kraken2.tsv", tmp_path / "A.bracken.tsv")
+    with open(tmp_path / "A.bracken.txt", "w") as f:
+        f.write(BRACKEN_HEADER + "Escherichia coli\t562\tS\t80\t10\t90\t1.00000\n")
+    result = run(tmp_path, "-i", "A.bracken.tsv", "A.bracken.txt", "-o", "bracken.tsv")
+    assert result.returncode == 1 and "duplicate sample names" in result.stdout
+    result = run(tmp_path, "-i", "A.bracken.tsv", "A.bracken.txt", "-k", "bracken", "-o", "bracken.tsv")
+    assert result.returncode == 0 and "skipping A.bracken.tsv" in result.stderr
+    with open(tmp_path / "bracken.tsv") as f:
+        assert f.read() == ("name\ttaxonomy_id\ttaxonomy_lvl\tA_num\tA_frac\n"
+            "Escherichia coli\t562\tS\t90\t1.00000\n")
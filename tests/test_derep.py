@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+
+BIN = os.path.join(os.path.dirname(__file__), "..", "bin")
+sys.path.insert(0, BIN)
+from derep import readRecords
+
+
+def run(script, *args):
+    return subprocess.run([sys.executable, os.path.join(BIN, script)] + [str(arg) for arg in args],
+        capture_output=True, text=True)
+
+
+def writeFasta(path, sequences):
+    with open(path, "w") as f:
+        for i, sequence in enumerate(sequences):
+            f.write(f">read{i + 1}\n{sequence}\n")
+
+
+def test_min_size_in_the_final_merge_only(tmp_path):
+    # ACGT: 2 reads in each shard (4 in total), GGCC: 3 reads in one shard, TTAA: 1 read
+    writeFasta(tmp_path / "s1.fa", ["ACGT", "acgt", "GGCC", "GGCC", "GGCC"])
+    writeFasta(tmp_path / "s2.fa", ["ACGT", "ACGT", "TTAA"])
+    for sample in ("s1", "s2"):
+        assert run("derep.py", "-i", tmp_path / f"{sample}.fa", "-o", tmp_path / f"{sample}.derep.fa").returncode == 0
+    assert sorted((sequence, size) for _, sequence, size in readRecords(str(tmp_path / "s1.derep.fa"))) == \
+        [(b"ACGT", 2), (b"GGCC", 3)]
+
+    # Each shard is merged without the threshold
+    for shard in ("s1", "s2"):
+        assert run("derepMerge.py", "-i", tmp_path / f"{shard}.derep.fa", "-o", tmp_path / f"{shard}.partial.fa",
+            "--partial").returncode == 0
+    result = run("derepMerge.py", "-i", tmp_path / "s1.partial.fa", "--partial", "-m", 3, "-o", tmp_path / "bad.fa")
+    assert result.returncode == 1 and "--min-size" in result.stdout
+
+    # ACGT reaches --min-size 4 only once the shards are summed
+    assert run("derepMerge.py", "-i", tmp_path / "s1.partial.fa", tmp_path / "s2.partial.fa",
+        "-o", tmp_path / "uniques.fasta", "--min-size", 4).returncode == 0
+    with open(tmp_path / "uniques.fasta") as f:
+        assert f.read() == ">Uniq1;size=4\nACGT\n"
+
+    # Sorted by decreasing size
+    assert run("derepMerge.py", "-i", tmp_path / "s1.partial.fa", tmp_path / "s2.partial.fa",
+        "-o", tmp_path / "all.fasta").returncode == 0
+    with open(tmp_path / "all.fasta") as f:
+        assert f.read() == ">Uniq1;size=4\nACGT\n>Uniq2;size=3\nGGCC\n>Uniq3;size=1\nTTAA\n"
@@ -0,0 +1,58 @@
+import io
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+from distanceMatrix import distanceMatrix, editDistance
+
+A = b"ACGTTGCAAGGCTTACCGATGCATTGACCGTAGGCTAACG"
+SEQUENCES = {
+    "a": A,
+    "b": A[:-1] + b"T",                             # one substitution
+    "c": A[2:],                                     # two deletions
+    "d": b"TTTTTTTTTTGGGGGGGGGGAAAAAAAAAACCCCCCCCCC",  # unrelated
+}
+
+
+def levenshtein(a, b):
+    previous = list(range(len(b) + 1))
+    for i, x in enumerate(a):
+        current = [i + 1]
+        for j, y in enumerate(b):
+            current.append(min(previous[j + 1] + 1, current[j] + 1, previous[j] + (x != y)))
+        previous = current
+    return previous[-1]
+
+
+def matrix(**options):
+    f = io.StringIO()
+    distanceMatrix(f, list(SEQUENCES), list(SEQUENCES.values()), **options)
+    return f.getvalue()
+
+
+def test_distance_lines():
+    # Edits over the longest length (40): b-a 1, c-a 2, c-b 3
+    assert matrix() == ("a\ta\t0\n"
+        "b\tb\t0\nb\ta\t0.0250\n"
+        "c\tc\t0\nc\ta\t0.0500\nc\tb\t0.0750\n"
+        "d\td\t0\n")
+    # Same pairs with larger bands, and one block per row
+    assert matrix(bands=32, block=1) == matrix()
+
+
+def test_max_candidates():
+    # c shares more sketch values with a than with b
+    assert matrix(max_candidates=1) == "a\ta\t0\nb\tb\t0\nb\ta\t0.0250\nc\tc\t0\nc\ta\t0.0500\nd\td\t0\n"
+
+
+def test_edit_distance():
+    rng = random.Random(5)
+    for _ in range(200):
+        a = bytes(rng.choice(b"ACGT") for _ in range(rng.randint(0, 70)))
+        b = bytes(rng.choice(b"ACGT") for _ in range(rng.randint(0, 70)))
+        distance = levenshtein(a, b)
+        assert editDistance(a, b, 100) == distance
+        assert editDistance(a, b, distance) == distance
+        if distance > 0:
+            assert editDistance(a, b, distance - 1) is None
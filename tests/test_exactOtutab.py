@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+
+BIN = os.path.join(os.path.dirname(__file__), "..", "bin")
+sys.path.insert(0, BIN)
+from exactOtutab import indexAsvs, reverseComplement
+
+# Stand-in for usearch -otutab: keeps a copy of its input, assigns every read to A1
+OTUTAB = """import shutil, sys
+shutil.copy(sys.argv[1], sys.argv[3])
+reads = sum(1 for line in open(sys.argv[1]) if line.startswith(">"))
+open(sys.argv[2], "w").write("#OTU ID\\tsample\\nA1\\t%d\\n" % reads)
+"""
+
+
+def test_forward_strand_has_the_precedence(tmp_path):
+    # A2 is the reverse complement of A1, A3 is not related
+    with open(tmp_path / "asv.fa", "w") as f:
+        f.write(">A1\nAACCGGTTAC\n>A2\nGTAACCGGTT\n>A3\nAAAACCCGGT\n")
+    names, index = indexAsvs(str(tmp_path / "asv.fa"))
+    assert names == ["A1", "A2", "A3"]
+    assert index[b"AACCGGTTAC"] == 0
+    assert index[b"GTAACCGGTT"] == 1
+    assert index[reverseComplement(b"AAAACCCGGT")] == 2
+
+
+def test_unmatched_reads_go_to_otutab(tmp_path):
+    with open(tmp_path / "asv.fa", "w") as f:
+        f.write(">A1\nAACCGGTTAC\n>A2\nGTAACCGGTT\n>A3\nAAAACCCGGT\n")
+    with open(tmp_path / "reads.fa", "w") as f:
+        # 2 x A2 (one lowercase), 1 x reverse complement of A3, 2 reads without an exact hit
+        f.write(">r1\nGTAACCGGTT\n>r2\ngtaaccggtt\n>r3\nACCGGGTTTT\n>r4\nAACCGGTTAA\n>r5\nCCCCCCCCCC\n")
+    with open(tmp_path / "otutab.py", "w") as f:
+        f.write(OTUTAB)
+    command = f"{sys.executable} {tmp_path / 'otutab.py'} {{input}} {{output}} {tmp_path / 'handoff.fa'}"
+    subprocess.run([sys.executable, os.path.join(BIN, "exactOtutab.py"), "-i", str(tmp_path / "reads.fa"),
+        "-a", str(tmp_path / "asv.fa"), "-s", "S1", "-o", str(tmp_path / "S1.tab"), "-x", command], cwd=tmp_path, check=True)
+    with open(tmp_path / "handoff.fa") as f:
+        assert f.read() == ">r4\nAACCGGTTAA\n>r5\nCCCCCCCCCC\n"
+    with open(tmp_path / "S1.tab") as f:
+        assert f.read() == "#OTU\tS1\nA1\t2\nA2\t2\nA3\t1\n"
+    # The temporary directory is removed
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(".otutab.")]
@@ -0,0 +1,55 @@
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+from exporter import FeatureTable
+from sparseTable import loadNpz
+
+# Relative table as written by pandas (explicit "0.0"), and a mixed one
+# with plain "0" cells next to floats
+FLOAT_TABLE = """#OTU ID\tA01\tA02\tF99
+ASV1\t0.8421333333333333\t0.9\t0.0
+ASV2\t0.0773333333333333\t0.1\t1.0
+ASV3\t0.0805333333333333\t0.0\t0.0
+"""
+MIXED_TABLE = """#OTU ID\tA01\tA02
+ASV1\t0.25\t0
+ASV2\t0\t1.5
+ASV3\t5.0\t0
+"""
+INT_TABLE = """#OTU ID\tA01\tA02\tF99
+ASV1\t1263\t1544\t1341
+ASV6\t29\t40\t0
+"""
+
+
+def baselineCsv(text):
+    # The cells of the input table, copied as they are
+    lines = text.splitlines()
+    csv = "#NAME," + ",".join(lines[0].split("\t")[1:]) + "\n"
+    return csv + "".join(",".join(line.split("\t")) + "\n" for line in lines[1:])
+
+
+def exportTable(path):
+    out = io.StringIO()
+    FeatureTable(path, "\t", "#", "OTU ID").write(out)
+    return out.getvalue()
+
+
+def test_write_matches_input_cells(tmp_path):
+    for text in (FLOAT_TABLE, MIXED_TABLE, INT_TABLE):
+        path = tmp_path / "table.tsv"
+        path.write_text(text)
+        assert exportTable(str(path)) == baselineCsv(text)
+
+
+def test_binary_round_trip(tmp_path):
+    for text in (FLOAT_TABLE, MIXED_TABLE, INT_TABLE):
+        path = tmp_path / "table.tsv"
+        path.write_text(text)
+        FeatureTable(str(path), "\t", "#", "OTU ID").table.save(str(tmp_path / "table.npz"))
+        assert exportTable(str(tmp_path / "table.npz")) == baselineCsv(text)
+        out = io.StringIO()
+        loadNpz(str(tmp_path / "table.npz")).writeTsv(out)
+        assert out.getvalue() == text
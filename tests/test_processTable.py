@@ -0,0 +1,65 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+from processTable import trimTable
+from sparseTable import SparseTable, readTsv
+
+# Thresholds of POSTPROCESS (and TRIM), and stricter ones
+SETTINGS = [
+    {"min_sample_size": 1000, "min_freq": 0.0005, "min_otu_size": 10, "min_count": 0},
+    {"min_sample_size": 1500, "min_freq": 0.01, "min_otu_size": 50, "min_count": 3},
+]
+USEARCH_OPTIONS = {"min_sample_size": "-min_sample_size", "min_freq": "-min_freq",
+    "min_otu_size": "-min_otu_size", "min_count": "-min_count"}
+
+
+def fixtureTable(seed=7, features=300, samples=24):
+    # Skewed counts, with small samples and rare OTUs
+    rng = np.random.default_rng(seed)
+    abundance = rng.pareto(1.2, features) + 0.01
+    depths = rng.integers(200, 5000, samples)
+    counts = np.column_stack([rng.multinomial(depth, abundance / abundance.sum()) for depth in depths])
+    return SparseTable.fromDense([f"Zotu{i + 1}" for i in range(features)], [f"S{j + 1}" for j in range(samples)], counts)
+
+
+def asDict(table):
+    dense = table.toDense()
+    return {(feature, sample): int(dense[i, j]) for i, feature in enumerate(table.features)
+        for j, sample in enumerate(table.samples) if dense[i, j] > 0}
+
+
+def test_trim_thresholds():
+    table = SparseTable.fromDense(["A", "B", "C", "D"], ["S1", "S2", "S3"], [
+        [60, 10, 2],
+        [30, 5, 1],
+        [10, 3, 0],
+        [0, 1, 1],
+    ])
+    # Counts: 3 is below 0.1 x 13 reads of S2 (1.3 is not, 1 < min_count 2).
+    # S3 has 2 reads left (< 5), C keeps 10 reads (= min_otu_size), D none
+    trimmed = trimTable(table, min_sample_size=5, min_freq=0.1, min_otu_size=10, min_count=2)
+    assert trimmed.features == ["A", "B", "C"]
+    assert trimmed.samples == ["S1", "S2"]
+    assert trimmed.toDense().tolist() == [[60, 10], [30, 5], [10, 3]]
+
+
+@pytest.mark.skipif(shutil.which("usearch") is None, reason="usearch not installed")
+@pytest.mark.parametrize("settings", SETTINGS)
+def test_trim_matches_usearch(tmp_path, settings):
+    table = fixtureTable()
+    with open(tmp_path / "otutab.txt", "w") as f:
+        table.writeTsv(f)
+    command = ["usearch", "-otutab_trim", str(tmp_path / "otutab.txt"), "-output", str(tmp_path / "trimmed.txt")]
+    for name, value in settings.items():
+        command += [USEARCH_OPTIONS[name], str(value)]
+    subprocess.run(command, check=True, capture_output=True)
+    expected = readTsv(str(tmp_path / "trimmed.txt"))
+    trimmed = trimTable(table, **settings)
+    assert set(trimmed.samples) == set(expected.samples)
+    assert asDict(trimmed) == asDict(expected)
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+from rarefy import rarefy
+from sparseTable import SparseTable
+
+
+def fixtureTable():
+    return SparseTable.fromDense(["A", "B", "C", "D"], ["S1", "S2", "S3"], [
+        [60, 5, 0],
+        [30, 5, 25],
+        [10, 0, 25],
+        [0, 0, 0],
+    ])
+
+
+def test_rarefied_table():
+    table = fixtureTable()
+    rarefied, _ = rarefy(table, 20, iterations=5, seed=1)
+    # S2 (10 reads) is dropped, D (no reads) too
+    assert rarefied.samples == ["S1", "S3"]
+    dense = rarefied.toDense()
+    original = table.toDense()[[table.features.index(feature) for feature in rarefied.features]][:, [0, 2]]
+    assert dense.sum(axis=0).tolist() == [20, 20]
+    assert (dense <= original).all()
+    assert "D" not in rarefied.features and "A" in rarefied.features
+    # Same draws whatever the number of workers
+    parallel, _ = rarefy(table, 20, iterations=5, seed=1, threads=2, chunk_size=1)
+    assert parallel.features == rarefied.features and np.array_equal(parallel.toDense(), dense)
+
+
+def test_curves():
+    _, curves = rarefy(fixtureTable(), 0, curve_depths=[1, 10, 50], iterations=4, seed=3)
+    # S2 has 10 reads: no point at 50
+    assert [row[0] for row in curves["S2"]] == [1, 10]
+    # At depth 1 one feature is observed, with a Shannon index of 0;
+    # at the full depth of S3 all its features are
+    assert curves["S1"][0][1:] == (1.0, 0.0, 0.0, 0.0)
+    step, observed, observed_sd, index, index_sd = curves["S3"][2]
+    assert (step, observed, observed_sd) == (50, 2.0, 0.0)
+    assert abs(index - np.log(2)) < 1e-12 and index_sd == 0
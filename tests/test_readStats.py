@@ -0,0 +1,36 @@
+import gzip
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+from readStats import scanFastq
+
+
+def writeFastq(path):
+    # Reads 1 to 10, of length 1 to 10
+    with gzip.open(path, "wt") as f:
+        for i in range(1, 11):
+            f.write(f"@read{i}\n{'A' * i}\n+\n{'I' * i}\n")
+
+
+def test_count_and_lengths(tmp_path):
+    path = str(tmp_path / "reads.fastq.gz")
+    writeFastq(path)
+    # Blocks smaller than a record
+    summary = scanFastq(path, blocksize=7)
+    assert (summary["reads"], summary["complete"], summary["sampled"]) == (10, True, 10)
+    assert (summary["min_len"], summary["max_len"], summary["mean_len"], summary["median_len"]) == (1, 10, 5.5, 5.5)
+    # One read every 2 (lengths 1, 3, 5, 7, 9), reads of at least 5 bases
+    assert scanFastq(path, every=2, blocksize=7)["median_len"] == 5.0
+    assert scanFastq(path, min_len=5, blocksize=7)["sampled"] == 6
+
+
+def test_stops_at_min_reads(tmp_path):
+    path = str(tmp_path / "reads.fastq.gz")
+    writeFastq(path)
+    summary = scanFastq(path, min_reads=3, sample_size=2, blocksize=16)
+    assert summary["pass"] and not summary["complete"]
+    assert 3 <= summary["reads"] < 10
+    assert (summary["sampled"], summary["min_len"], summary["max_len"]) == (2, 1, 2)
+    summary = scanFastq(path, min_reads=11, blocksize=16)
+    assert summary["complete"] and not summary["pass"] and summary["reads"] == 10